@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# vi: ts=4 sw=4
+"""
+Usage: pmc_corpus.py [--seed=0] [--scale=1] OUTPUT_DIR
+
+Writes a deterministic synthetic Turbo PMAC configuration corpus for the
+benchmarks: large I/M/P/Q variable blocks, a deep tree of include files
+holding hundreds of nested PLCs, and plenty of comments and quoted text.
+The same seed and scale always give the same files.
+
+Arguments:
+    OUTPUT_DIR       directory to write the corpus to (root.pmc and others)
+
+Options:
+    -s --seed=N      random seed [default: 0]
+    -x --scale=N     size multiplier [default: 1]
+"""
+
+from __future__ import print_function
+import os
+import sys
+import random
+import hashlib
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tpmac.conf import (TpConfig, TpPlcBlock)
+from tpmac.plcsim import (PlcError, compile_plc)
+
+
+ROOT_FN = 'root.pmc'
+
+MOTORS = 32
+COORD_SYSTEMS = 16
+TREE_DEPTH = 6
+TREE_BRANCHING = 2
+# per scale unit
+M_VARS = 4096
+P_VARS = 8192
+Q_VARS = 128
+PLCS_PER_NODE = 8
+PLC_STATEMENTS = 40
+
+_words = ('servo', 'axis', 'encoder', 'home', 'limit', 'phase', 'gather',
+          'status', 'fault', 'clamp', 'brake', 'velocity', 'following error',
+          'ready', 'jog', 'amp', 'temperature', 'retry')
+
+
+class _Random(object):
+    # only random.random() is used: the other methods of random.Random give
+    # different sequences on Python 2 and 3 for the same seed
+    def __init__(self, seed):
+        self._rng = random.Random(seed)
+
+    def below(self, n):
+        return int(self._rng.random() * n)
+
+    def chance(self, p):
+        return self._rng.random() < p
+
+    def choice(self, seq):
+        return seq[self.below(len(seq))]
+
+    def text(self, words=3):
+        return ' '.join(self.choice(_words)
+                        for i in range(1 + self.below(words)))
+
+
+def _comment(rng):
+    # comments with semicolons and quotes of their own
+    kind = rng.below(4)
+    if kind == 0:
+        return '; %s' % rng.text()
+    elif kind == 1:
+        return '; "%s; %s"' % (rng.text(), rng.text())
+    elif kind == 2:
+        return "; %s 'x' ; %s" % (rng.text(), rng.text())
+    return ''
+
+
+def _value(rng):
+    kind = rng.below(5)
+    if kind == 0:
+        return '$%X' % rng.below(0x1000000)
+    elif kind == 1:
+        return '%d.%d' % (rng.below(100000) - 50000, rng.below(1000))
+    elif kind == 2:
+        return '(P%d+%d)*2' % (rng.below(1000), rng.below(100))
+    return '%d' % rng.below(100000)
+
+
+def _ivar_lines(rng):
+    yield ';#### I-variables'
+    for num in range(100):
+        yield ('I%d=%s %s' % (num, _value(rng), _comment(rng))).rstrip()
+
+    for motor in range(1, MOTORS + 1):
+        yield ''
+        yield '; motor %d %s' % (motor, rng.text())
+        for param in range(100):
+            yield ('I%d=%s %s' % (motor * 100 + param, _value(rng),
+                                  _comment(rng))).rstrip()
+
+    for cs in range(1, COORD_SYSTEMS + 1):
+        yield 'I%d..%d=0 ; coordinate system %d' % (5000 + cs * 100,
+                                                    5000 + cs * 100 + 99, cs)
+
+    for num in range(7000, 7100):
+        yield 'I%d=%s' % (num, _value(rng))
+
+
+def _mvar_lines(rng, scale):
+    yield ';#### M-variables'
+    yield 'M0..%d->*  ; self-referenced' % (M_VARS * scale - 1)
+    for num in range(M_VARS * scale):
+        kind = rng.below(4)
+        word = 0x78000 + rng.below(0x1000)
+        if kind == 0:
+            definition = 'Y:$%05X,%d,%d' % (word, rng.below(24), 1)
+        elif kind == 1:
+            definition = 'X:$%05X,0,24,S' % word
+        elif kind == 2:
+            definition = 'D:$%06X' % (0x800 + rng.below(0x2000))
+        else:
+            definition = 'Y:$%05X,%d' % (word, rng.below(24))
+
+        line = 'M%d->%s %s' % (num, definition, _comment(rng))
+        yield line.rstrip()
+
+
+def _pvar_lines(rng, scale):
+    yield ';#### P-variables'
+    for num in range(P_VARS * scale):
+        if rng.chance(0.05):
+            yield '; %s' % rng.text(6)
+        yield ('P%d=%s %s' % (num, _value(rng), _comment(rng))).rstrip()
+
+    for cs in range(1, COORD_SYSTEMS + 1):
+        yield '&%d' % cs
+        for motor in range(1, 1 + rng.below(4)):
+            yield '#%d->%dX' % (motor + cs, 1000 * (1 + rng.below(10)))
+        for num in range(1, Q_VARS * scale + 1):
+            yield 'Q%d=%s' % (num, _value(rng))
+
+
+def _plc_lines(rng, number, statements):
+    yield 'OPEN PLC %d CLEAR' % number
+    # [closing word, has an ELSE] of the open blocks, innermost last
+    closers = []
+    for i in range(statements):
+        # messy indentation, for fix-indent to clean up
+        pad = ' ' * rng.below(6)
+        kind = rng.below(10)
+        if kind < 2 and len(closers) < 6:
+            if rng.chance(0.5):
+                yield '%sIF (M%d = 1 AND P%d > %d)' % (pad, rng.below(4096),
+                                                       rng.below(8192),
+                                                       rng.below(100))
+                closers.append(['ENDIF', False])
+            else:
+                yield '%sWHILE (P%d < %d)' % (pad, rng.below(8192),
+                                              rng.below(100))
+                closers.append(['ENDWHILE', False])
+        elif kind == 2 and closers:
+            closer = closers[-1]
+            if closer == ['ENDIF', False] and rng.chance(0.5):
+                closer[1] = True
+                yield '%sELSE' % pad
+            else:
+                yield '%s%s' % (pad, closers.pop()[0])
+        elif kind == 3:
+            yield '%sCMD"#%dJ+" ; jog "%s"' % (pad, 1 + rng.below(MOTORS),
+                                              rng.text())
+        elif kind == 4:
+            yield '%sSEND"%s; done"' % (pad, rng.text())
+        elif kind == 5:
+            yield '%s; %s' % (pad, rng.text(5))
+        elif kind == 6:
+            yield '%sP(M%d+%d)=I%d%02d' % (pad, rng.below(4096),
+                                           rng.below(10),
+                                           1 + rng.below(MOTORS),
+                                           rng.below(100))
+        else:
+            yield ('%sP%d=P%d+%d %s' % (pad, rng.below(8192), rng.below(8192),
+                                        rng.below(10), _comment(rng))).rstrip()
+
+    while closers:
+        yield closers.pop()[0]
+
+    yield 'DISABLE PLC %d' % number
+    yield 'CLOSE'
+
+
+def _check_plc(number, lines):
+    # the corpus must stay valid PMAC code: compile each PLC as plcsim does
+    plc = TpPlcBlock(number)
+    for line in lines[1:-1]:
+        plc.append(*TpConfig.split_comment(line))
+
+    try:
+        compile_plc(plc)
+    except PlcError as ex:
+        raise RuntimeError('Generated PLC %d does not compile: %s' %
+                           (number, ex))
+
+
+def _node_fn(depth, index):
+    return 'tree/node_%d_%d.pmc' % (depth, index)
+
+
+def _node_lines(rng, depth, index, scale):
+    yield '; include tree node %d.%d' % (depth, index)
+    if depth + 1 < TREE_DEPTH:
+        for i in range(TREE_BRANCHING):
+            child = os.path.basename(_node_fn(depth + 1,
+                                              index * TREE_BRANCHING + i))
+            yield '#include "%s"' % child
+
+    first_p = 10000 + 100 * (depth * 64 + index)
+    for num in range(first_p, first_p + 20):
+        yield ('P%d=%s %s' % (num, _value(rng), _comment(rng))).rstrip()
+
+    for i in range(PLCS_PER_NODE * scale):
+        number = (index * PLCS_PER_NODE + i) % 32
+        lines = list(_plc_lines(rng, number, PLC_STATEMENTS))
+        _check_plc(number, lines)
+        for line in lines:
+            yield line
+        yield ''
+
+
+def corpus_files(seed=0, scale=1):
+    '''
+    [(relative filename, [lines])] of the corpus, root file first
+    '''
+    rng = _Random(seed)
+    files = [('ivars.pmc', list(_ivar_lines(rng))),
+             ('mvars.pmc', list(_mvar_lines(rng, scale))),
+             ('pvars.pmc', list(_pvar_lines(rng, scale))),
+             ]
+
+    for depth in range(TREE_DEPTH):
+        for index in range(TREE_BRANCHING ** depth):
+            files.append((_node_fn(depth, index),
+                          list(_node_lines(rng, depth, index, scale))))
+
+    root = [';####################################################',
+            '; synthetic benchmark corpus (seed %d, scale %d)' % (seed, scale),
+            ';####################################################']
+    root.extend('#include "%s"' % fn for fn, lines in files[:3])
+    root.append('#include "%s"' % _node_fn(0, 0))
+    return [(ROOT_FN, root)] + files
+
+
+def write_corpus(path, seed=0, scale=1):
+    '''
+    Write the corpus to path; returns (file paths, total lines, sha1 digest
+    of the contents)
+    '''
+    digest = hashlib.sha1()
+    fns = []
+    total = 0
+    for fn, lines in corpus_files(seed=seed, scale=scale):
+        full_fn = os.path.join(path, fn)
+        dir_ = os.path.dirname(full_fn)
+        if not os.path.isdir(dir_):
+            os.makedirs(dir_)
+
+        text = ''.join('%s\n' % line for line in lines)
+        with open(full_fn, 'wt') as f:
+            f.write(text)
+
+        digest.update(fn.encode('ascii'))
+        digest.update(text.encode('ascii'))
+        fns.append(full_fn)
+        total += len(lines)
+
+    return fns, total, digest.hexdigest()
+
+
+if __name__ == '__main__':
+    opts = docopt(__doc__)
+    fns, lines, digest = write_corpus(opts['OUTPUT_DIR'],
+                                      seed=int(opts['--seed']),
+                                      scale=int(opts['--scale']))
+    print('%d files, %d lines (sha1 %s)' % (len(fns), lines, digest))
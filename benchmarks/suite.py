@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# vi: ts=4 sw=4
+"""
+Usage: suite.py [--seed=0] [--scale=1] [--repeat=3] [--profile=geobrick_lv] [--corpus=DIR] [--output=JSON] [--baseline=JSON] [--tolerance=0.25] [BENCHMARK...]
+
+Measures the throughput and peak memory of the parsing, cleaning and
+information lookup paths on a synthetic corpus (see pmc_corpus.py).  Each
+benchmark runs in a process of its own, so that peak memory is its own.
+
+Results can be written as JSON and compared against a stored baseline (an
+earlier --output); the exit status is 1 if any benchmark regressed by more
+than the tolerance.
+
+Arguments:
+    BENCHMARK          benchmarks to run (all by default): load, dump,
+                       clean, include_graph, lookup, search
+
+Options:
+    -s --seed=N        corpus random seed [default: 0]
+    -x --scale=N       corpus size multiplier [default: 1]
+    -r --repeat=N      timed runs of each benchmark [default: 3]
+    -p --profile=x     variable information profile [default: geobrick_lv]
+    -c --corpus=DIR    write (and keep) the corpus in DIR
+    -o --output=JSON   write the results to a file
+    -b --baseline=JSON compare against the results of an earlier run
+    -t --tolerance=F   allowed slowdown or memory growth [default: 0.25]
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import multiprocessing
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pmc_corpus
+from tpmac import info
+from tpmac.conf import (TpConfig, TpIncludeGraph)
+from tpmac.clean import clean_pmc
+
+
+RESULTS_VERSION = 1
+# memory differences below this are noise, whatever the tolerance
+MEMORY_SLACK_KB = 1024
+
+_search_texts = ('servo', 'encoder', 'following error', 'home', 'jog',
+                 'coordinate system', 'phase', 'gather', 'limit', 'amp',
+                 'velocity', 'temperature', 'ready', 'brake', 'status')
+
+
+def _corpus_mvar_addresses(corpus):
+    # the M-variable definitions of the corpus, e.g. Y:$78005,8,1
+    with open(os.path.join(corpus['path'], 'mvars.pmc'), 'rt') as f:
+        for line in f:
+            code = line.split(';')[0]
+            if '->' in code and ':$' in code:
+                yield code.split('->', 1)[1].strip()
+
+
+def _bench_load(corpus, profile):
+    fns = corpus['fns']
+
+    def run():
+        return [TpConfig(fn, verbose=False) for fn in fns]
+
+    return run, corpus['lines'], 'lines'
+
+
+def _bench_dump(corpus, profile):
+    configs = [TpConfig(fn, verbose=False) for fn in corpus['fns']]
+
+    def run():
+        return [list(config.dump()) for config in configs]
+
+    return run, corpus['lines'], 'lines'
+
+
+def _bench_clean(corpus, profile):
+    info.load_settings(profile)
+    fns = corpus['fns']
+
+    def run():
+        return [list(clean_pmc(fn, annotate=True, fix_indent=True))
+                for fn in fns]
+
+    return run, corpus['lines'], 'lines'
+
+
+def _bench_include_graph(corpus, profile):
+    root = corpus['fns'][0]
+
+    def run():
+        graph = TpIncludeGraph([root], workers=1, verbose=False)
+        return list(graph.flatten())
+
+    return run, corpus['lines'], 'lines'
+
+
+def _bench_lookup(corpus, profile):
+    info.load_settings(profile)
+    texts = ['I%d' % num for num in range(0, 3300, 3)]
+    texts.extend(list(_corpus_mvar_addresses(corpus))[:2000])
+    texts.extend(_search_texts)
+
+    # the first lookups of a profile read its tables
+    info.lookup(texts[0])
+
+    def run():
+        return [info.lookup(text) for text in texts]
+
+    return run, len(texts), 'lookups'
+
+
+def _bench_search(corpus, profile):
+    profile = info.get_profile(profile)
+    tables = (profile.toc_info, profile.ivar_info)
+    texts = list(_search_texts)
+    # substrings as typed, a character at a time
+    for text in _search_texts:
+        texts.extend(text[:i] for i in range(3, len(text)))
+
+    for table in tables:
+        list(table.search(texts[0]))
+
+    def run():
+        return [list(table.search(text)) for table in tables
+                for text in texts]
+
+    return run, len(texts) * len(tables), 'searches'
+
+
+BENCHMARKS = [('load', _bench_load),
+              ('dump', _bench_dump),
+              ('clean', _bench_clean),
+              ('include_graph', _bench_include_graph),
+              ('lookup', _bench_lookup),
+              ('search', _bench_search),
+              ]
+
+
+def _peak_rss_kb():
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+def memory_method():
+    if tracemalloc is not None:
+        return 'tracemalloc'
+    elif resource is not None:
+        return 'maxrss'
+    return None
+
+
+def _run_benchmark(args):
+    name, corpus, profile, repeat = args
+    setup = dict(BENCHMARKS)[name]
+    run, items, unit = setup(corpus, profile)
+
+    method = memory_method()
+    if method == 'maxrss':
+        rss_before = _peak_rss_kb()
+
+    times = []
+    for i in range(repeat):
+        t0 = time.time()
+        result = run()
+        times.append(time.time() - t0)
+        del result
+
+    peak_kb = None
+    if method == 'maxrss':
+        peak_kb = _peak_rss_kb() - rss_before
+    elif method == 'tracemalloc':
+        # an extra, untimed run: tracing slows everything down
+        tracemalloc.start()
+        result = run()
+        peak_kb = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+        del result
+
+    best = min(times)
+    return {'seconds': best,
+            'mean_seconds': sum(times) / len(times),
+            'repeat': repeat,
+            'items': items,
+            'unit': unit,
+            'throughput': items / max(best, 1e-9),
+            'peak_kb': peak_kb,
+            }
+
+
+def run_benchmarks(names, corpus, profile='geobrick_lv', repeat=3):
+    '''
+    {name: result} of the benchmarks, each run in a new process
+    '''
+    results = {}
+    for name in names:
+        pool = multiprocessing.Pool(1)
+        try:
+            results[name] = pool.apply(_run_benchmark,
+                                       ((name, corpus, profile, repeat), ))
+        finally:
+            pool.close()
+            pool.join()
+
+    return results
+
+
+def compare(results, baseline, tolerance=0.25):
+    '''
+    [(benchmark, metric, baseline value, value)] of the regressions of
+    results against baseline: throughput lower, or peak memory higher, by
+    more than tolerance (a fraction)
+    '''
+    regressions = []
+    for name, result in sorted(results['benchmarks'].items()):
+        try:
+            base = baseline['benchmarks'][name]
+        except KeyError:
+            continue
+
+        if result['throughput'] < base['throughput'] * (1.0 - tolerance):
+            regressions.append((name, 'throughput', base['throughput'],
+                                result['throughput']))
+
+        peak, base_peak = result['peak_kb'], base['peak_kb']
+        if (peak is not None and base_peak is not None and
+                peak > base_peak * (1.0 + tolerance) and
+                peak - base_peak > MEMORY_SLACK_KB):
+            regressions.append((name, 'peak_kb', base_peak, peak))
+
+    return regressions
+
+
+def _comparable(results, baseline):
+    # warnings for results which are not measured on the same terms
+    for key in ('version', 'corpus', 'python', 'memory'):
+        if results.get(key) != baseline.get(key):
+            yield ('baseline %s differs: %s (now %s)' %
+                   (key, baseline.get(key), results.get(key)))
+
+
+def format_results(results, baseline=None):
+    benchmarks = results['benchmarks']
+    yield '%-14s %10s %20s %10s %12s' % ('benchmark', 'seconds', 'throughput',
+                                         'peak kB', 'vs baseline')
+    for name, result in sorted(benchmarks.items()):
+        change = ''
+        if baseline is not None and name in baseline['benchmarks']:
+            base = baseline['benchmarks'][name]['throughput']
+            change = '%+.1f%%' % (100.0 * (result['throughput'] / base - 1.0))
+
+        peak = result['peak_kb']
+        yield '%-14s %10.3f %9.0f %-10s %10s %12s' % (
+            name, result['seconds'], result['throughput'],
+            result['unit'] + '/s', '-' if peak is None else peak, change)
+
+
+def main(names, seed=0, scale=1, repeat=3, profile='geobrick_lv',
+         corpus_dir=None):
+    '''
+    Results of the benchmarks names, as stored in JSON
+    '''
+    path = corpus_dir or tempfile.mkdtemp(prefix='tpmac-bench-')
+    try:
+        fns, lines, digest = pmc_corpus.write_corpus(path, seed=seed,
+                                                     scale=scale)
+        corpus = {'path': path, 'fns': fns, 'lines': lines}
+        benchmarks = run_benchmarks(names, corpus, profile=profile,
+                                    repeat=repeat)
+    finally:
+        if corpus_dir is None:
+            shutil.rmtree(path)
+
+    return {'version': RESULTS_VERSION,
+            'corpus': {'seed': seed, 'scale': scale, 'files': len(fns),
+                       'lines': lines, 'sha1': digest},
+            'profile': profile,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'memory': memory_method(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'benchmarks': benchmarks,
+            }
+
+
+if __name__ == '__main__':
+    opts = docopt(__doc__)
+
+    names = opts['BENCHMARK'] or [name for name, setup in BENCHMARKS]
+    unknown = set(names) - set(name for name, setup in BENCHMARKS)
+    if unknown:
+        raise SystemExit('Unknown benchmark(s): %s' %
+                         ', '.join(sorted(unknown)))
+
+    results = main(names, seed=int(opts['--seed']),
+                   scale=int(opts['--scale']), repeat=int(opts['--repeat']),
+                   profile=opts['--profile'], corpus_dir=opts['--corpus'])
+
+    baseline = None
+    if opts['--baseline']:
+        with open(opts['--baseline'], 'rt') as f:
+            baseline = json.load(f)
+
+    for line in format_results(results, baseline):
+        print(line)
+
+    if opts['--output']:
+        with open(opts['--output'], 'wt') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if baseline is not None:
+        for warning in _comparable(results, baseline):
+            print('warning: %s' % warning, file=sys.stderr)
+
+        regressions = compare(results, baseline,
+                              tolerance=float(opts['--tolerance']))
+        for name, metric, base, value in regressions:
+            print('REGRESSION %s %s: %.1f -> %.1f' % (name, metric, base,
+                                                      value))
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# vi: ts=4 sw=4
+"""
+Usage: tpvar_memory.py [--files=12] [PMC_FILE]
+
+Compares the memory used per variable by the compact TpVar/TpVars storage
+against the previous dictionary-based representation, loading PMC_FILE
+(the bundled geobrick_lv M-variable definitions by default) as if it were
+open several times.
+
+Options:
+    -f --files=N     number of copies of the file to load [default: 12]
+"""
+
+from __future__ import print_function
+import os
+import sys
+import gc
+import types
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tpmac.conf import (TpConfig, TpVar, TpVars)
+from tpmac import util
+
+DEFAULT_FILE = os.path.join(util.get_profile_path('geobrick_lv'),
+                            'm_variables.pmc')
+
+
+class DictTpVar(object):
+    '''The previous TpVar: one __dict__ and private strings per variable'''
+    def __init__(self, var, value, comment=None):
+        self.type_ = var[0].lower()
+        self.var = int(var[1:])
+        self.value = value.strip()
+        self.comment = comment
+
+
+class DictTpVars(object):
+    '''The previous TpVars: a dictionary of variable number to TpVar'''
+    def __init__(self, type_):
+        self.type_ = type_
+        self.items = {}
+
+    def add_var(self, tpvar):
+        self.items[tpvar.var] = tpvar
+
+
+_skip_types = (type, types.ModuleType, types.FunctionType,
+               types.BuiltinFunctionType)
+
+
+def deep_sizeof(*objs):
+    seen = set()
+    total = 0
+    pending = list(objs)
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, _skip_types):
+            continue
+
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+
+    return total
+
+
+def read_vars(fn):
+    # a fresh read each time, as tpview does for each open file
+    with open(fn, 'rt') as f:
+        lines = [line.rstrip() for line in f.readlines()]
+
+    for line_num, line, comment in TpConfig.parse_lines(lines):
+        m = TpConfig.var_re.match(line.rstrip())
+        if m:
+            var, eq, value = m.groups()
+            yield var, value.strip(), comment
+
+
+def measure(fn, files, var_cls, vars_cls):
+    containers = []
+    count = 0
+    for i in range(files):
+        per_type = {}
+        for var, value, comment in read_vars(fn):
+            tpvar = var_cls(var, value, comment)
+            if tpvar.type_ not in per_type:
+                per_type[tpvar.type_] = vars_cls(tpvar.type_)
+
+            per_type[tpvar.type_].add_var(tpvar)
+            count += 1
+
+        containers.extend(per_type.values())
+
+    return deep_sizeof(containers) - deep_sizeof([]), count
+
+
+def main(fn, files):
+    results = []
+    for label, var_cls, vars_cls in [('dict', DictTpVar, DictTpVars),
+                                     ('compact', TpVar, TpVars)]:
+        total, count = measure(fn, files, var_cls, vars_cls)
+        results.append((label, total, count))
+
+    print('%s x %d' % (fn, files))
+    print('%-10s %12s %10s %10s' % ('storage', 'bytes', 'variables',
+                                    'bytes/var'))
+    for label, total, count in results:
+        print('%-10s %12d %10d %10.1f' % (label, total, count,
+                                          float(total) / max(count, 1)))
+
+    return results
+
+
+if __name__ == '__main__':
+    opts = docopt(__doc__)
+    main(opts['PMC_FILE'] or DEFAULT_FILE, int(opts['--files']))
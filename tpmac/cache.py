@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# vi: ts=4 sw=4
+"""
+tpmac.cache
+Optional on-disk cache of parsed TpConfig block models, keyed by file
+content hash and parser (model) version.
+
+Usage:
+    cache = ParseCache('/path/to/cache')
+    config = TpConfig('file.pmc', cache=cache)
+"""
+
+from __future__ import print_function
+import os
+import io
+import sys
+import errno
+import marshal
+import hashlib
+import tempfile
+
+from . import (conf, stats, util)
+
+
+DEFAULT_PATH = util.CACHE_PATH
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+# the directory is rescanned after this many puts, counting the files
+# written by other processes sharing it
+RESCAN_PUTS = 256
+
+ENTRY_DIR = 'entries'
+PATH_DIR = 'paths'
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+
+
+class ParseCache(object):
+    '''
+    Entries are marshalled TpConfig.get_model() tuples stored under the
+    sha1 of the file contents.  A small per-path record of (mtime, size,
+    content hash) lets unchanged files skip reading and hashing entirely.
+
+    Files are written to a temporary name and renamed into place, so
+    several processes may share a cache directory; unreadable entries are
+    treated as misses.  The least recently used files are evicted once the
+    directory grows past max_size bytes.  Its size is only scanned on the
+    first put and every RESCAN_PUTS puts; in between, the sizes of the
+    entries written are added to it.
+    '''
+    def __init__(self, path=DEFAULT_PATH, max_size=DEFAULT_MAX_SIZE):
+        self.path = os.path.abspath(path)
+        self.max_size = int(max_size)
+        self.hits = 0
+        self.misses = 0
+        # tracked size of the directory (None until scanned)
+        self._size = None
+        self._puts = 0
+
+        for dir_ in (ENTRY_DIR, PATH_DIR):
+            _makedirs(os.path.join(self.path, dir_))
+
+    @property
+    def version(self):
+        # marshal's format depends on the python version
+        return '%d-%d%d' % ((conf.MODEL_VERSION, ) + sys.version_info[:2])
+
+    def _entry_fn(self, key):
+        return os.path.join(self.path, ENTRY_DIR,
+                            '%s-%s' % (key, self.version))
+
+    def _path_fn(self, fn):
+        path_key = hashlib.sha1(os.path.abspath(fn).encode('utf-8'))
+        return os.path.join(self.path, PATH_DIR, path_key.hexdigest())
+
+    def _read(self, fn):
+        try:
+            with open(fn, 'rb') as f:
+                data = marshal.load(f)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+
+        try:
+            # mark as recently used
+            os.utime(fn, None)
+        except OSError:
+            pass
+
+        return data
+
+    def _write(self, fn, data):
+        # the size written, or None on failure
+        dir_ = os.path.dirname(fn)
+        fd, temp_fn = tempfile.mkstemp(dir=dir_, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                marshal.dump(data, f)
+                size = f.tell()
+
+            # mkstemp creates files readable only by their owner
+            os.chmod(temp_fn, 0o644)
+
+            try:
+                os.rename(temp_fn, fn)
+            except OSError:
+                # windows will not rename over an existing file
+                if os.path.exists(fn):
+                    os.unlink(fn)
+                os.rename(temp_fn, fn)
+        except (IOError, OSError):
+            try:
+                os.unlink(temp_fn)
+            except OSError:
+                pass
+            return None
+
+        return size
+
+    def get(self, key):
+        '''
+        The block model stored under the content hash key, or None
+        '''
+        model = self._read(self._entry_fn(key))
+        if model is not None and model[0] != conf.MODEL_VERSION:
+            model = None
+
+        return model
+
+    def put(self, key, model):
+        size = self._write(self._entry_fn(key), model)
+
+        self._puts += 1
+        if self._size is None or self._puts % RESCAN_PUTS == 0:
+            self._size = self.size()
+        elif size is not None:
+            self._size += size
+
+        if self._size > self.max_size:
+            self.evict()
+
+    def _hit(self, config, model, verbose):
+        self.hits += 1
+        config.set_model(model, verbose=verbose)
+        if stats.current is not None:
+            stats.current.count('cached_files')
+
+    def load_config(self, config, fn, **kwargs):
+        '''
+        Load fn into config, from the cache if possible.  kwargs are passed
+        on to TpConfig.load_config on a miss.
+        '''
+        st = os.stat(fn)
+        stamp = (st.st_mtime, st.st_size)
+
+        path_fn = self._path_fn(fn)
+        path_info = self._read(path_fn)
+        if path_info is not None and tuple(path_info[:2]) == stamp:
+            model = self.get(path_info[2])
+            if model is not None:
+                self._hit(config, model, kwargs.get('verbose', True))
+                return
+
+        with open(fn, 'rb') as f:
+            data = f.read()
+
+        key = hashlib.sha1(data).hexdigest()
+        model = self.get(key)
+        if model is not None:
+            self._hit(config, model, kwargs.get('verbose', True))
+        else:
+            self.misses += 1
+            config.load_config(io.BytesIO(data), **kwargs)
+            self.put(key, config.get_model())
+
+        self._write(path_fn, stamp + (key, ))
+
+    def _files(self):
+        for dir_ in (ENTRY_DIR, PATH_DIR):
+            dir_ = os.path.join(self.path, dir_)
+            for fn in os.listdir(dir_):
+                fn = os.path.join(dir_, fn)
+                try:
+                    st = os.stat(fn)
+                except OSError:
+                    # removed by another process
+                    continue
+
+                yield st.st_mtime, st.st_size, fn
+
+    def size(self):
+        return sum(size for mtime, size, fn in self._files())
+
+    def evict(self, max_size=None):
+        '''
+        Remove least recently used files until the cache is below max_size
+        '''
+        if max_size is None:
+            max_size = self.max_size
+
+        files = sorted(self._files())
+        total = sum(size for mtime, size, fn in files)
+        for mtime, size, fn in files:
+            if total <= max_size:
+                break
+
+            try:
+                os.unlink(fn)
+            except OSError:
+                pass
+
+            total -= size
+
+        self._size = total
+
+    def clear(self):
+        self.evict(max_size=0)
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # vi: ts=4 sw=4
 """
-Usage: tpmac.clean [-fav] [--indent=2] [--profile=geobrick_lv] [--min-col=10] INPUT_PMC [OUTPUT_PMC]
+Usage: tpmac.clean [-fav] [--indent=2] [--profile=geobrick_lv] [--min-col=10] [--cache=DIR] [--stats=FILE] INPUT_PMC [OUTPUT_PMC]
 
 Cleans up indentation and optionally annotates Turbo PMAC configuration files (.pmc)
 
@@ -16,6 +16,8 @@ Options:
     -m --min-col=10  minimum column to align comments [default: 10]
     -v --verbose     verbose mode
     -p --profile=x   variable information profile [default: geobrick_lv]
+    --cache=DIR      cache parsed files in DIR
+    --stats=FILE     write stage timings and counters as JSON (- for stderr)
 """
 
 from __future__ import print_function
@@ -23,23 +25,78 @@ import sys
 
 from docopt import docopt
 
-from . import conf
+from . import (conf, stats)
 from .conf import TpConfig
+from .cache import ParseCache
 from . import info as tp_info
 
 
 def clean_pmc(input_fn, verbose=False, annotate=False,
-              fix_indent=False, indent=2):
-    config = TpConfig(input_fn, verbose=verbose)
-
+              fix_indent=False, indent=2, cache=None):
+    with stats.stage('load'):
+        config = TpConfig(input_fn, verbose=verbose, cache=cache)
+    return clean_config(config, annotate=annotate, fix_indent=fix_indent,
+                        indent=indent)
+
+
+def write_clean_pmc(input_fn, output, verbose=False, annotate=False,
+                    fix_indent=False, indent=2, cache=None):
+    '''
+    As clean_pmc, writing the result to the file object output in bulk
+    (see TpConfig.write).  Returns the configuration.
+    '''
+    with stats.stage('load'):
+        config = TpConfig(input_fn, verbose=verbose, cache=cache)
+
+    prepare_config(config, annotate=annotate, fix_indent=fix_indent,
+                   indent=indent)
+
+    with stats.stage('dump'):
+        config.write(output)
+
+    return config
+
+
+def clean_many(input_fns, verbose=False, annotate=False,
+               fix_indent=False, indent=2, cache=None, workers=None):
+    '''
+    Clean several files, parsing them in parallel (see conf.load_many).
+    Returns a list of line generators in the order of input_fns.
+    '''
+    configs = conf.load_many(input_fns, workers=workers, verbose=verbose,
+                             cache=cache)
+    return [clean_config(config, annotate=annotate, fix_indent=fix_indent,
+                         indent=indent)
+            for config in configs]
+
+
+def prepare_config(config, annotate=False, fix_indent=False, indent=2):
+    '''
+    Annotate and reindent a configuration in place
+    '''
     if annotate:
-        for vars_ in config.variables.values():
-            for tpvar in vars_:
-                tpvar.annotate()
+        with stats.stage('annotate'):
+            for vars_ in config.variables.values():
+                for tpvar in vars_:
+                    tpvar.annotate()
+
+        if stats.current is not None:
+            stats.current.count('annotated_vars',
+                                sum(len(vars_)
+                                    for vars_ in config.variables.values()))
 
     if fix_indent:
-        for plc in config.plcs.values():
-            plc.reformat(start_indent=indent, indent_amount=indent)
+        with stats.stage('reformat'):
+            for plc in config.plcs.values():
+                plc.reformat(start_indent=indent, indent_amount=indent)
+
+        if stats.current is not None:
+            stats.current.count('reformatted_plcs', len(config.plcs))
+
+
+def clean_config(config, annotate=False, fix_indent=False, indent=2):
+    prepare_config(config, annotate=annotate, fix_indent=fix_indent,
+                   indent=indent)
 
     for line in config.dump():
         yield line
@@ -56,16 +113,31 @@ if __name__ == '__main__':
 
     conf.MIN_COMMENT_COL = int(opts['--min-col'])
 
-    ret = clean_pmc(input_fn,
-                    annotate=opts['--annotate'],
-                    fix_indent=opts['--fix-indent'],
-                    indent=indent,
-                    verbose=verbose)
+    if opts['--cache']:
+        cache = ParseCache(opts['--cache'])
+    else:
+        cache = None
 
     if output_fn is not None:
         output_ = open(output_fn, 'wt')
     else:
         output_ = sys.stdout
 
-    for line in ret:
-        print(line, file=output_)
+    with stats.collect(enabled=bool(opts['--stats'])) as pipeline_stats:
+        with stats.stage('total'):
+            config = write_clean_pmc(input_fn, output_,
+                                     annotate=opts['--annotate'],
+                                     fix_indent=opts['--fix-indent'],
+                                     indent=indent,
+                                     verbose=verbose,
+                                     cache=cache)
+
+    if verbose:
+        for line in config.format_diagnostics():
+            print(line, file=sys.stderr)
+
+    if opts['--stats'] == '-':
+        pipeline_stats.write_json(sys.stderr)
+    elif opts['--stats']:
+        with open(opts['--stats'], 'wt') as f:
+            pipeline_stats.write_json(f)
@@ -0,0 +1,477 @@
+#!/usr/bin/env python
+# vi: ts=4 sw=4
+"""
+Usage: tpmac.comm [-osv] [--host=HOST] [--port=1025] [--depth=32] INPUT_PMC
+
+Downloads a Turbo PMAC configuration file over the Ethernet ASCII
+protocol, pipelining commands and packing several lines per packet
+
+Arguments:
+    INPUT_PMC          the PMC file to download
+
+Options:
+    -H --host=HOST     controller address [default: 192.168.0.200]
+    -p --port=PORT     controller port [default: 1025]
+    -d --depth=N       packets in flight per connection [default: 32]
+    -o --optimize      collapse assignments into range commands first
+    -s --standin       download to a local stand-in server instead
+    -v --verbose       verbose mode
+"""
+
+from __future__ import print_function
+import re
+import sys
+import time
+import socket
+import struct
+import threading
+from contextlib import contextmanager
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from docopt import docopt
+
+from . import util
+
+
+DEFAULT_PORT = 1025
+DEFAULT_DEPTH = 32
+DEFAULT_TIMEOUT = 2.0
+
+# Turbo PMAC command line buffer limit, in characters
+MAX_LINE = 255
+
+# Ethernet protocol request types and requests
+VR_UPLOAD = 0xC0
+VR_DOWNLOAD = 0x40
+
+VR_PMAC_SENDLINE = 0xB0
+VR_PMAC_GETLINE = 0xB1
+VR_PMAC_FLUSH = 0xB3
+VR_PMAC_GETRESPONSE = 0xBF
+
+# RequestType, Request, wValue, wIndex, wLength (network byte order)
+HEADER = struct.Struct('>BBHHH')
+
+ACK = b'\x06'
+BELL = b'\x07'
+
+_error_re = re.compile(br'\x07ERR(\d+)\r')
+
+
+class PmacError(Exception):
+    def __init__(self, message, code=None, command=None):
+        Exception.__init__(self, message)
+        self.code = code
+        self.command = command
+
+
+def make_packet(request, data=b'', request_type=VR_DOWNLOAD, value=0,
+                index=0):
+    return HEADER.pack(request_type, request, value, index, len(data)) + data
+
+
+def split_response(buf):
+    '''
+    (response, remaining bytes) of the first complete response in buf, or
+    None.  A response ends with an ACK, or is an error: BELL ERRnnn CR.
+    '''
+    ack = buf.find(ACK)
+    bell = buf.find(BELL)
+    if bell != -1 and (ack == -1 or bell < ack):
+        m = _error_re.search(buf, bell)
+        if m is None:
+            return None
+        return buf[:m.end()], buf[m.end():]
+
+    if ack == -1:
+        return None
+
+    return buf[:ack + 1], buf[ack + 1:]
+
+
+def parse_response(response, command=None):
+    '''
+    The reply lines of a response, or PmacError for error responses
+    '''
+    m = _error_re.search(response)
+    if m is not None:
+        code = int(m.group(1))
+        return PmacError('ERR%03d: %s' % (code, command), code=code,
+                         command=command)
+
+    text = response.rstrip(ACK).decode('ascii')
+    return [line for line in text.split('\r') if line]
+
+
+def strip_comment(line):
+    '''
+    A line without its ; or // comment (outside of quotes)
+    '''
+    if ';' not in line and '//' not in line:
+        return line.strip()
+
+    in_quotes = False
+    for i, c in enumerate(line):
+        if c == '"':
+            in_quotes = not in_quotes
+        elif not in_quotes and (c == ';' or line.startswith('//', i)):
+            return line[:i].strip()
+
+    return line.strip()
+
+
+def _split_lines(lines):
+    # dump() yields some blocks as a single multi-line string
+    for line in lines:
+        if '\n' in line:
+            for sub_line in line.split('\n'):
+                yield sub_line
+        else:
+            yield line
+
+
+def download_lines(lines):
+    '''
+    Configuration lines as the controller is to receive them: comments,
+    blank lines and #define lines are dropped, and the #define
+    substitutions (made host-side by PEWIN) are made in the lines
+    following each definition
+    '''
+    defines = {}
+    substitute = None
+    for line in _split_lines(lines):
+        line = strip_comment(line)
+        if not line:
+            continue
+
+        m = util.DEFINE_RE.match(line)
+        if m:
+            name, value = m.groups()
+            defines[name] = value.strip()
+            substitute = util.define_substitution(defines)
+            continue
+
+        if substitute is not None:
+            line = substitute(line).strip()
+
+        yield line
+
+
+_open_close_re = re.compile(r'^\s*(open|close)\b', flags=re.IGNORECASE)
+_open_plc_re = re.compile(r'^\s*open\s+plc\s*(\d+)\s*(clear)?',
+                          flags=re.IGNORECASE)
+
+
+def batch_lines(lines, max_length=MAX_LINE):
+    '''
+    Commands packing as many configuration lines as fit in max_length
+    characters, separated by spaces (see download_lines).  OPEN and CLOSE
+    lines, and the program lines in between, are sent one per command:
+    joined, block IF/WHILE statements would become single-line ones.
+    '''
+    batch = []
+    length = 0
+    in_program = False
+    for line in download_lines(lines):
+        m = _open_close_re.match(line)
+        alone = in_program or m is not None
+        if m is not None:
+            in_program = (m.group(1).lower() == 'open')
+
+        if batch and (alone or length + 1 + len(line) > max_length):
+            yield ' '.join(batch)
+            batch = []
+            length = 0
+
+        if alone:
+            yield line
+            continue
+
+        batch.append(line)
+        length += len(line) + (1 if length else 0)
+
+    if batch:
+        yield ' '.join(batch)
+
+
+def program_lines(lines):
+    '''
+    {PLC number: [lines]} of the PLC programs in configuration lines, as
+    downloaded (see download_lines)
+    '''
+    programs = {}
+    program = None
+    for line in download_lines(lines):
+        m = _open_close_re.match(line)
+        if m is None:
+            if program is not None:
+                program.append(line)
+        elif m.group(1).lower() == 'close':
+            program = None
+        else:
+            m = _open_plc_re.match(line)
+            if m is None:
+                # another kind of buffer
+                program = None
+                continue
+
+            number, clear = m.groups()
+            program = programs.setdefault(int(number), [])
+            if clear:
+                del program[:]
+
+    return programs
+
+
+class PmacClient(object):
+    '''
+    A connection to a Turbo PMAC over the Ethernet ASCII protocol
+
+    Commands are sent as GETRESPONSE packets.  pipeline() keeps up to
+    depth packets in flight, reading replies (which arrive in order) as
+    they come, so a round trip is paid per window rather than per command.
+    '''
+    def __init__(self, host, port=DEFAULT_PORT, timeout=DEFAULT_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self._buf = b''
+        self.connect()
+
+    def connect(self):
+        self.close()
+        self.sock = socket.create_connection((self.host, self.port),
+                                             timeout=self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._buf = b''
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _read_response(self):
+        while True:
+            ret = split_response(self._buf)
+            if ret is not None:
+                response, self._buf = ret
+                return response
+
+            data = self.sock.recv(65536)
+            if not data:
+                raise PmacError('Connection closed')
+            self._buf += data
+
+    def flush(self):
+        self.sock.sendall(make_packet(VR_PMAC_FLUSH))
+        self.sock.recv(1)
+
+    def send_receive(self, command):
+        '''
+        The reply lines of a single command; raises PmacError on errors
+        '''
+        ret = self.pipeline([command])[0]
+        if isinstance(ret, PmacError):
+            raise ret
+        return ret
+
+    def pipeline(self, commands, depth=DEFAULT_DEPTH):
+        '''
+        Reply lines of each command, in order, with up to depth commands
+        in flight.  Errors are returned as PmacError instances in place of
+        the reply lines.
+        '''
+        commands = list(commands)
+        packets = [make_packet(VR_PMAC_GETRESPONSE, cmd.encode('ascii'))
+                   for cmd in commands]
+
+        replies = []
+        sent = 0
+        while len(replies) < len(commands):
+            # keep the window full, sending as many packets at once as fit
+            window = min(len(commands), len(replies) + depth)
+            if sent < window:
+                self.sock.sendall(b''.join(packets[sent:window]))
+                sent = window
+
+            response = self._read_response()
+            replies.append(parse_response(response, commands[len(replies)]))
+
+        return replies
+
+    def download(self, lines, depth=DEFAULT_DEPTH, max_length=MAX_LINE):
+        '''
+        Send configuration lines (e.g., TpConfig.dump()), packed into as
+        few commands as possible.  Returns (commands sent, errors), errors
+        being PmacErrors for the failed commands.
+        '''
+        commands = list(batch_lines(lines, max_length=max_length))
+        replies = self.pipeline(commands, depth=depth)
+        errors = [reply for reply in replies if isinstance(reply, PmacError)]
+        return len(commands), errors
+
+    def get_vars(self, names, depth=DEFAULT_DEPTH, max_length=MAX_LINE):
+        '''
+        {name: reply} of variables (e.g., ['P1', 'I100']), queried several
+        per command
+        '''
+        names = list(names)
+        commands = list(batch_lines(names, max_length=max_length))
+
+        values = []
+        for reply in self.pipeline(commands, depth=depth):
+            if isinstance(reply, PmacError):
+                raise reply
+            values.extend(reply)
+
+        return dict(zip(names, values))
+
+
+class ConnectionPool(object):
+    '''
+    A small pool of PmacClients to one controller, created as needed up to
+    size connections
+
+    Commands sent through one connection are executed in order; query()
+    spreads independent commands (e.g., variable reads) over several
+    connections at once.
+    '''
+    def __init__(self, host, port=DEFAULT_PORT, size=4, **kwargs):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.kwargs = kwargs
+        self._idle = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _get(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+
+        if create:
+            try:
+                return PmacClient(self.host, self.port, **self.kwargs)
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        return self._idle.get()
+
+    @contextmanager
+    def connection(self):
+        client = self._get()
+        try:
+            yield client
+        except Exception:
+            # the connection may be out of sync; do not reuse it
+            client.close()
+            with self._lock:
+                self._created -= 1
+            raise
+        else:
+            self._idle.put(client)
+
+    def query(self, commands, depth=DEFAULT_DEPTH):
+        '''
+        Reply lines of independent commands, pipelined over up to size
+        connections in parallel; results are in the order of commands
+        '''
+        commands = list(commands)
+        chunk = max(1, -(-len(commands) // self.size))
+        chunks = [commands[i:i + chunk]
+                  for i in range(0, len(commands), chunk)]
+        results = [None] * len(chunks)
+        failures = []
+
+        def run(i):
+            try:
+                with self.connection() as client:
+                    results[i] = client.pipeline(chunks[i], depth=depth)
+            except Exception as ex:
+                failures.append(ex)
+
+        threads = [threading.Thread(target=run, args=(i, ))
+                   for i in range(len(chunks))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if failures:
+            raise failures[0]
+
+        return [reply for result in results for reply in result]
+
+    def close(self):
+        while True:
+            try:
+                client = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            client.close()
+            with self._lock:
+                self._created -= 1
+
+
+if __name__ == '__main__':
+    from .conf import TpConfig
+
+    opts = docopt(__doc__)
+
+    config = TpConfig(opts['INPUT_PMC'], verbose=bool(opts['--verbose']))
+    for line in config.format_diagnostics():
+        print(line, file=sys.stderr)
+    lines = list(config.dump())
+    if opts['--optimize']:
+        from .optimize import (optimize_config, format_stats)
+        commands, stats = optimize_config(config)
+        print(format_stats(stats))
+    else:
+        commands = lines
+
+    host, port = opts['--host'], int(opts['--port'])
+    server = None
+    if opts['--standin']:
+        from .standin import PmacStandIn
+        server = PmacStandIn()
+        server.serve_in_thread()
+        host, port = server.address
+
+    t0 = time.time()
+    with PmacClient(host, port) as client:
+        num_commands, errors = client.download(commands,
+                                               depth=int(opts['--depth']))
+    elapsed = time.time() - t0
+
+    for error in errors:
+        print(error, file=sys.stderr)
+
+    print('%d lines in %d commands, %.3fs (%.0f lines/s), %d errors' %
+          (len(lines), num_commands, elapsed, len(lines) / max(elapsed, 1e-9),
+           len(errors)))
+
+    if server is not None:
+        for number in server.mismatched_plcs(program_lines(lines)):
+            print('PLC %d was not received line for line' % number,
+                  file=sys.stderr)
+        server.shutdown()
@@ -7,19 +7,28 @@ line order, comments, etc.
 """
 
 from __future__ import print_function
+import os
 import re
+import marshal
+import multiprocessing
+from bisect import (bisect_left, bisect_right)
+from itertools import chain
 
-from . import (info, util)
+from . import (info, stats, util)
 from .util import VAR_TYPES
 
 
 MIN_COMMENT_COL = 10
 SPACES_PER_TAB = 4
+# bump whenever parsing changes the resulting block model
+MODEL_VERSION = 3
+# diagnostics kept per configuration; the rest are only counted
+MAX_DIAGNOSTICS = 100
 
 
 def format_comments(lines):
     lengths = [len(line) for line, comment in lines]
-    comment_col = max(lengths) + 2
+    comment_col = max(lengths or [0]) + 2
 
     if comment_col < MIN_COMMENT_COL:
         comment_col = MIN_COMMENT_COL
@@ -45,6 +54,44 @@ def format_comments(lines):
             last_line = line
 
 
+def format_comments_text(lines):
+    '''
+    format_comments(lines) as a single string, each line terminated by a
+    newline
+    '''
+    if not lines:
+        return ''
+
+    comment_col = max([len(line) for line, comment in lines]) + 2
+    if comment_col < MIN_COMMENT_COL:
+        comment_col = MIN_COMMENT_COL
+
+    out = []
+    append = out.append
+    for line, comment in lines:
+        if comment is not None:
+            if line.strip():
+                # lines are never longer than comment_col, so this pads
+                # exactly as format_comments does
+                line = '%-*s; %s' % (comment_col, line, comment)
+            elif comment:
+                # indented as the last non-empty line
+                last_line = ''
+                for last_line in reversed(out):
+                    if last_line:
+                        break
+
+                last_spaces = len(last_line) - len(last_line.lstrip())
+                line = '%s; %s' % (' ' * last_spaces, comment)
+            else:
+                line = ';'
+
+        append(line)
+
+    append('')
+    return '\n'.join(out)
+
+
 class TpBlock(object):
     def __init__(self, lines=None):
         if lines is not None:
@@ -52,6 +99,10 @@ class TpBlock(object):
         else:
             self.lines = []
 
+        # [(index in lines, TpVarRange)] of the range assignments among the
+        # lines
+        self.ranges = []
+
     def get_lines(self):
         for line in format_comments(self.lines):
             yield line
@@ -62,6 +113,10 @@ class TpBlock(object):
     def config_str(self, config=None):
         yield str(self)
 
+    def config_text(self, config=None):
+        # an empty block is still dumped as a single empty line
+        return format_comments_text(self.lines) or '\n'
+
 
 class TpCoord(object):
     def __init__(self, coord_sys, motor, axis, comment=None):
@@ -99,25 +154,45 @@ class TpCoordSys(object):
         for line in format_comments(lines):
             yield line
 
+    def config_text(self, config=None):
+        lines = [('%s' % coord, coord.comment)
+                 for num, coord in sorted(self.coords.items())]
+
+        return '&%d\n%s' % (self.coord_sys, format_comments_text(lines))
+
     def __str__(self):
         return '\n'.join(self.config_str())
 
 
 class TpVar(object):
+    __slots__ = ('type_', 'var', 'value', 'comment')
+
     def __init__(self, var, value, comment=None):
-        self.type_ = var[0].lower()
-        try:
-            var = int(var[1:])
-        except:
-            var = var[1:]
+        if isinstance(var, util.VarRef):
+            self.type_, var = var
+        else:
+            self.type_ = util.intern_str(var[0].lower())
+            try:
+                var = int(var[1:])
+            except:
+                var = var[1:]
 
-        self.var, self.value = var, value.strip()
-        self.comment = comment
+        self.var = var
+        self.value = util.intern_str(value.strip())
+        self.comment = util.intern_str(comment)
 
     @property
     def var_str(self):
         return '%s%s' % (self.type_, self.var)
 
+    @property
+    def ref(self):
+        '''
+        util.VarRef of the variable (ValueError if the number is not an
+        integer)
+        '''
+        return util.VarRef(self.type_, self.var)
+
     def config_str(self, config=None):
         if self.type_ == 'm':
             eq = '->'
@@ -130,22 +205,22 @@ class TpVar(object):
         return '\n'.join(self.config_str())
 
     def annotate(self):
-        value = self.value
-
         if self.type_ == 'm':
-            value = util.clean_addr(value)
-
             try:
-                desc = info.mem_info[value][0]
+                desc = info.mem_info[util.Address.parse(self.value)][0]
             except KeyError:
                 return
 
         elif self.type_ == 'i':
             try:
-                desc, category, page = info.ivar_info[self.var_str]
-            except KeyError:
+                desc, category, page = info.ivar_info[self.ref]
+            except (KeyError, ValueError):
                 return
 
+        else:
+            # only I-variables and memory addresses are documented
+            return
+
         if self.comment:
             if desc in self.comment:
                 pass
@@ -158,43 +233,289 @@ class TpVar(object):
     def page(self):
         if self.type_ == 'i':
             try:
-                desc, category, page = info.ivar_info[self.var_str]
-            except KeyError:
+                desc, category, page = info.ivar_info[self.ref]
+            except (KeyError, ValueError):
                 pass
             else:
                 return int(page)
 
 
+class TpVarRange(object):
+    '''
+    A range assignment, such as M0..8191->* or I100..199=0, which is kept as
+    a single object rather than expanded into individual variables
+
+    Its line stays in the unparsed block (TpBlock) it appears in, so that
+    it is dumped unchanged.
+    '''
+    __slots__ = ('type_', 'first', 'last', 'value', 'comment')
+
+    def __init__(self, type_, first, last, value, comment=None):
+        self.type_ = util.intern_str(type_.lower())
+        self.first = int(first)
+        self.last = int(last)
+        self.value = util.intern_str(value.strip())
+        self.comment = util.intern_str(comment)
+
+    @property
+    def var(self):
+        return self.first
+
+    @property
+    def var_str(self):
+        return '%s%d..%d' % (self.type_, self.first, self.last)
+
+    def __contains__(self, num):
+        return self.first <= num <= self.last
+
+    def __len__(self):
+        return self.last - self.first + 1
+
+    def __str__(self):
+        if self.type_ == 'm':
+            eq = '->'
+        else:
+            eq = '='
+
+        return '%s%d..%d%s%s' % (self.type_.upper(), self.first, self.last,
+                                 eq, self.value)
+
+    def config_str(self, config=None):
+        for line in format_comments([(str(self), self.comment)]):
+            yield line
+
+    def annotate(self):
+        # ranges cover many documented variables; leave the comment alone
+        pass
+
+    @property
+    def page(self):
+        return None
+
+
 class TpVars(object):
+    # variable numbers and their TpVars are kept sorted by variable number in
+    # chunks of parallel lists, found by bisecting the last number of each
+    # chunk and then the chunk itself.  Iteration walks the chunks in order,
+    # and inserting out of order only shifts a single chunk.  TpVarRanges
+    # are only used for lookups of variables that are not defined
+    # individually.
+    __slots__ = ('type_', '_maxes', '_key_chunks', '_var_chunks', '_len',
+                 '_ranges')
+
+    # chunks are split in half once they grow past twice this size
+    chunk_size = 512
+
     def __init__(self, type_):
         self.type_ = type_
         assert(type_ in VAR_TYPES)
-        self.items = {}
+        self._maxes = []
+        self._key_chunks = []
+        self._var_chunks = []
+        self._len = 0
+        self._ranges = None
+
+    def _locate(self, key):
+        # (chunk, index) where key is, or would be inserted
+        ci = bisect_left(self._maxes, key)
+        if ci == len(self._maxes):
+            return ci, 0
+
+        return ci, bisect_left(self._key_chunks[ci], key)
+
+    def _index(self, key):
+        ci, i = self._locate(key)
+        if ci < len(self._maxes) and self._key_chunks[ci][i] == key:
+            return ci, i
+
+        raise KeyError(key)
+
+    @property
+    def items(self):
+        return dict(zip(self.keys(), self._iter_vars()))
+
+    @property
+    def ranges(self):
+        return list(self._ranges or [])
+
+    @property
+    def range_count(self):
+        '''
+        The number of range assignments (not included in len())
+        '''
+        return len(self._ranges or [])
+
+    def keys(self):
+        return list(chain.from_iterable(self._key_chunks))
+
+    def __contains__(self, key):
+        return self.get(key) is not None
 
     def __getitem__(self, key):
-        return self.items[key]
+        try:
+            ci, i = self._index(key)
+        except KeyError:
+            # the last range assignment covering the variable
+            for var_range in reversed(self._ranges or []):
+                if key in var_range:
+                    return var_range
+            raise
+        else:
+            return self._var_chunks[ci][i]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def get_exact(self, key, default=None):
+        '''
+        The individually-defined variable key, ignoring ranges
+        '''
+        try:
+            ci, i = self._index(key)
+        except KeyError:
+            return default
+        else:
+            return self._var_chunks[ci][i]
+
+    def range(self, first, last):
+        '''
+        The individually-defined variables numbered first to last
+        (inclusive), in order
+        '''
+        key_chunks, var_chunks = self._key_chunks, self._var_chunks
+        ci, i = self._locate(first)
+        while ci < len(key_chunks):
+            keys = key_chunks[ci]
+            j = bisect_right(keys, last, i)
+            for tpvar in var_chunks[ci][i:j]:
+                yield tpvar
+
+            if j < len(keys):
+                break
+
+            ci += 1
+            i = 0
 
     def __setitem__(self, key, value):
-        self.items[key].value = value
+        self[key].value = util.intern_str(value)
+
+    def __delitem__(self, key):
+        ci, i = self._index(key)
+        keys = self._key_chunks[ci]
+        del keys[i]
+        del self._var_chunks[ci][i]
+        self._len -= 1
+
+        if not keys:
+            del self._key_chunks[ci]
+            del self._var_chunks[ci]
+            del self._maxes[ci]
+        elif i == len(keys):
+            self._maxes[ci] = keys[-1]
 
     def __len__(self):
-        return len(self.items.keys())
+        return self._len
+
+    def _iter_vars(self):
+        return chain.from_iterable(self._var_chunks)
 
     def __iter__(self):
-        for var, tpvar in sorted(self.items.items(), key=lambda (k, v): k):
+        if not self._ranges:
+            return self._iter_vars()
+
+        return self._iter_with_ranges()
+
+    def _iter_with_ranges(self):
+        # ranges are ordered by their first variable, before any variable
+        # of the same number
+        ranges = sorted(self._ranges, key=lambda var_range: var_range.first)
+        i = 0
+        for tpvar in self._iter_vars():
+            while i < len(ranges) and ranges[i].first <= tpvar.var:
+                yield ranges[i]
+                i += 1
+
             yield tpvar
 
+        for var_range in ranges[i:]:
+            yield var_range
+
     def config_str(self, config=None):
         lines = [('%s' % tpvar, tpvar.comment)
-                 for var, tpvar in sorted(self.items.items(), key=lambda (k, v): k)]
+                 for tpvar in self]
 
         for line in format_comments(lines):
             yield line
 
+    def config_text(self, config=None):
+        # as config_str, formatting variables directly rather than through
+        # TpVar.config_str
+        if self.type_ == 'm':
+            fmt = 'M%s->%s'
+        else:
+            fmt = '%s%%s=%%s' % self.type_.upper()
+
+        lines = []
+        append = lines.append
+        for tpvar in self:
+            if tpvar.__class__ is TpVar:
+                append((fmt % (tpvar.var, tpvar.value), tpvar.comment))
+            else:
+                append(('%s' % tpvar, tpvar.comment))
+
+        return format_comments_text(lines)
+
     def add_var(self, tpvar):
         assert(self.type_ == tpvar.type_)
 
-        self.items[tpvar.var] = tpvar
+        if isinstance(tpvar, TpVarRange):
+            return self.add_range(tpvar)
+
+        key = tpvar.var
+        maxes = self._maxes
+        if not maxes or key > maxes[-1]:
+            # in-order fast path
+            if maxes and len(self._key_chunks[-1]) < self.chunk_size:
+                self._key_chunks[-1].append(key)
+                self._var_chunks[-1].append(tpvar)
+                maxes[-1] = key
+            else:
+                self._key_chunks.append([key])
+                self._var_chunks.append([tpvar])
+                maxes.append(key)
+
+            self._len += 1
+            return
+
+        ci, i = self._locate(key)
+        keys, tpvars = self._key_chunks[ci], self._var_chunks[ci]
+        if keys[i] == key:
+            tpvars[i] = tpvar
+            return
+
+        keys.insert(i, key)
+        tpvars.insert(i, tpvar)
+        self._len += 1
+
+        if len(keys) > 2 * self.chunk_size:
+            half = len(keys) // 2
+            self._key_chunks[ci:ci + 1] = [keys[:half], keys[half:]]
+            self._var_chunks[ci:ci + 1] = [tpvars[:half], tpvars[half:]]
+            maxes[ci:ci + 1] = [keys[half - 1], keys[-1]]
+
+    def add_range(self, var_range):
+        assert(self.type_ == var_range.type_)
+
+        if self._ranges is None:
+            self._ranges = []
+
+        self._ranges.append(var_range)
+
+    def clear_ranges(self):
+        self._ranges = None
 
     def __str__(self):
         return '\n'.join(self.config_str())
@@ -218,15 +539,20 @@ class TpInclude(object):
 class TpPlcBlock(object):
     _ref_res = [re.compile('([pmqi]\([^\)]+\))', flags=re.IGNORECASE),
                 re.compile('([pmqi]\d+)', flags=re.IGNORECASE)]
+    # both of the above in one pass; the lookahead allows overlapping
+    # matches, so P(M1+1) gives both P(M1+1) and M1
+    ref_re = re.compile('(?=([pmqi](?:\([^\)]+\)|\d+)))', flags=re.IGNORECASE)
 
     def __init__(self, number, clear=True):
         self.number = int(number)
         self.clear = bool(clear)
 
         self.lines = []
+        self._refs = None
 
     def append(self, line, comment):
         self.lines.append((line, comment))
+        self._refs = None
 
     def reformat(self, start_indent=2, indent_amount=2):
         indent = start_indent
@@ -264,18 +590,32 @@ class TpPlcBlock(object):
 
         yield 'CLOSE'
 
+    def config_text(self, config=None):
+        return '%s\n%sCLOSE\n' % (next(self.config_str()),
+                                   format_comments_text(self.lines))
+
     def __iter__(self):
         for line, comment in self.lines:
             yield line, comment
 
+    def iter_references(self):
+        '''
+        (reference, line index) for each variable reference in the PLC,
+        e.g. ('P123', 0) or ('P(M1+1)', 3)
+        '''
+        findall = self.ref_re.findall
+        for i, (line, comment) in enumerate(self.lines):
+            for ref in findall(line):
+                yield ref, i
+
     def find_references(self):
-        refs = set()
-        for line, comment in self:
-            for ref_re in self._ref_res:
-                for ref in ref_re.findall(line):
-                    refs.add(ref)
+        # cached until lines are appended; reassigning self.lines also
+        # requires resetting self._refs
+        if self._refs is None:
+            refs = set(ref for ref, i in self.iter_references())
+            self._refs = list(sorted(refs))
 
-        return list(sorted(refs))
+        return list(self._refs)
 
     def __str__(self):
         return '\n'.join(self.config_str())
@@ -286,8 +626,31 @@ class TpConfig(object):
     coord_def_re = re.compile('^\s*#(\d+)->(.*)$', flags=re.IGNORECASE)
     plc_re = re.compile('^\s*open plc\s*(\d+)\s*(clear)?$', flags=re.IGNORECASE)
     var_re = re.compile('^\s*([pmqi]\d+)\s*(->|=)\s*(.*)$', flags=re.IGNORECASE)
+    var_range_re = re.compile('^\s*([pmqi])(\d+)\.\.(\d+)\s*(->|=)\s*(.*)$',
+                              flags=re.IGNORECASE)
     include_re = re.compile('^\s*#include\s*"?(.*)"?$', flags=re.IGNORECASE)
 
+    # all of the above in a single pattern, tried in the same order; the
+    # outer named group of the alternative that matched is m.lastgroup
+    line_re = re.compile(r"""^\s*(?:
+        (?P<var>(?P<var_name>[pmqi]\d+)\s*(?:->|=)\s*(?P<var_value>.*))
+      | (?P<var_range>(?P<range_type>[pmqi])(?P<range_first>\d+)\.\.
+                      (?P<range_last>\d+)\s*(?:->|=)\s*(?P<range_value>.*))
+      | (?P<coord>&(?P<coord_sys>\d+)(?P<coord_rest>.*))
+      | (?P<coord_def>\#(?P<motor>\d+)->(?P<axis>.*))
+      | (?P<plc>open\ plc\s*(?P<plc_num>\d+)\s*(?P<plc_clear>clear)?)
+      | (?P<include>\#include\s*"?(?P<include_fn>.*)"?)
+      )$""", flags=re.IGNORECASE | re.VERBOSE)
+
+    # first non-whitespace characters which line_re can possibly match
+    line_start_chars = frozenset('pmqiPMQI&#oO')
+
+    close_re = re.compile('^\s*close(?![a-z])', flags=re.IGNORECASE)
+
+    # code before the first semicolon that is not within quotes.  like the
+    # original character loop, either quote character toggles quoting
+    comment_re = re.compile(r"""^((?:[^;"']|["'][^"']*["'])*);(.*)$""")
+
     def __init__(self, fn='config/mc09.pmc', **load_opts):
         if fn:
             self.load_config(fn, **load_opts)
@@ -295,23 +658,31 @@ class TpConfig(object):
             self._clear()
 
     @staticmethod
-    def parse_lines(lines):
-        for i, line in enumerate(lines):
-            line = line.rstrip()
-            line = line.replace('\t', ' ' * SPACES_PER_TAB)
-            if ';' in line:
-                in_quotes = False
-                for i, c in enumerate(line):
-                    if c in ("'", '"'):
-                        in_quotes = not in_quotes
-                    elif c == ';' and not in_quotes:
-                        line, comment = line[:i], line[i + 1:]
-                        break
+    def split_comment(line):
+        if ';' not in line:
+            return line, None
 
-                comment = comment.strip()
-            else:
-                comment = None
+        code, sep, comment = line.partition(';')
+        if '"' in code or "'" in code:
+            m = TpConfig.comment_re.match(line)
+            if m is None:
+                # every semicolon is quoted
+                return line, None
+
+            code, comment = m.groups()
 
+        return code, comment.strip()
+
+    @staticmethod
+    def parse_lines(lines, start=0):
+        split_comment = TpConfig.split_comment
+        tab = ' ' * SPACES_PER_TAB
+        for i, line in enumerate(lines, start):
+            line = line.rstrip()
+            if '\t' in line:
+                line = line.replace('\t', tab)
+
+            line, comment = split_comment(line)
             yield i, line, comment
 
     def _clear(self):
@@ -322,17 +693,39 @@ class TpConfig(object):
         self.plcs = {}
         self._plc = None
         self._unparsed = []
+        # [(index in _unparsed, TpVarRange)]
+        self._unparsed_ranges = []
         self._var_block = None
         self.includes = []
 
         self.last_coord = 0
         self.blocks = []
+        # first line number of each block in self.blocks
+        self._block_starts = []
+        self._unparsed_start = None
+        # variable and plc keys defined more than once
+        self._redefined = set()
+        # [(line number, message)], at most MAX_DIAGNOSTICS (verbose only)
+        self.diagnostics = []
+        self.dropped_diagnostics = 0
+        self.unparsed_lines = 0
 
         self.variables = {}
         for var_type in VAR_TYPES:
             self.variables[var_type] = TpVars(var_type)
 
-    def load_config(self, fn, **kwargs):
+        self._handlers = {'var': self._matched_var,
+                          'var_range': self._matched_var_range,
+                          'coord': self._matched_coord,
+                          'coord_def': self._matched_coord_def,
+                          'plc': self._matched_plc,
+                          'include': self._matched_include,
+                          }
+
+    def load_config(self, fn, cache=None, **kwargs):
+        if cache is not None and not hasattr(fn, 'readlines'):
+            return cache.load_config(self, fn, **kwargs)
+
         self._clear()
 
         if hasattr(fn, 'readlines'):
@@ -342,11 +735,139 @@ class TpConfig(object):
 
         self.lines = [line.rstrip() for line in f.readlines()]
 
-        for line_num, line, comment in TpConfig.parse_lines(self.lines):
-            self._eval_line(line_num, line, comment, **kwargs)
+        stats_ = stats.current
+        if stats_ is None:
+            for line_num, line, comment in TpConfig.parse_lines(self.lines):
+                self._eval_line(line_num, line, comment, **kwargs)
+        else:
+            # parse up front, so that the two stages are timed separately
+            with stats_.stage('parse_lines'):
+                parsed = list(TpConfig.parse_lines(self.lines))
+
+            with stats_.stage('eval_line'):
+                for line_num, line, comment in parsed:
+                    self._eval_line(line_num, line, comment, **kwargs)
 
         self._unparsed_block()
 
+        if stats_ is not None:
+            self._count_stats(stats_)
+
+    def _count_stats(self, stats_):
+        stats_.count('files')
+        stats_.count('lines', len(self.lines))
+        stats_.count('blocks', len(self.blocks))
+        stats_.count('plcs', len(self.plcs))
+        stats_.count('unparsed_lines', self.unparsed_lines)
+
+    def get_model(self):
+        '''
+        The block model of the configuration as plain tuples, lists and
+        strings (suitable for marshal)
+        '''
+        blocks = []
+        for block in self.blocks:
+            if isinstance(block, TpVars):
+                blocks.append(('v', block.type_,
+                               [(tpvar.var, tpvar.value, tpvar.comment)
+                                for tpvar in block]))
+            elif isinstance(block, TpCoordSys):
+                blocks.append(('c', block.coord_sys,
+                               [(coord.motor, coord.axis, coord.comment)
+                                for num, coord in sorted(block.coords.items())]))
+            elif isinstance(block, TpPlcBlock):
+                blocks.append(('p', block.number, block.clear, block.lines))
+            elif isinstance(block, TpInclude):
+                blocks.append(('i', block.fn, block.comment))
+            else:
+                blocks.append(('b', block.lines,
+                               [(index, var_range.type_, var_range.first,
+                                 var_range.last, var_range.value,
+                                 var_range.comment)
+                                for index, var_range in block.ranges]))
+
+        return (MODEL_VERSION, self.lines, self._block_starts, blocks)
+
+    def set_model(self, model, verbose=False):
+        '''
+        Load a block model from get_model(), without evaluating any lines
+
+        Unparsed lines are counted (and with verbose, reported in
+        diagnostics) as when loading the configuration itself.
+        '''
+        self._clear()
+
+        version, lines, starts, blocks = model
+        if version != MODEL_VERSION:
+            raise ValueError('Unsupported model version: %s' % version)
+
+        self.lines = list(lines)
+        self._block_starts = list(starts)
+
+        intern_str = util.intern_str
+        for block, start in zip(blocks, starts):
+            kind = block[0]
+            if kind == 'v':
+                type_, items = block[1:]
+                new_block = TpVars(type_)
+                variables = self.variables[type_]
+                for var, value, comment in items:
+                    tpvar = TpVar.__new__(TpVar)
+                    tpvar.type_ = type_
+                    tpvar.var = var
+                    tpvar.value = intern_str(value)
+                    tpvar.comment = intern_str(comment)
+                    new_block.add_var(tpvar)
+
+                    if variables.get_exact(var) is not None:
+                        self._redefined.add((type_, var))
+                    variables.add_var(tpvar)
+
+            elif kind == 'c':
+                coord_sys, coords = block[1:]
+                new_block = TpCoordSys(coord_sys)
+                for motor, axis, comment in coords:
+                    new_block.set(motor, TpCoord(coord_sys, motor, axis,
+                                                 comment))
+
+                self.last_coord = coord_sys
+
+            elif kind == 'p':
+                number, clear, plc_lines = block[1:]
+                new_block = TpPlcBlock(number, clear=clear)
+                new_block.lines = [tuple(line) for line in plc_lines]
+                if number in self.plcs:
+                    self._redefined.add(('plc', number))
+                self.plcs[number] = new_block
+
+            elif kind == 'i':
+                fn, comment = block[1:]
+                new_block = TpInclude(fn, comment)
+                self.includes.append(new_block)
+
+            else:
+                new_block = TpBlock([tuple(line) for line in block[1]])
+                for range_ in block[2]:
+                    var_range = TpVarRange(*range_[1:])
+                    new_block.ranges.append((range_[0], var_range))
+                    self.variables[var_range.type_].add_range(var_range)
+
+                self._model_unparsed(new_block, start, verbose)
+
+            self.blocks.append(new_block)
+
+        if stats.current is not None:
+            self._count_stats(stats.current)
+
+    def _model_unparsed(self, block, start, verbose):
+        # the lines of an unparsed block are consecutive, from its start
+        range_lines = set(index for index, var_range in block.ranges)
+        for index, (line, comment) in enumerate(block.lines):
+            if line and index not in range_lines:
+                self.unparsed_lines += 1
+                if verbose:
+                    self._diagnostic(start + index, 'unparsed: %s' % line)
+
     def dump(self, reformat=False, reformat_kw={}):
         for block in self.blocks:
             if hasattr(block, 'reformat') and reformat:
@@ -358,32 +879,90 @@ class TpConfig(object):
             for line in block.config_str(self):
                 yield line
 
+    def write(self, fileobj, reformat=False, reformat_kw={},
+              buffer_size=65536):
+        '''
+        Write the configuration to a file object, with the same output as
+        printing each line of dump().  Blocks are formatted whole and
+        written in chunks of about buffer_size characters.
+        '''
+        chunks = []
+        size = 0
+        for block in self.blocks:
+            if hasattr(block, 'reformat') and reformat:
+                block.reformat(**reformat_kw)
+
+            if hasattr(block, 'coord_sys'):
+                self.last_coord = block.coord_sys
+
+            if hasattr(block, 'config_text'):
+                text = block.config_text(self)
+            else:
+                text = ''.join('%s\n' % line for line in block.config_str(self))
+
+            chunks.append(text)
+            size += len(text)
+            if size >= buffer_size:
+                fileobj.write(''.join(chunks))
+                chunks = []
+                size = 0
+
+        if chunks:
+            fileobj.write(''.join(chunks))
+
+    def _add_block(self, block, line_num):
+        self.blocks.append(block)
+        self._block_starts.append(line_num)
+
     def _unparsed_block(self):
         if self._unparsed:
-            self.blocks.append(TpBlock(self._unparsed))
+            block = TpBlock(self._unparsed)
+            block.ranges = self._unparsed_ranges
+            self._add_block(block, self._unparsed_start)
             self._unparsed = []
+            self._unparsed_ranges = []
 
     @property
     def last_block(self):
-        return self.blocks[-1]
+        if self.blocks:
+            return self.blocks[-1]
 
     def _matched_var(self, m, line_num, line, comment, eval_kwargs):
-        var, eq, value = m.groups()
+        var, value = m.group('var_name', 'var_value')
         tpvar = TpVar(var, value.strip(), comment)
 
-        last_block = self.blocks[-1]
+        last_block = self.last_block
         if isinstance(last_block, TpVars) and last_block.type_ == tpvar.type_:
             last_block.add_var(tpvar)
         else:
             new_block = TpVars(tpvar.type_)
             new_block.add_var(tpvar)
 
-            self.blocks.append(new_block)
+            self._add_block(new_block, line_num)
+
+        variables = self.variables[tpvar.type_]
+        if variables.get_exact(tpvar.var) is not None:
+            self._redefined.add((tpvar.type_, tpvar.var))
+
+        variables.add_var(tpvar)
 
-        self.variables[tpvar.type_].add_var(tpvar)
+    def _matched_var_range(self, m, line_num, line, comment, eval_kwargs):
+        type_, first, last, value = m.group('range_type', 'range_first',
+                                            'range_last', 'range_value')
+        var_range = TpVarRange(type_, first, last, value, comment)
+
+        # the line is kept in the unparsed block around it, and formatted
+        # with it
+        if not self._unparsed:
+            self._unparsed_start = line_num
+
+        self._unparsed_ranges.append((len(self._unparsed), var_range))
+        self._unparsed.append((line, comment))
+        self.variables[var_range.type_].add_range(var_range)
 
     def _matched_coord(self, m, line_num, line, comment, eval_kwargs):
-        coord_sys = int(m.groups()[0])
+        coord_sys, rest = m.group('coord_sys', 'coord_rest')
+        coord_sys = int(coord_sys)
 
         self.last_coord = coord_sys
 
@@ -392,13 +971,13 @@ class TpConfig(object):
             # two &1's in a row, for example
             pass
         else:
-            self.blocks.append(TpCoordSys(coord_sys))
+            self._add_block(TpCoordSys(coord_sys), line_num)
 
-        if m.groups()[1]:
-            self._eval_line(line_num, m.groups()[1], comment, **eval_kwargs)
+        if rest:
+            self._eval_line(line_num, rest, comment, **eval_kwargs)
 
     def _matched_coord_def(self, m, line_num, line, comment, eval_kwargs):
-        motor, axis = m.groups()
+        motor, axis = m.group('motor', 'axis')
         motor = int(motor)
 
         last_block = self.last_block
@@ -406,65 +985,674 @@ class TpConfig(object):
             coord_sys = last_block
         else:
             coord_sys = TpCoordSys(self.last_coord)
-            self.blocks.append(coord_sys)
+            self._add_block(coord_sys, line_num)
 
         coord = TpCoord(coord_sys.coord_sys, motor, axis, comment)
         coord_sys.set(motor, coord)
 
     def _matched_plc(self, m, line_num, line, comment, eval_kwargs):
-        number, clear = m.groups()
+        number, clear = m.group('plc_num', 'plc_clear')
         number = int(number)
         clear = clear is not None and clear.lower() == 'clear'
+        if number in self.plcs:
+            self._redefined.add(('plc', number))
+
         self.plcs[number] = self._plc = TpPlcBlock(number, clear=clear)
-        self.blocks.append(self._plc)
+        self._add_block(self._plc, line_num)
 
     def _matched_include(self, m, line_num, line, comment, eval_kwargs):
-        fn, = m.groups()
+        fn = m.group('include_fn')
         include = TpInclude(fn, comment)
         self.includes.append(include)
-        self.blocks.append(include)
+        self._add_block(include, line_num)
 
     def remove_block(self, block):
         #  TODO - track parents for easy removal
-        self.blocks.remove(block)
+        i = self.blocks.index(block)
+        del self.blocks[i]
+        del self._block_starts[i]
 
-    def _eval_line(self, line_num, line, comment, verbose=True):
-        line_lower = line.lower().strip()
+    @staticmethod
+    def _block_key(block):
+        # blocks with equal keys are treated identically by the _matched_*
+        # methods when deciding whether to extend the last block
+        if isinstance(block, TpVars):
+            return (TpVars, block.type_)
+        elif isinstance(block, TpCoordSys):
+            return (TpCoordSys, block.coord_sys)
+        elif block is None:
+            return None
+        else:
+            return (type(block), )
+
+    def update_lines(self, start, end, text, **kwargs):
+        '''
+        Replace lines [start, end) with text (a string or a list of lines),
+        re-evaluating only the blocks affected by the change
+
+        self.variables, self.plcs and self.includes are updated in place.
+        Returns the list of newly evaluated blocks.
+        '''
+        if isinstance(text, basestring):
+            text = text.splitlines()
+
+        new_lines = [line.rstrip() for line in text]
+        delta = len(new_lines) - (end - start)
+
+        starts = self._block_starts
+        blocks = self.blocks
+
+        # restart evaluation at the block before the first one touched, as
+        # new lines may extend it.  several blocks can start on one line.
+        first = bisect_right(starts, start) - 1
+        if first >= 0:
+            first = bisect_left(starts, starts[first])
+        if first > 0:
+            first = bisect_left(starts, starts[first - 1])
+
+        first = max(first, 0)
+        if first < len(starts):
+            restart = min(starts[first], start)
+        else:
+            restart = start
+
+        prev_block = blocks[first - 1] if first > 0 else None
+        old_blocks = blocks[first:]
+        old_starts = starts[first:]
+        del blocks[first:]
+        del starts[first:]
+
+        self.lines[start:end] = new_lines
+        self._plc = None
+        self._unparsed = []
+        self._unparsed_ranges = []
+        self._unparsed_start = None
+        self.last_coord = 0
+        for block in reversed(blocks):
+            if isinstance(block, TpCoordSys):
+                self.last_coord = block.coord_sys
+                break
+
+        # old blocks are forgotten as evaluation passes them, and reused from
+        # the first block boundary past the edit where the parser is in the
+        # same state as it was originally
+        old_coord = self.last_coord
+        forgotten = 0
+        resume = len(old_blocks)
+        edit_end = start + len(new_lines)
+        lines = self.lines
+        for line_num in range(restart, len(lines)):
+            if line_num < start:
+                old_line_num = line_num
+            elif line_num < edit_end:
+                old_line_num = end - 1
+            else:
+                old_line_num = line_num - delta
+                boundary = bisect_left(old_starts, old_line_num)
+                while forgotten < boundary:
+                    old_coord = self._forget_block(old_blocks[forgotten],
+                                                   old_coord)
+                    forgotten += 1
+
+                if (boundary < len(old_starts) and
+                        old_starts[boundary] == old_line_num and
+                        self._can_resume(old_blocks, boundary, prev_block,
+                                         old_coord)):
+                    resume = boundary
+                    break
+
+            while (forgotten < len(old_blocks) and
+                   old_starts[forgotten] <= old_line_num):
+                old_coord = self._forget_block(old_blocks[forgotten], old_coord)
+                forgotten += 1
+
+            for i, line, comment in self.parse_lines([lines[line_num]],
+                                                     start=line_num):
+                self._eval_line(i, line, comment, **kwargs)
+
+        for block in old_blocks[forgotten:resume]:
+            self._forget_block(block, old_coord)
+
+        self._unparsed_block()
+        new_blocks = blocks[first:]
+
+        blocks.extend(old_blocks[resume:])
+        starts.extend(start_ + delta for start_ in old_starts[resume:])
+
+        self._resolve_blocks(old_blocks[:resume], new_blocks)
+        return new_blocks
+
+    def _can_resume(self, old_blocks, boundary, prev_block, old_coord):
+        if self._plc is not None or self.last_coord != old_coord:
+            return False
 
-        eval_kwargs = dict(verbose=verbose)
+        if self._unparsed:
+            if isinstance(old_blocks[boundary], TpBlock):
+                # the pending unparsed lines would be extended
+                return False
+
+            # the next (matched) line would flush these
+            self._unparsed_block()
+
+        if boundary > 0:
+            old_prev = old_blocks[boundary - 1]
+        else:
+            old_prev = prev_block
+
+        return self._block_key(self.last_block) == self._block_key(old_prev)
+
+    def _forget_block(self, block, last_coord):
+        # remove an old block's definitions, returning the coordinate system
+        # in effect after it
+        if isinstance(block, TpVars):
+            variables = self.variables[block.type_]
+            for tpvar in block:
+                if variables.get(tpvar.var) is tpvar:
+                    del variables[tpvar.var]
+
+        elif isinstance(block, TpPlcBlock):
+            if self.plcs.get(block.number) is block:
+                del self.plcs[block.number]
+
+        elif isinstance(block, TpCoordSys):
+            return block.coord_sys
+
+        return last_coord
+
+    def _resolve_blocks(self, removed, added):
+        # pick the last definition of any variable or plc which was defined
+        # more than once and touched by the update
+        redefined = self._redefined
+        pending = {}
+        for block in removed + added:
+            if isinstance(block, TpVars):
+                for tpvar in block:
+                    if (block.type_, tpvar.var) in redefined:
+                        pending.setdefault(block.type_, set()).add(tpvar.var)
+
+            elif isinstance(block, TpPlcBlock):
+                if ('plc', block.number) in redefined:
+                    pending.setdefault('plc', set()).add(block.number)
+
+        if pending:
+            self._resolve_redefined(pending)
+
+        if any(isinstance(block, TpBlock) and block.ranges
+               for block in removed + added):
+            self._update_ranges()
+
+        removed_includes = [block for block in removed
+                            if isinstance(block, TpInclude)]
+        added_includes = [block for block in added
+                          if isinstance(block, TpInclude)]
+        if removed_includes or added_includes:
+            self._update_includes(removed_includes, added_includes)
+
+    def _resolve_redefined(self, pending):
+        # pending: {var type or 'plc': set of numbers}. walk back from the
+        # end, stopping once the last definition of each has been found
+        for block in reversed(self.blocks):
+            if isinstance(block, TpVars):
+                keys = pending.get(block.type_)
+                if not keys:
+                    continue
+
+                if len(keys) < len(block):
+                    found = [key for key in keys if key in block]
+                else:
+                    found = [key for key in block.keys() if key in keys]
+
+                for key in found:
+                    self.variables[block.type_].add_var(block[key])
+                    keys.remove(key)
+
+            elif isinstance(block, TpPlcBlock):
+                keys = pending.get('plc')
+                if keys and block.number in keys:
+                    self.plcs[block.number] = block
+                    keys.remove(block.number)
+
+            else:
+                continue
+
+            if not any(pending.values()):
+                return
+
+        # no definitions left
+        for type_, keys in pending.items():
+            if type_ == 'plc':
+                defs = self.plcs
+            else:
+                defs = self.variables[type_]
 
+            for key in keys:
+                self._redefined.discard((type_, key))
+                if type_ == 'plc':
+                    defs.pop(key, None)
+                elif defs.get_exact(key) is not None:
+                    del defs[key]
+
+    def _update_ranges(self):
+        # ranges are few; rebuild them to keep their order of definition
+        for variables in self.variables.values():
+            variables.clear_ranges()
+
+        for block in self.blocks:
+            if isinstance(block, TpBlock):
+                for index, var_range in block.ranges:
+                    self.variables[var_range.type_].add_range(var_range)
+
+    def _update_includes(self, removed, added):
+        # removed includes are contiguous in self.includes, and added ones
+        # were appended to it during evaluation
+        includes = self.includes
+        if added:
+            del includes[-len(added):]
+
+        if removed:
+            index = includes.index(removed[0])
+        else:
+            index = 0
+            first_added = self.blocks.index(added[0])
+            for block in reversed(self.blocks[:first_added]):
+                if isinstance(block, TpInclude):
+                    index = includes.index(block) + 1
+                    break
+
+        includes[index:index + len(removed)] = added
+
+    def _eval_line(self, line_num, line, comment, verbose=True):
         if self._plc:
-            if util.get_first_word(line_lower) == 'close':
+            if self.close_re.match(line):
                 self._plc = None
             else:
                 self._plc.append(line, comment)
+            return
+
+        stripped = line.strip()
+        if stripped and stripped[0] in self.line_start_chars:
+            m = self.line_re.match(line.rstrip())
+            if m:
+                if stats.current is not None:
+                    stats.current.hit(m.lastgroup)
+                if m.lastgroup != 'var_range':
+                    self._unparsed_block()
+                eval_kwargs = dict(verbose=verbose)
+                return self._handlers[m.lastgroup](m, line_num, line, comment,
+                                                   eval_kwargs)
+
+        line_lower = stripped.lower()
+        if line_lower == 'undefine':
+            self.coords.remove(self.coord)
+            self.coord = None
+
+        elif line_lower == 'undefine all':
+            self.coords = []
+            self.coord = None
+
+        if line:
+            self.unparsed_lines += 1
+            if verbose:
+                self._diagnostic(line_num, 'unparsed: %s' % line)
+
+        if not self._unparsed:
+            self._unparsed_start = line_num
 
+        self._unparsed.append((line, comment))
+
+    def _diagnostic(self, line_num, message):
+        if len(self.diagnostics) < MAX_DIAGNOSTICS:
+            self.diagnostics.append((line_num, message))
         else:
-            matches = [(self.var_re, self._matched_var),
-                       (self.coord_re, self._matched_coord),
-                       (self.coord_def_re, self._matched_coord_def),
-                       (self.plc_re, self._matched_plc),
-                       (self.include_re, self._matched_include),
-                       ]
-
-            for regex, fcn in matches:
-                m = regex.match(line.rstrip())
-                if m:
-                    self._unparsed_block()
-                    return fcn(m, line_num, line, comment, eval_kwargs)
+            self.dropped_diagnostics += 1
+
+    def format_diagnostics(self):
+        '''
+        Report lines of the diagnostics collected while evaluating lines
+        '''
+        for line_num, message in self.diagnostics:
+            yield '* [Line %d] %s' % (line_num, message)
+
+        if self.dropped_diagnostics:
+            yield '* (%d more not shown)' % self.dropped_diagnostics
+
+
+def _load_model(args):
+    fn, load_opts = args
+    return marshal.dumps(TpConfig(fn, **load_opts).get_model())
+
+
+def load_many(fns, workers=None, **load_opts):
+    '''
+    Load several configuration files in a pool of worker processes,
+    returning TpConfigs in the same order as fns
+
+    Parsed configurations are passed back from the workers as marshalled
+    block models (see TpConfig.get_model).  workers defaults to the number
+    of CPUs; with one worker (or one file) everything is loaded in-process.
+    load_opts are passed to TpConfig.
+    '''
+    fns = list(fns)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    workers = min(workers, len(fns))
+    if workers <= 1:
+        return [TpConfig(fn, **load_opts) for fn in fns]
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        models = pool.map(_load_model, [(fn, load_opts) for fn in fns],
+                          chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    configs = []
+    for model in models:
+        config = TpConfig(None)
+        config.set_model(marshal.loads(model),
+                         verbose=load_opts.get('verbose', True))
+        configs.append(config)
+
+    return configs
+
+
+def resolve_include(fn, including_fn=None, search_path=()):
+    '''
+    Find an included file: relative to the including file's directory, then
+    in each of search_path, then relative to the current directory.
+    Returns a normalized absolute path, or None if not found.
+    '''
+    if os.path.isabs(fn):
+        candidates = [fn]
+    else:
+        dirs = list(search_path) + ['']
+        if including_fn is not None:
+            dirs.insert(0, os.path.dirname(os.path.abspath(including_fn)))
+
+        candidates = [os.path.join(dir_, fn) for dir_ in dirs]
+
+    for candidate in candidates:
+        if os.path.isfile(candidate):
+            return os.path.normpath(os.path.abspath(candidate))
+
+    return None
+
+
+def ref_key(ref):
+    '''
+    Normalized form of a variable reference: upper case, no whitespace,
+    no leading zeros, with constant indices folded (P(123) -> P123)
+    '''
+    ref = ''.join(ref.split()).upper()
+    type_, rest = ref[0], ref[1:]
+    if rest.startswith('(') and rest.endswith(')') and rest[1:-1].isdigit():
+        rest = rest[1:-1]
+    if rest.isdigit():
+        rest = str(int(rest))
+    return type_ + rest
+
+
+class TpRefIndex(object):
+    '''
+    Reverse index of PLC variable references across configurations:
+    {reference: [(file name, PLC number, line number)]}
+
+    References are keyed by ref_key(), so 'p123', 'P0123' and 'P(123)'
+    are equivalent queries; expression references like P(M1+1) are indexed
+    under the whole expression and, separately, each variable within it.
+    Line numbers are those of the configuration file (0-based, as in the
+    rest of TpConfig).
+    '''
+    def __init__(self):
+        # {key: {(fn, plc number): [line numbers]}}
+        self._refs = {}
+        # {(fn, plc number): (plc block, first line, keys)}
+        self._plcs = {}
+
+    def __len__(self):
+        return len(self._refs)
+
+    def __contains__(self, ref):
+        return ref_key(ref) in self._refs
+
+    def keys(self):
+        return self._refs.keys()
+
+    def references(self, ref):
+        '''
+        [(file name, PLC number, line number)] for a variable reference
+        '''
+        plcs = self._refs.get(ref_key(ref))
+        if not plcs:
+            return []
+
+        return [(fn, number, line_num)
+                for (fn, number), lines in sorted(plcs.items())
+                for line_num in lines]
+
+    __getitem__ = references
+
+    def plcs(self, ref):
+        '''
+        [(file name, PLC number)] of PLCs referencing a variable
+        '''
+        return sorted(self._refs.get(ref_key(ref), {}).keys())
+
+    def add_plc(self, fn, plc, start=0):
+        '''
+        Index a TpPlcBlock whose OPEN PLC line is start, replacing any
+        previously indexed PLC with the same number in fn
+        '''
+        plc_key = (fn, plc.number)
+        self.remove_plc(fn, plc.number)
+
+        refs = self._refs
+        keys = set()
+        for ref, i in plc.iter_references():
+            key = ref_key(ref)
+            keys.add(key)
+            lines = refs.setdefault(key, {}).setdefault(plc_key, [])
+            lines.append(start + 1 + i)
+
+        self._plcs[plc_key] = (plc, start, keys)
+
+    def remove_plc(self, fn, number):
+        plc_key = (fn, number)
+        try:
+            plc, start, keys = self._plcs.pop(plc_key)
+        except KeyError:
+            return
+
+        for key in keys:
+            plcs = self._refs[key]
+            del plcs[plc_key]
+            if not plcs:
+                del self._refs[key]
+
+    def add_config(self, fn, config):
+        '''
+        Index (or re-index) the PLCs of a TpConfig.  Only PLCs that were
+        added, replaced or moved since the last call are re-scanned, so
+        this is cheap after TpConfig.update_lines.
+        '''
+        current = {}
+        for start, block in zip(config._block_starts, config.blocks):
+            if not isinstance(block, TpPlcBlock):
+                continue
+
+            # only the last definition of a PLC number is in effect
+            if config.plcs.get(block.number) is block:
+                current[block.number] = (block, start)
+
+        for (plc_fn, number) in list(self._plcs.keys()):
+            if plc_fn == fn and number not in current:
+                self.remove_plc(fn, number)
+
+        for number, (block, start) in current.items():
+            indexed = self._plcs.get((fn, number))
+            if indexed is None or indexed[0] is not block or indexed[1] != start:
+                self.add_plc(fn, block, start)
+
+    update_config = add_config
+
+    def remove_config(self, fn):
+        for (plc_fn, number) in list(self._plcs.keys()):
+            if plc_fn == fn:
+                self.remove_plc(fn, number)
+
+
+class IncludeCycleError(Exception):
+    pass
+
+
+class TpIncludeGraph(object):
+    '''
+    The graph of files reachable through #include from one or more root
+    files.  Each unique file is parsed once (a level of includes at a time,
+    with load_many), no matter how many times it is included.
+
+    Attributes:
+        roots: the root file paths
+        edges: {path: [(line number, include fn, resolved path or None)]}
+        cycles: lists of paths, each beginning and ending with the same file
+        missing: [(including path, line number, include fn)]
+        configs: {path: TpConfig}, only populated with keep_configs=True
+    '''
+    def __init__(self, fns, search_path=(), keep_configs=False, workers=None,
+                 **load_opts):
+        self.search_path = list(search_path)
+        self.roots = []
+        self.edges = {}
+        self.cycles = []
+        self.missing = []
+        self.configs = {}
+
+        for fn in fns:
+            path = resolve_include(fn, search_path=self.search_path)
+            if path is None:
+                raise IOError('File not found: %s' % fn)
+            self.roots.append(path)
+
+        self._load(keep_configs, workers, load_opts)
+        self._find_cycles()
+
+    def _load(self, keep_configs, workers, load_opts):
+        pending = list(self.roots)
+        while pending:
+            paths = []
+            for path in pending:
+                if path not in self.edges and path not in paths:
+                    paths.append(path)
+
+            pending = []
+            configs = load_many(paths, workers=workers, **load_opts)
+            for path, config in zip(paths, configs):
+                edges = self.edges[path] = []
+                for line_num, block in zip(config._block_starts, config.blocks):
+                    if not isinstance(block, TpInclude):
+                        continue
+
+                    include_path = resolve_include(block.fn, path,
+                                                   self.search_path)
+                    edges.append((line_num, block.fn, include_path))
+                    if include_path is None:
+                        self.missing.append((path, line_num, block.fn))
+                    else:
+                        pending.append(include_path)
+
+                if keep_configs:
+                    self.configs[path] = config
+
+    def _find_cycles(self):
+        # iterative depth-first search; a cycle is an edge back to a file
+        # still on the stack
+        done = set()
+        for root in self.roots:
+            if root in done:
+                continue
+
+            stack = [root]
+            on_stack = set(stack)
+            children = [self.includes(root)]
+            while stack:
+                try:
+                    child = next(children[-1])
+                except StopIteration:
+                    path = stack.pop()
+                    children.pop()
+                    on_stack.discard(path)
+                    done.add(path)
+                    continue
+
+                if child in on_stack:
+                    self.cycles.append(stack[stack.index(child):] + [child])
+                elif child not in done:
+                    stack.append(child)
+                    on_stack.add(child)
+                    children.append(self.includes(child))
+
+    def includes(self, path):
+        '''
+        Resolved paths of the files included by path, in order
+        '''
+        for line_num, fn, include_path in self.edges.get(path, []):
+            if include_path is not None:
+                yield include_path
+
+    def __iter__(self):
+        '''
+        All unique files in the graph
+        '''
+        return iter(self.edges)
+
+    def flatten(self, root=None, once=False):
+        '''
+        Yield the lines of root (the first root by default) with includes
+        replaced by the contents of the included files.  Files are read
+        line by line as they are reached, so only one line per level of
+        nesting is held in memory.
+
+        Each #include line is kept as a comment.  With once=True, files
+        already output are not repeated.  Raises IncludeCycleError if an
+        include cycle is reached.
+        '''
+        if root is None:
+            root = self.roots[0]
+        else:
+            root = resolve_include(root, search_path=self.search_path)
+
+        return self._flatten(root, [], set() if once else None)
+
+    def _flatten(self, path, stack, output):
+        if path in stack:
+            raise IncludeCycleError(' -> '.join(stack[stack.index(path):] +
+                                                [path]))
+
+        if output is not None:
+            output.add(path)
+
+        stack.append(path)
+        edges = dict((line_num, include_path)
+                     for line_num, fn, include_path in self.edges[path])
 
-            if line_lower == 'undefine':
-                self.coords.remove(self.coord)
-                self.coord = None
+        with open(path, 'rt') as f:
+            for line_num, line in enumerate(f):
+                line = line.rstrip('\r\n')
+                include_path = edges.get(line_num)
+                if include_path is None:
+                    yield line
+                    continue
 
-            elif line_lower == 'undefine all':
-                self.coords = []
-                self.coord = None
+                yield '; %s' % line.strip()
+                if output is not None and include_path in output:
+                    continue
 
-            if verbose and line:
-                print('* [Line %d] unparsed: %s' % (line_num, line))
+                for line in self._flatten(include_path, stack, output):
+                    yield line
 
-            self._unparsed.append((line, comment))
+        stack.pop()
 
 
 if __name__ == '__main__':
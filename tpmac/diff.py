@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# vi: ts=4 sw=4
+"""
+Usage: tpmac.diff [-cpfv] [--include=DIR...] OLD_PMC NEW_PMC
+
+Compares the variables, coordinate system definitions and PLCs of two Turbo
+PMAC configuration files, regardless of their order, indentation and
+comment alignment
+
+Arguments:
+    OLD_PMC            the original PMC file
+    NEW_PMC            the PMC file to compare against it
+
+Options:
+    -c --comments      also report variables whose comments changed
+    -p --plc-lines     show the changed lines of each changed PLC
+    -f --follow-includes  compare the files with everything they include
+    -I --include=DIR   additional directory to search for included files
+    -v --verbose       verbose mode
+"""
+
+from __future__ import print_function
+import sys
+import difflib
+import hashlib
+import marshal
+from collections import namedtuple
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from docopt import docopt
+
+from .conf import (TpConfig, TpCoordSys, TpVarRange, TpIncludeGraph)
+
+
+# variables are hashed in buckets of 2**BUCKET_BITS consecutive numbers
+BUCKET_BITS = 8
+
+# kind is one of 'added', 'removed', 'changed';
+# category is one of 'variable', 'coord', 'plc'
+Change = namedtuple('Change', ['kind', 'category', 'key', 'old', 'new'])
+
+
+def _normalize_value(value):
+    return ''.join(value.split()).upper()
+
+
+def _digest(obj):
+    # content digest of nested tuples of strings, numbers and None: unlike
+    # hash(), collisions are not a practical concern, so equal digests can
+    # stand for equal contents
+    return hashlib.sha1(marshal.dumps(obj)).digest()
+
+
+def plc_code(plc):
+    '''
+    The normalized code lines of a PLC: stripped, lowercase, single-spaced,
+    without comments or blank lines
+    '''
+    return tuple(' '.join(line.split()).lower()
+                 for line, comment in plc if line.strip())
+
+
+class ConfigSummary(object):
+    '''
+    The effective definitions of a TpConfig with a tree of content digests
+    (SHA-1): variables hash into buckets of consecutive numbers, buckets
+    and PLC bodies hash into a single root.  Subtrees with equal digests
+    are skipped when diffing.
+
+    Attributes:
+        buckets: {(type, bucket): (hash, {key: entry})}
+        coords: {(coord sys, motor): axis}
+        plcs: {number: (hash, TpPlcBlock)}
+        root: hash of all of the above
+    '''
+    def __init__(self, config, comments=False):
+        self.comments = comments
+        self.buckets = self._hash_vars(config)
+        self.coords = self._effective_coords(config)
+        self.plcs = dict((number, (_digest((plc.clear, plc_code(plc))), plc))
+                         for number, plc in config.plcs.items())
+
+        self.root = _digest((
+            tuple(sorted((key, hash_)
+                         for key, (hash_, entries) in self.buckets.items())),
+            tuple(sorted(self.coords.items())),
+            tuple(sorted((number, hash_)
+                         for number, (hash_, plc) in self.plcs.items()))))
+
+    def _hash_vars(self, config):
+        comments = self.comments
+        buckets = {}
+        for type_, tpvars in config.variables.items():
+            for tpvar in tpvars:
+                if isinstance(tpvar, TpVarRange):
+                    key = (type_, tpvar.first, tpvar.last)
+                else:
+                    key = (type_, tpvar.var, None)
+
+                entry = _normalize_value(tpvar.value)
+                if comments:
+                    entry = (entry, tpvar.comment or '')
+
+                bucket = (type_, tpvar.var >> BUCKET_BITS)
+                try:
+                    buckets[bucket].append((key, entry, tpvar))
+                except KeyError:
+                    buckets[bucket] = [(key, entry, tpvar)]
+
+        ret = {}
+        for bucket, items in buckets.items():
+            hash_ = _digest(tuple((key, entry) for key, entry, tpvar in items))
+            ret[bucket] = (hash_, dict((key, (entry, tpvar))
+                                       for key, entry, tpvar in items))
+
+        return ret
+
+    def _effective_coords(self, config):
+        # later definitions of the same motor take precedence
+        coords = {}
+        for block in config.blocks:
+            if isinstance(block, TpCoordSys):
+                for motor, coord in block.coords.items():
+                    coords[(block.coord_sys, motor)] = _normalize_value(coord.axis)
+
+        return coords
+
+
+def _diff_dicts(category, old, new):
+    for key in sorted(set(old) | set(new)):
+        if key not in new:
+            yield Change('removed', category, key, old[key], None)
+        elif key not in old:
+            yield Change('added', category, key, None, new[key])
+        elif old[key] != new[key]:
+            yield Change('changed', category, key, old[key], new[key])
+
+
+def _diff_vars(old, new):
+    # {key: (entry, TpVar)}, compared by entry
+    for key in sorted(set(old) | set(new)):
+        if key not in new:
+            yield Change('removed', 'variable', key, old[key][1], None)
+        elif key not in old:
+            yield Change('added', 'variable', key, None, new[key][1])
+        elif old[key][0] != new[key][0]:
+            yield Change('changed', 'variable', key, old[key][1], new[key][1])
+
+
+def diff_summaries(old, new):
+    '''
+    Changes between two ConfigSummaries, as a list of Change tuples
+    '''
+    if old.root == new.root:
+        return []
+
+    changes = []
+    empty = (None, {})
+    for bucket in sorted(set(old.buckets) | set(new.buckets)):
+        old_hash, old_vars = old.buckets.get(bucket, empty)
+        new_hash, new_vars = new.buckets.get(bucket, empty)
+        if old_hash == new_hash:
+            continue
+
+        changes.extend(_diff_vars(old_vars, new_vars))
+
+    changes.extend(_diff_dicts('coord', old.coords, new.coords))
+
+    for number in sorted(set(old.plcs) | set(new.plcs)):
+        old_hash, old_plc = old.plcs.get(number, empty)
+        new_hash, new_plc = new.plcs.get(number, empty)
+        if old_hash == new_hash:
+            continue
+
+        if old_hash is None:
+            changes.append(Change('added', 'plc', number, None, new_plc))
+        elif new_hash is None:
+            changes.append(Change('removed', 'plc', number, old_plc, None))
+        else:
+            changes.append(Change('changed', 'plc', number, old_plc, new_plc))
+
+    return changes
+
+
+def diff_configs(old, new, comments=False):
+    '''
+    Changes between two TpConfigs, as a list of Change tuples.  Variable
+    values are compared ignoring case and whitespace, PLCs ignoring
+    indentation and comments.
+    '''
+    return diff_summaries(ConfigSummary(old, comments=comments),
+                          ConfigSummary(new, comments=comments))
+
+
+def _var_str(tpvar):
+    text = '%s' % tpvar
+    if tpvar.comment:
+        text = '%s  ; %s' % (text, tpvar.comment)
+    return text
+
+
+def format_changes(changes, plc_lines=False):
+    '''
+    Lines of text describing a list of Changes
+    '''
+    marks = {'added': '+', 'removed': '-', 'changed': '~'}
+    for kind, category, key, old, new in changes:
+        mark = marks[kind]
+        if category == 'variable':
+            if kind == 'changed':
+                yield '%s %s (was %s)' % (mark, _var_str(new), _var_str(old))
+            else:
+                yield '%s %s' % (mark, _var_str(old or new))
+
+        elif category == 'coord':
+            coord_sys, motor = key
+            if kind == 'changed':
+                yield '%s &%d #%d->%s (was %s)' % (mark, coord_sys, motor,
+                                                   new, old)
+            else:
+                yield '%s &%d #%d->%s' % (mark, coord_sys, motor, old or new)
+
+        elif category == 'plc':
+            yield '%s PLC %d' % (mark, key)
+            if plc_lines and kind == 'changed':
+                diff = difflib.unified_diff(plc_code(old), plc_code(new),
+                                            lineterm='', n=1)
+                for line in list(diff)[2:]:
+                    yield '    %s' % line
+
+
+def _load(fn, follow_includes, search_path, verbose):
+    if not follow_includes:
+        return TpConfig(fn, verbose=verbose)
+
+    graph = TpIncludeGraph([fn], search_path=search_path, verbose=verbose)
+    flattened = StringIO('\n'.join(graph.flatten(once=True)))
+    return TpConfig(flattened, verbose=verbose)
+
+
+def diff_pmc(old_fn, new_fn, comments=False, follow_includes=False,
+             search_path=(), verbose=False):
+    old = _load(old_fn, follow_includes, search_path, verbose)
+    new = _load(new_fn, follow_includes, search_path, verbose)
+    return diff_configs(old, new, comments=comments)
+
+
+if __name__ == '__main__':
+    opts = docopt(__doc__)
+
+    verbose = bool(opts['--verbose'])
+    configs = [_load(fn, opts['--follow-includes'], opts['--include'],
+                     verbose)
+               for fn in (opts['OLD_PMC'], opts['NEW_PMC'])]
+
+    if verbose:
+        for fn, config in zip((opts['OLD_PMC'], opts['NEW_PMC']), configs):
+            for line in config.format_diagnostics():
+                print('%s: %s' % (fn, line), file=sys.stderr)
+
+    changes = diff_configs(configs[0], configs[1],
+                           comments=opts['--comments'])
+
+    for line in format_changes(changes, plc_lines=opts['--plc-lines']):
+        print(line)
+
+    sys.exit(1 if changes else 0)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# vi: ts=4 sw=4
+"""
+Usage: tpmac.flatten [-ov] [--include=DIR...] INPUT_PMC [OUTPUT_PMC]
+
+Assembles a single download file from a PMC file and everything it includes
+
+Arguments:
+    INPUT_PMC        the root PMC file
+    OUTPUT_PMC       optionally output to a file (stdout by default)
+
+Options:
+    -I --include=DIR  additional directory to search for included files
+    -o --once         include each file only once
+    -v --verbose      verbose mode
+"""
+
+from __future__ import print_function
+import sys
+
+from docopt import docopt
+
+from .conf import (TpIncludeGraph, IncludeCycleError)
+
+
+def flatten_pmc(input_fn, search_path=(), once=False, verbose=False):
+    graph = TpIncludeGraph([input_fn], search_path=search_path,
+                           verbose=verbose)
+
+    for path, line_num, fn in graph.missing:
+        print('* [%s:%d] include not found: %s' % (path, line_num + 1, fn),
+              file=sys.stderr)
+
+    if graph.cycles:
+        raise IncludeCycleError('\n'.join(' -> '.join(cycle)
+                                          for cycle in graph.cycles))
+
+    return graph.flatten(once=once)
+
+
+if __name__ == '__main__':
+    opts = docopt(__doc__)
+
+    input_fn = opts['INPUT_PMC']
+    output_fn = opts['OUTPUT_PMC']
+
+    try:
+        ret = flatten_pmc(input_fn,
+                          search_path=opts['--include'],
+                          once=opts['--once'],
+                          verbose=bool(opts['--verbose']))
+    except IncludeCycleError as ex:
+        print('Include cycle:\n%s' % ex, file=sys.stderr)
+        sys.exit(1)
+
+    if output_fn is not None:
+        output_ = open(output_fn, 'wt')
+    else:
+        output_ = sys.stdout
+
+    for line in ret:
+        print(line, file=output_)
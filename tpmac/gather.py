@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+# vi: ts=4 sw=4
+"""
+Usage: tpmac.gather [-u] [--period=1] [--config=PMC] [--decode=DUMP] SOURCE...
+
+Turbo PMAC data gathering: builds the gather setup (I5000..I5051) for
+M-variables or memory definitions, and decodes uploaded gather buffers
+(LIST GATHER) into NumPy structured arrays
+
+Arguments:
+    SOURCE             M-variables (M1, requires --config) or memory
+                       definitions (Y:$78005,8,16,S)
+
+Options:
+    -c --config=PMC    configuration with the M-variable definitions
+    -p --period=N      servo cycles per sample [default: 1]
+    -d --decode=DUMP   decode a LIST GATHER dump instead
+    -u --unwrap        unwrap rollover of integer sources
+"""
+
+from __future__ import print_function
+from collections import namedtuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from docopt import docopt
+
+from . import info
+from . import mem
+from . import util
+
+
+WORD_BITS = mem.WORD_BITS
+
+# gather source address (I5001..I5048) bits 22-23: register width and type
+GATHER_KINDS = {'y': 0x0, 'x': 0x1, 'd': 0x2, 'l': 0x3}
+
+MAX_SOURCES = 48
+
+
+class GatherSource(namedtuple('GatherSource', ['name', 'kind', 'word', 'bit',
+                                               'width', 'signed', 'unwrap'])):
+    '''
+    A gathered quantity: the (X or Y) bit field, 48-bit fixed point (D) or
+    48-bit floating point (L) value at a memory word
+
+    Bit fields are extracted from the gathered word on decoding, so several
+    sources on the same word use a single gather address.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def from_definition(cls, name, definition, unwrap=False):
+        '''
+        A source from an M-variable memory definition, e.g. Y:$78005,8,16,S
+        (see mem.parse_definition)
+        '''
+        parsed = mem.parse_definition(definition)
+        if parsed is None or parsed.type_ == 'dp':
+            raise ValueError('Not a memory definition: %s' % definition)
+
+        kind = parsed.type_
+        if kind in ('d', 'l', 'f'):
+            # 48-bit values; F definitions are gathered as floating point
+            if kind == 'f':
+                kind = 'l'
+            return cls(name, kind, parsed.fields[0].word, 0, 2 * WORD_BITS,
+                       kind == 'd', unwrap and kind == 'd')
+
+        field, = parsed.fields
+        if field.bit + field.width > WORD_BITS:
+            # a single gathered word
+            raise ValueError('Invalid bit field: %s' % definition)
+
+        return cls(name, kind, field.word, field.bit, field.width,
+                   parsed.format == 's', unwrap)
+
+    @property
+    def address(self):
+        '''
+        Gather source address (I5001..I5048 value)
+        '''
+        return (GATHER_KINDS[self.kind] << 22) | self.word
+
+    @property
+    def words(self):
+        '''
+        Number of 24-bit words gathered per sample
+        '''
+        return 2 if self.kind in ('d', 'l') else 1
+
+
+def source_from_mvar(config, mvar, unwrap=False):
+    '''
+    A source from the definition of an M-variable (e.g., 'M1') in a
+    TpConfig
+    '''
+    type_, num = util.var_split(mvar)
+    if type_ != 'm':
+        raise ValueError('Not an M-variable: %s' % mvar)
+
+    definition = config.variables['m'][num].value
+    return GatherSource.from_definition(mvar.upper(), definition,
+                                        unwrap=unwrap)
+
+
+def source_from_address(address, name=None, unwrap=False):
+    '''
+    A source from a memory definition, named after its info.mem_info
+    description when one is loaded
+    '''
+    if name is None:
+        name = address
+        if info.mem_info is not None:
+            try:
+                name = info.mem_info[address][0]
+            except KeyError:
+                pass
+
+    return GatherSource.from_definition(name, address, unwrap=unwrap)
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError('numpy is required to decode gathered data')
+
+
+def unpack_words(data, big_endian=False):
+    '''
+    24-bit words packed as 3 bytes each (e.g., a binary upload of the
+    gather buffer) as a uint64 array
+    '''
+    _require_numpy()
+    data = np.frombuffer(data, dtype=np.uint8)
+    if len(data) % 3:
+        raise ValueError('Data is not a whole number of 24-bit words')
+
+    data = data.reshape(-1, 3).astype(np.uint64)
+    if big_endian:
+        data = data[:, ::-1]
+    return ((data[:, 2] << np.uint64(16)) | (data[:, 1] << np.uint64(8)) |
+            data[:, 0])
+
+
+_HEX_INVALID = 255
+_HEX_SPACE = 254
+
+
+def _hex_table():
+    table = np.full(256, _HEX_INVALID, dtype=np.uint8)
+    for c in b' \t\r\n':
+        table[ord(c) if isinstance(c, str) else c] = _HEX_SPACE
+    for i, c in enumerate('0123456789abcdef'):
+        table[ord(c)] = i
+        table[ord(c.upper())] = i
+    return table
+
+
+def parse_hex_words(text):
+    '''
+    The 24-bit words of a LIST GATHER dump, as a uint64 array
+
+    The dump lists each word as 6 hex digits (48-bit values as 12, the
+    high word first); only whitespace may separate them.
+    '''
+    _require_numpy()
+    if not isinstance(text, bytes):
+        text = text.encode('ascii')
+
+    digits = _hex_table()[np.frombuffer(text, dtype=np.uint8)]
+    digits = digits[digits != _HEX_SPACE]
+    if len(digits) and digits.max() == _HEX_INVALID:
+        raise ValueError('Gather data is not hexadecimal')
+
+    if len(digits) % 6:
+        raise ValueError('Gather data is not a whole number of 24-bit words')
+
+    digits = digits.reshape(-1, 6).astype(np.uint64)
+    words = digits[:, 0]
+    for i in range(1, 6):
+        words = (words << np.uint64(4)) | digits[:, i]
+
+    return words
+
+
+def _sign_extend(values, width):
+    # values: int64 array of unsigned width-bit fields
+    sign = np.int64(1) << (width - 1)
+    return (values ^ sign) - sign
+
+
+def unwrap(values, width):
+    '''
+    Undo the rollover of a width-bit counter: each step between samples is
+    taken to be the one of least magnitude modulo 2**width
+    '''
+    _require_numpy()
+    values = np.asarray(values, dtype=np.int64)
+    if len(values) < 2:
+        return values.copy()
+
+    modulus = np.int64(1) << width
+    half = modulus >> 1
+    steps = ((np.diff(values) + half) & (modulus - 1)) - half
+
+    ret = np.empty_like(values)
+    ret[0] = values[0]
+    np.cumsum(steps, out=ret[1:])
+    ret[1:] += values[0]
+    return ret
+
+
+class GatherList(object):
+    '''
+    An ordered list of GatherSources and the gather addresses they use
+
+    Sources sharing a register (e.g., the bit fields of one status word)
+    share a gather address.  The samples of a gather dump hold the words of
+    each address in turn.
+    '''
+    def __init__(self, sources=()):
+        self.sources = []
+        self.addresses = []
+        for source in sources:
+            self.add(source)
+
+    def __len__(self):
+        return len(self.sources)
+
+    def __iter__(self):
+        return iter(self.sources)
+
+    def add(self, source):
+        if source.name in self.names:
+            raise ValueError('Duplicate source name: %s' % source.name)
+
+        address = source.address
+        if address not in self.addresses:
+            if len(self.addresses) >= MAX_SOURCES:
+                raise ValueError('Too many gather addresses (max %d)' %
+                                 MAX_SOURCES)
+            self.addresses.append(address)
+
+        self.sources.append(source)
+
+    @property
+    def names(self):
+        return [source.name for source in self.sources]
+
+    def _address_words(self):
+        # the first word column and number of words of each address
+        columns = {}
+        col = 0
+        for address in self.addresses:
+            words = 2 if (address >> 22) >= GATHER_KINDS['d'] else 1
+            columns[address] = (col, words)
+            col += words
+        return columns, col
+
+    @property
+    def sample_words(self):
+        return self._address_words()[1]
+
+    def setup_commands(self, period=1):
+        '''
+        Command lines setting up (but not starting) data gathering of the
+        sources every period servo cycles
+        '''
+        yield 'DEL GAT'
+        yield 'I5000=0'
+        for i, address in enumerate(self.addresses):
+            yield 'I%d=$%06X' % (5001 + i, address)
+
+        mask = (1 << len(self.addresses)) - 1
+        yield 'I5049=%d' % period
+        yield 'I5050=$%06X' % (mask & 0xFFFFFF)
+        yield 'I5051=$%06X' % (mask >> 24)
+        yield 'DEF GAT'
+
+    @property
+    def dtype(self):
+        _require_numpy()
+        return np.dtype([(str(source.name),
+                          np.float64 if source.kind == 'l' else np.int64)
+                         for source in self.sources])
+
+    def decode(self, data, big_endian=False):
+        '''
+        A structured array of the samples (one field per source) of a
+        LIST GATHER dump (text) or an array of 24-bit words.  Pass bytes
+        through unpack_words first for packed binary data.
+        '''
+        _require_numpy()
+        if isinstance(data, (str, bytes, type(u''))):
+            words = parse_hex_words(data)
+        else:
+            words = np.asarray(data, dtype=np.uint64)
+
+        columns, sample_words = self._address_words()
+        if not sample_words or len(words) % sample_words:
+            raise ValueError('Gather data is not a whole number of samples '
+                             '(%d words per sample)' % sample_words)
+
+        words = words.reshape(-1, sample_words)
+        ret = np.empty(len(words), dtype=self.dtype)
+        for source in self.sources:
+            col, num_words = columns[source.address]
+            if num_words == 2:
+                value = ((words[:, col] << np.uint64(WORD_BITS)) |
+                         words[:, col + 1])
+            else:
+                value = words[:, col]
+
+            ret[str(source.name)] = _decode_field(source, value)
+
+        return ret
+
+
+def _decode_field(source, value):
+    if source.kind == 'l':
+        # 36-bit two's complement mantissa (1.35 fixed point), 12-bit
+        # exponent offset by $7FF
+        value = value.astype(np.int64)
+        mantissa = _sign_extend(value >> 12, 36).astype(np.float64)
+        exponent = (value & 0xFFF) - (0x7FF + 35)
+        with np.errstate(over='ignore'):
+            return np.ldexp(mantissa, exponent.astype(np.int32))
+
+    width = source.width
+    if source.bit or width < source.words * WORD_BITS:
+        value = (value >> np.uint64(source.bit)) & np.uint64((1 << width) - 1)
+
+    value = value.astype(np.int64)
+    if source.signed:
+        value = _sign_extend(value, width)
+    if source.unwrap:
+        value = unwrap(value, width)
+    return value
+
+
+if __name__ == '__main__':
+    opts = docopt(__doc__)
+
+    config = None
+    if opts['--config']:
+        from .conf import TpConfig
+        config = TpConfig(opts['--config'], verbose=False)
+
+    sources = GatherList()
+    unwrap_ = bool(opts['--unwrap'])
+    for source in opts['SOURCE']:
+        if util.simple_var_re.match(source):
+            if config is None:
+                raise SystemExit('M-variable sources require --config')
+            sources.add(source_from_mvar(config, source, unwrap=unwrap_))
+        else:
+            sources.add(source_from_address(source, unwrap=unwrap_))
+
+    if opts['--decode']:
+        data = sources.decode(open(opts['--decode'], 'rt').read())
+        print('\t'.join(sources.names))
+        for sample in data:
+            print('\t'.join('%s' % value for value in sample))
+    else:
+        for line in sources.setup_commands(period=int(opts['--period'])):
+            print(line)
@@ -1,362 +1,1141 @@
-#!/usr/bin/env python
-# vi: ts=4 sw=4
-"""
-tpmac.info
-Generates (and reads) tab-separated files containing turbo pmac variable,
-memory, and documentation page locations
-"""
-
-from __future__ import print_function
-import os
-import sys
-import re
-
-from . import util
-
-
-ranges = {'motor': [('%.2d' % x, [('xx', '%d' % x)]) for x in range(1, 33)],
-          'macro': [('%d' % n, [(' n ', ' %d' % n)]) for n in range(1, 3)],
-          'servo': [('%d%d' % (m, n),
-                    [('Servo IC m', 'Servo IC %d' % m),
-                     ('Channel n', 'Channel %d' % n)])
-                    for m in range(0, 10) for n in range(1, 5)],
-          'servo0': [('%d0' % m,
-                     [('Servo IC m', 'Servo IC %d' % m)])
-                     for m in range(0, 10)],
-          }
-
-
-def cs_range():
-    cs = 1
-    ret = []
-    for s in range(5, 7):
-        if s == 0:
-            x_range = range(1, 10)
-        else:
-            x_range = range(1, 7)
-
-        for x in x_range:
-            ret.append(('%s%s' % (s, x), [(' x ', ' %d ' % cs)]))
-            cs += 1
-    return ret
-
-
-ranges['cs'] = cs_range()
-ivars = {}
-
-
-def _eval_ivar(f, page, ivar, category, desc):
-    if '/' in ivar:
-        for iv in ivar.split('/'):
-            _eval_ivar(f, page, iv, category, desc)
-        return
-    elif '-' in ivar:
-        r0, r1 = [util.ivar_to_int(iv) for iv in ivar.split('-')]
-        for i in range(r0, r1 + 1):
-            _eval_ivar(f, page, 'i%d' % i, category, desc)
-    else:
-        try:
-            ivar_int = util.ivar_to_int(ivar)
-        except:
-            print('Failed: %s' % ivar)
-        else:
-            print('i%d\t%s\t%s\t%d' % (ivar_int, desc, category, page), file=f)
-
-            if ivar in ivars:
-                print('Duplicate', ivar, ivars[ivar], '//', (category, desc))
-
-            ivars[ivar] = (category, desc, page)
-
-
-def eval_ivar(f, page, ivar, category, desc):
-    if 'Motor xx' in desc:
-        class_, replace = 'motor', 'xx'
-    elif 'Servo IC m Channel n' in desc:
-        class_, replace = 'servo', 'mn'
-    elif 'Servo IC m' in desc:
-        class_, replace = 'servo0', 'm'
-    elif ('MACRO IC Channel n' in desc) or ('MACRO IC Encoder n' in desc):
-        class_, replace = 'macro', 'n'
-    elif 'Coordinate System' in desc:
-        class_, replace = 'cs', 'sx'
-    else:
-        class_ = ''
-
-    if class_:
-        range_ = ranges[class_]
-        for replace_with, desc_replace in range_:
-            _eval_ivar(f, page,
-                       ivar.replace(replace, replace_with),
-                       replace_multiple(category, *desc_replace),
-                       replace_multiple(desc, *desc_replace))
-    else:
-        _eval_ivar(f, page, ivar, category, desc)
-
-
-def replace_multiple(s, *from_to):
-    for from_, to in from_to:
-        s = s.replace(from_, to)
-    return s
-
-
-def generate_toc_info(input_fn, output_fn, only_ivars=False):
-    category = ''
-    re_istart = re.compile('(I[sxmn0-9][sxmn0-9-]*)')
-
-    all_toc = []
-
-    category = ''
-
-    with open(output_fn, 'wt') as f:
-        print('# vi: ts=30 sw=30', file=f)
-        with open(input_fn, 'rt') as inf:
-            for line in inf.readlines():
-                if not line.strip():
-                    continue
-                elif '....' not in line:
-                    continue
-
-                is_category = not line.startswith(' ')
-
-                line, page = line.split('....', 1)
-                line = line.rstrip('.').strip()
-                page = int(page.lstrip('.'))
-
-                line = line.replace('\t', ' ')
-                line = line.replace('  ', ' ')
-
-                all_toc.append((page, line))
-
-                if is_category:
-                    category = line
-
-                if only_ivars:
-                    if not is_category:
-                        m = re_istart.match(line)
-                        if m:
-                            ivar, desc = line.split(' ', 1)
-                            eval_ivar(f, page, ivar, category, desc.strip())
-                    continue
-
-                print('%s\t%s\t%d' % (line, category, page), file=f)
-
-
-def generate_mem_info(fn, output_fn):
-    addr_info = {}
-
-    whitespace = re.compile('[\s]')
-
-    def fix_comment(s):
-        if s.startswith('&'):
-            s = 'CS %s' % s[1:]
-        elif s.startswith('#'):
-            s = 'Motor %s' % s[1:]
-
-        return s
-
-    for line in open(fn, 'rt').readlines():
-        line = line.strip()
-        if ';' in line:
-            line, comment = line.split(';', 1)
-            comment = comment.strip()
-        else:
-            comment = ''
-
-        line = whitespace.subn('', line)[0]
-        if not line:
-            continue
-
-        if '->' in line:
-            mvar, mem = line.split('->')
-            if mem.strip() == '*':
-                continue
-
-            mvar = mvar.upper()
-            mem = util.clean_addr(mem)
-
-            if not comment:
-                print('%s points to %s which is %s' % (mvar, mem, comment))
-
-            addr_info[mem] = fix_comment(comment)
-
-    with open(output_fn, 'wt') as f:
-        print('# vi: sw=20 ts=20', file=f)
-
-        for mem, info in sorted(addr_info.items(), key=lambda (mem, info): '%s %s' % (info.lower(), mem)):
-            print('%s\t%s' % (mem, info), file=f)
-
-
-class Info(object):
-    def __init__(self, fn=None, delim='\t'):
-        self.clear()
-
-        if fn is not None:
-            self.load_file(fn, delim=delim)
-
-    def clear(self):
-        self.data = {}
-        self._lower_keys = {}
-        self._lower_data = {}
-
-    def load_file(self, fn, delim='\t', clear=True):
-        if clear:
-            self.clear()
-
-        for line in open(fn, 'rt').readlines():
-            line = line.strip()
-            if line.startswith('#'):
-                continue
-
-            info = line.split(delim)
-
-            key, data = info[0], info[1:]
-            self.add_item(key, data)
-
-    def add_item(self, key, data):
-        self._lower_keys[key.lower()] = key
-        self.data[key] = data
-
-    def __getitem__(self, key):
-        if key.lower() in self._lower_keys:
-            key = self._lower_keys[key.lower()]
-
-        return self.data[key]
-
-    def search(self, text, in_keys=True, in_data=True,
-               case_insensitive=True):
-        # note: very inefficient search
-        if case_insensitive:
-            text = text.lower()
-
-        for key, values in self.data.items():
-            s = []
-            if in_keys:
-                s.append(key)
-            if in_data:
-                s.extend(values)
-
-            s = ''.join(s)
-            if case_insensitive:
-                s = s.lower()
-
-            s = s.decode('ascii', 'ignore')
-
-            if text in s:
-                yield (key, values)
-
-
-class VarInfo(Info):
-    def __init__(self, type_='i', **kwargs):
-        self.type_ = type_
-        Info.__init__(self, **kwargs)
-
-    def __getitem__(self, key):
-        if '->' in key:
-            key = key.split('->', 1)[0]
-
-        return Info.__getitem__(self, util.clean_var(key, type_=self.type_))
-
-    def add_item(self, key, data):
-        return Info.add_item(self, util.clean_var(key, type_=self.type_), data)
-
-
-class MemInfo(Info):
-    def __getitem__(self, key):
-        if '->' in key:
-            key = key.split('->', 1)[1]
-
-        return Info.__getitem__(self, util.clean_addr(key))
-
-    def add_item(self, key, data):
-        return Info.add_item(self, util.clean_addr(key), data)
-
-
-# table of contents file generated using:
-#    pdftotext -layout turbo_srm.pdf and partially hand-tweaked
-# see the geobrick_lv one for example
-RAW_IVAR_FN = 'ivars_raw.txt'
-RAW_TOC_FN = 'contents.txt'
-# memory information should be a commented script containing
-# mappings from (arbitrary) m variables to memory addresses.
-# the address and comment for that line then get stored.
-RAW_MEM_FN = 'm_variables.pmc'
-
-# the actual information files -- tsv (tab-separated values)
-IVAR_FN = 'ivars.tsv'
-MEM_FN = 'mem.tsv'
-TOC_FN = 'contents.tsv'
-
-ivar_info = None
-mem_info = None
-toc_info = None
-
-
-def load_settings(profile, ivar_fn=IVAR_FN, mem_fn=MEM_FN,
-                  toc_fn=TOC_FN):
-    global ivar_info, mem_info, toc_info
-
-    profile_path = util.get_profile_path(profile)
-
-    ivar_fn = os.path.join(profile_path, ivar_fn)
-    ivar_info = VarInfo(fn=ivar_fn, type_='i')
-
-    mem_fn = os.path.join(profile_path, mem_fn)
-    mem_info = MemInfo(fn=mem_fn)
-
-    toc_fn = os.path.join(profile_path, toc_fn)
-    toc_info = Info(fn=toc_fn)
-
-
-def generate_settings(profile, ivar_fns=(RAW_TOC_FN, IVAR_FN),
-                      mem_fns=(RAW_MEM_FN, MEM_FN),
-                      toc_fns=(RAW_TOC_FN, TOC_FN)):
-    profile_path = util.get_profile_path(profile)
-
-    ivar_fns = [os.path.join(profile_path, fn) for fn in ivar_fns]
-    mem_fns = [os.path.join(profile_path, fn) for fn in mem_fns]
-    toc_fns = [os.path.join(profile_path, fn) for fn in toc_fns]
-
-    generate_toc_info(ivar_fns[0], ivar_fns[1], only_ivars=True)
-    generate_mem_info(*mem_fns)
-    generate_toc_info(*toc_fns)
-
-
-def lookup(text):
-    global ivar_info, mem_info, toc_info
-    text = text.strip()
-    if not text:
-        return []
-
-    if ':$' in text:
-        try:
-            desc = mem_info[text][0]
-        except KeyError:
-            pass
-        else:
-            return [(desc, None)]
-
-    try:
-        var_type, num = util.var_split(text)
-    except ValueError:
-        pass
-    else:
-        if var_type == 'i':
-            try:
-                desc, category, page = ivar_info[text]
-            except KeyError:
-                pass
-            else:
-                return [('%s [%s]' % (desc, category), int(page))]
-
-    contents = toc_info
-    return [('%s [%s]' % (desc_, cat_), int(page_))
-            for desc_, (cat_, page_) in contents.search(text)]
-
-
-if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print('Usage: %s profile_name' % (sys.argv[0]))
-        sys.exit(1)
-
-    profile = sys.argv[1]
-    generate_settings(profile)
+#!/usr/bin/env python
+# vi: ts=4 sw=4
+"""
+tpmac.info
+Generates (and reads) tab-separated files containing turbo pmac variable,
+memory, and documentation page locations
+
+The tsv files are part of each profile (tpmac/info/<profile>).  Their
+compiled tables, search indices and the profile's generation manifest
+are not: they are built on demand (on first use, or by generate_settings
+and compile_settings) and kept in the user's cache directory (see
+INFO_CACHE_PATH).  Until a table is compiled, its tsv file is read.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import re
+import json
+import mmap
+import struct
+import marshal
+import hashlib
+import binascii
+import tempfile
+import multiprocessing
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from . import util
+from .mem import (AddressIndex, field_span, parse_mvar)
+
+
+ranges = {'motor': [('%.2d' % x, [('xx', '%d' % x)]) for x in range(1, 33)],
+          'macro': [('%d' % n, [(' n ', ' %d' % n)]) for n in range(1, 3)],
+          'servo': [('%d%d' % (m, n),
+                    [('Servo IC m', 'Servo IC %d' % m),
+                     ('Channel n', 'Channel %d' % n)])
+                    for m in range(0, 10) for n in range(1, 5)],
+          'servo0': [('%d0' % m,
+                     [('Servo IC m', 'Servo IC %d' % m)])
+                     for m in range(0, 10)],
+          }
+
+
+def cs_range():
+    cs = 1
+    ret = []
+    for s in range(5, 7):
+        if s == 0:
+            x_range = range(1, 10)
+        else:
+            x_range = range(1, 7)
+
+        for x in x_range:
+            ret.append(('%s%s' % (s, x), [(' x ', ' %d ' % cs)]))
+            cs += 1
+    return ret
+
+
+ranges['cs'] = cs_range()
+
+
+def _eval_ivar(rows, page, ivar, category, desc, seen):
+    if '/' in ivar:
+        for iv in ivar.split('/'):
+            _eval_ivar(rows, page, iv, category, desc, seen)
+        return
+    elif '-' in ivar:
+        r0, r1 = [util.ivar_to_int(iv) for iv in ivar.split('-')]
+        for i in range(r0, r1 + 1):
+            _eval_ivar(rows, page, 'i%d' % i, category, desc, seen)
+    else:
+        try:
+            ivar_int = util.ivar_to_int(ivar)
+        except:
+            print('Failed: %s' % ivar)
+        else:
+            rows.append('i%d\t%s\t%s\t%d' % (ivar_int, desc, category, page))
+
+            if ivar in seen:
+                print('Duplicate', ivar, seen[ivar], '//', (category, desc))
+
+            seen[ivar] = (category, desc, page)
+
+
+def eval_ivar(rows, page, ivar, category, desc, seen=None):
+    '''
+    Append the ivars.tsv rows of a table of contents I-variable entry
+    (expanding templates such as Ixx30 or I7mn0) to rows
+    '''
+    if seen is None:
+        seen = {}
+
+    if 'Motor xx' in desc:
+        class_, replace = 'motor', 'xx'
+    elif 'Servo IC m Channel n' in desc:
+        class_, replace = 'servo', 'mn'
+    elif 'Servo IC m' in desc:
+        class_, replace = 'servo0', 'm'
+    elif ('MACRO IC Channel n' in desc) or ('MACRO IC Encoder n' in desc):
+        class_, replace = 'macro', 'n'
+    elif 'Coordinate System' in desc:
+        class_, replace = 'cs', 'sx'
+    else:
+        class_ = ''
+
+    if class_:
+        range_ = ranges[class_]
+        for replace_with, desc_replace in range_:
+            _eval_ivar(rows, page,
+                       ivar.replace(replace, replace_with),
+                       replace_multiple(category, *desc_replace),
+                       replace_multiple(desc, *desc_replace), seen)
+    else:
+        _eval_ivar(rows, page, ivar, category, desc, seen)
+
+
+def replace_multiple(s, *from_to):
+    for from_, to in from_to:
+        s = s.replace(from_, to)
+    return s
+
+
+def _read_lines(fn, lines):
+    if lines is None:
+        with open(fn, 'rt') as f:
+            return f.readlines()
+    return lines
+
+
+def parse_toc(lines):
+    '''
+    (page, entry, category, is_category) of each line of a table of
+    contents (contents.txt)
+    '''
+    category = ''
+    for line in lines:
+        if not line.strip():
+            continue
+        elif '....' not in line:
+            continue
+
+        is_category = not line.startswith(' ')
+
+        line, page = line.split('....', 1)
+        line = line.rstrip('.').strip()
+        page = int(page.lstrip('.'))
+
+        line = line.replace('\t', ' ')
+        line = line.replace('  ', ' ')
+
+        if is_category:
+            category = line
+
+        yield page, line, category, is_category
+
+
+def generate_toc_info(input_fn, output_fn, only_ivars=False, lines=None):
+    '''
+    Write the table of contents (or, with only_ivars, the I-variable) tsv
+    from the table of contents input_fn, or its already-read lines
+    '''
+    re_istart = re.compile('(I[sxmn0-9][sxmn0-9-]*)')
+
+    rows = ['# vi: ts=30 sw=30']
+    seen = {}
+    for page, line, category, is_category in parse_toc(_read_lines(input_fn,
+                                                                   lines)):
+        if only_ivars:
+            if not is_category:
+                m = re_istart.match(line)
+                if m:
+                    ivar, desc = line.split(' ', 1)
+                    eval_ivar(rows, page, ivar, category, desc.strip(),
+                              seen=seen)
+            continue
+
+        rows.append('%s\t%s\t%d' % (line, category, page))
+
+    rows.append('')
+    with open(output_fn, 'wt') as f:
+        f.write('\n'.join(rows))
+
+    if not only_ivars:
+        # precompute the search index of the table of contents
+        Info(fn=output_fn).save_index()
+
+
+def generate_mem_info(fn, output_fn, lines=None):
+    addr_info = {}
+
+    whitespace = re.compile('[\s]')
+
+    def fix_comment(s):
+        if s.startswith('&'):
+            s = 'CS %s' % s[1:]
+        elif s.startswith('#'):
+            s = 'Motor %s' % s[1:]
+
+        return s
+
+    for line in _read_lines(fn, lines):
+        line = line.strip()
+        if ';' in line:
+            line, comment = line.split(';', 1)
+            comment = comment.strip()
+        else:
+            comment = ''
+
+        line = whitespace.subn('', line)[0]
+        if not line:
+            continue
+
+        if '->' in line:
+            mvar, mem = line.split('->')
+            if mem.strip() == '*':
+                continue
+
+            mvar = mvar.upper()
+            mem = util.clean_addr(mem)
+
+            if not comment:
+                print('%s points to %s which is %s' % (mvar, mem, comment))
+
+            addr_info[mem] = fix_comment(comment)
+
+    rows = ['# vi: sw=20 ts=20']
+    rows.extend('%s\t%s' % (mem, info)
+                for mem, info in sorted(addr_info.items(), key=lambda (mem, info): '%s %s' % (info.lower(), mem)))
+    rows.append('')
+
+    with open(output_fn, 'wt') as f:
+        f.write('\n'.join(rows))
+
+
+NGRAM = 3
+# bump whenever the layout of saved indices changes
+INDEX_VERSION = 1
+
+# files generated from the profiles' tsv files, outside of the source tree
+INFO_CACHE_PATH = os.path.join(util.CACHE_PATH, 'info')
+
+
+def generated_filename(fn, ext):
+    '''
+    The name of the file generated from fn (a profile's tsv file), with the
+    extension ext, under INFO_CACHE_PATH
+    '''
+    path, name = os.path.split(os.path.abspath(fn))
+    # the same profile in different checkouts is kept apart
+    path_key = hashlib.sha1(path.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(INFO_CACHE_PATH,
+                        '%s-%s' % (os.path.basename(path), path_key),
+                        os.path.splitext(name)[0] + ext)
+
+
+@contextmanager
+def _generated_file(fn, mode='wb'):
+    # written to a temporary name and renamed into place, as several
+    # processes may generate the same file
+    path = os.path.dirname(fn)
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+    fd, temp_fn = tempfile.mkstemp(dir=path, prefix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+
+        os.chmod(temp_fn, 0o644)
+        try:
+            os.rename(temp_fn, fn)
+        except OSError:
+            # windows will not rename over an existing file
+            if os.path.exists(fn):
+                os.unlink(fn)
+            os.rename(temp_fn, fn)
+    except BaseException:
+        try:
+            os.unlink(temp_fn)
+        except OSError:
+            pass
+        raise
+
+
+def index_filename(fn):
+    return generated_filename(fn, '.idx')
+
+
+def search_text(key, values):
+    '''
+    The text an Info entry is searched in, as by Info.search
+    '''
+    return ''.join([key] + list(values)).lower().decode('ascii', 'ignore')
+
+
+def _ngrams(text):
+    return set(text[i:i + NGRAM] for i in range(len(text) - NGRAM + 1))
+
+
+class NgramIndex(object):
+    '''
+    Inverted index from the n-grams of each entry's search text to the
+    entries containing them.  A substring query only checks the entries
+    that have all of its n-grams; queries shorter than an n-gram fall back
+    to checking every entry.
+    '''
+    def __init__(self):
+        self.keys = []
+        self.texts = []
+        self.grams = {}
+
+    @classmethod
+    def from_info(cls, info):
+        index = cls()
+        for key, values in info.data.items():
+            index.add(key, search_text(key, values))
+        return index
+
+    def add(self, key, text):
+        id_ = len(self.keys)
+        self.keys.append(key)
+        self.texts.append(text)
+
+        grams = self.grams
+        for gram in _ngrams(text):
+            try:
+                grams[gram].append(id_)
+            except KeyError:
+                grams[gram] = [id_]
+
+    def _candidates(self, text):
+        if len(text) < NGRAM:
+            return range(len(self.texts))
+
+        postings = []
+        for gram in _ngrams(text):
+            posting = self.grams.get(gram)
+            if posting is None:
+                return ()
+            postings.append(posting)
+
+        postings.sort(key=len)
+        ids = set(postings[0])
+        for posting in postings[1:]:
+            ids.intersection_update(posting)
+            if not ids:
+                break
+
+        return ids
+
+    def _find(self, text):
+        # {id: position of text} of the entries containing (lowercase) text
+        texts = self.texts
+        found = {}
+        for id_ in self._candidates(text):
+            pos = texts[id_].find(text)
+            if pos != -1:
+                found[id_] = pos
+        return found
+
+    def search(self, text, tokens=False):
+        '''
+        Keys of the entries containing (lowercase) text, best first: key
+        matches, then earlier matches.  With tokens, entries need only
+        contain every whitespace-separated word of text, in any order.
+        '''
+        if tokens and text.split():
+            words = text.split()
+            found = self._find(words[0])
+            for word in words[1:]:
+                if not found:
+                    break
+                other = self._find(word)
+                found = dict((id_, pos + other[id_])
+                             for id_, pos in found.items() if id_ in other)
+        else:
+            found = self._find(text)
+
+        keys = self.keys
+        ranked = sorted((pos >= len(keys[id_]), pos, keys[id_])
+                        for id_, pos in found.items())
+        return [key for in_data, pos, key in ranked]
+
+    def save(self, fn, digest):
+        with _generated_file(fn) as f:
+            marshal.dump((INDEX_VERSION, tuple(sys.version_info[:2]), digest,
+                          self.keys, self.texts, self.grams), f)
+
+    @classmethod
+    def load(cls, fn, digest):
+        '''
+        A saved index, or None if it is missing, unreadable or was made
+        from a different file (by digest) or python version
+        '''
+        try:
+            with open(fn, 'rb') as f:
+                data = marshal.load(f)
+            (version, py_version, saved_digest, keys, texts,
+             grams) = data
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+
+        if (version != INDEX_VERSION or saved_digest != digest or
+                py_version != tuple(sys.version_info[:2])):
+            return None
+
+        index = cls()
+        index.keys, index.texts, index.grams = keys, texts, grams
+        return index
+
+
+# compiled tables: header, (count + 1) key offsets, (count + 1) row offsets,
+# the lowercase keys (sorted) and the rows ('key\tvalue\tvalue...')
+COMPILED_MAGIC = b'TPIT'
+COMPILED_VERSION = 1
+_compiled_header = struct.Struct('<4sHHdQ20sI')
+_offset = struct.Struct('<I')
+_offset_pair = struct.Struct('<II')
+
+
+def compiled_filename(fn):
+    return generated_filename(fn, '.bin')
+
+
+# rows (value tuples) of all loaded tables, so that entries common to
+# several profiles are stored once
+_shared_rows = {}
+# open compiled tables, by (file name, source digest)
+_open_tables = {}
+
+
+def _share(values):
+    values = tuple(values)
+    return _shared_rows.setdefault(values, values)
+
+
+def _to_bytes(s):
+    if isinstance(s, bytes):
+        return s
+    return s.encode('utf-8')
+
+
+def _from_bytes(b):
+    if str is bytes:
+        return b
+    return b.decode('utf-8')
+
+
+class _SortedKeys(object):
+    # the sorted keys of a CompiledTable, as a sequence for bisect
+    def __init__(self, table):
+        self.table = table
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, i):
+        return self.table._key(i)
+
+
+class CompiledTable(object):
+    '''
+    A memory-mapped, read-only Info table written by Info.compile
+
+    Opening it only reads the header; lookups bisect the sorted lowercase
+    keys and decode the single matching row (once: decoded rows are kept
+    for repeated lookups).  The header records the
+    size and modification time of the source tsv, so that a stale table
+    is ignored (see CompiledTable.open).
+
+    The mapping is read-only, so the operating system shares its pages
+    between all processes using the table (e.g., conf.load_many workers);
+    within a process, identical tables are opened once.
+    '''
+    def __init__(self, fn):
+        with open(fn, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            (magic, version, _, self.source_mtime, self.source_size, digest,
+             self._count) = _compiled_header.unpack_from(self._map, 0)
+        except struct.error:
+            raise ValueError('Not a compiled table: %s' % fn)
+
+        if magic != COMPILED_MAGIC or version != COMPILED_VERSION:
+            raise ValueError('Not a compiled table: %s' % fn)
+
+        self.digest = _from_bytes(binascii.hexlify(digest))
+        self._decoded = {}
+        self._key_offsets = _compiled_header.size
+        self._row_offsets = self._key_offsets + _offset.size * (self._count + 1)
+        self._keys = self._row_offsets + _offset.size * (self._count + 1)
+        self._rows = self._keys + self._offset(self._key_offsets, self._count)
+
+    @classmethod
+    def open(cls, fn, source_fn):
+        '''
+        The compiled table fn of source_fn, or None if it is missing,
+        invalid or older than source_fn
+        '''
+        try:
+            table = cls(fn)
+            stat = os.stat(source_fn)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if (table.source_size != stat.st_size or
+                table.source_mtime != stat.st_mtime):
+            table.close()
+            return None
+
+        key = (os.path.basename(fn), table.digest)
+        if key in _open_tables:
+            table.close()
+            return _open_tables[key]
+
+        _open_tables[key] = table
+        return table
+
+    def close(self):
+        self._map.close()
+
+    def __len__(self):
+        return self._count
+
+    def _offset(self, base, i):
+        return _offset.unpack_from(self._map, base + _offset.size * i)[0]
+
+    def _key(self, i):
+        start, end = _offset_pair.unpack_from(self._map, self._key_offsets +
+                                              _offset.size * i)
+        return self._map[self._keys + start:self._keys + end]
+
+    def row(self, i):
+        '''
+        [key, value, ...] of the i-th row (in lowercase key order)
+        '''
+        start, end = _offset_pair.unpack_from(self._map, self._row_offsets +
+                                              _offset.size * i)
+        return _from_bytes(self._map[self._rows + start:
+                                     self._rows + end]).split('\t')
+
+    def __getitem__(self, lower_key):
+        '''
+        The values of the row with the (lowercase) key
+        '''
+        try:
+            return self._decoded[lower_key]
+        except KeyError:
+            pass
+
+        key = _to_bytes(lower_key)
+        i = bisect_left(_SortedKeys(self), key)
+        if i == self._count or self._key(i) != key:
+            raise KeyError(lower_key)
+
+        values = self._decoded[lower_key] = _share(self.row(i)[1:])
+        return values
+
+    def items(self):
+        for i in range(self._count):
+            row = self.row(i)
+            yield row[0], _share(row[1:])
+
+    @staticmethod
+    def write(fn, rows, source_fn, digest):
+        '''
+        Write rows, {lowercase key: (key, values)}, as compiled from
+        source_fn (whose sha1 hex digest is digest)
+        '''
+        keys = []
+        key_offsets = [0]
+        row_data = []
+        row_offsets = [0]
+        for lower_key, (key, values) in sorted((_to_bytes(lower_key), row)
+                                               for lower_key, row
+                                               in rows.items()):
+            keys.append(lower_key)
+            key_offsets.append(key_offsets[-1] + len(lower_key))
+            row = _to_bytes('\t'.join([key] + list(values)))
+            row_data.append(row)
+            row_offsets.append(row_offsets[-1] + len(row))
+
+        stat = os.stat(source_fn)
+        with _generated_file(fn) as f:
+            f.write(_compiled_header.pack(COMPILED_MAGIC, COMPILED_VERSION, 0,
+                                          stat.st_mtime, stat.st_size,
+                                          binascii.unhexlify(digest),
+                                          len(keys)))
+            f.write(struct.pack('<%dI' % len(key_offsets), *key_offsets))
+            f.write(struct.pack('<%dI' % len(row_offsets), *row_offsets))
+            f.write(b''.join(keys))
+            f.write(b''.join(row_data))
+
+
+class Info(object):
+    def __init__(self, fn=None, delim='\t', lazy=False):
+        '''
+        With lazy, the file is only read on first use, and its compiled
+        table (see compile) is used for lookups if it is up to date.
+        A lazy table without one is compiled when the file is read, and its
+        search index is saved when first built, for later processes.
+        '''
+        self.clear()
+        self._lazy = lazy
+
+        if fn is not None:
+            if lazy:
+                self._fn = fn
+                self._pending = (fn, delim)
+                self._compiled = CompiledTable.open(compiled_filename(fn), fn)
+            else:
+                self.load_file(fn, delim=delim)
+
+    def clear(self):
+        self._data = {}
+        self._lower_keys = {}
+        self._lower_data = {}
+        self._index = None
+        self._fn = None
+        self._digest = None
+        self._pending = None
+        self._compiled = None
+
+    @property
+    def data(self):
+        if self._pending is not None:
+            fn, delim = self._pending
+            compiled = self._compiled
+            self.load_file(fn, delim=delim)
+            if compiled is None:
+                try:
+                    self.compile()
+                except (IOError, OSError):
+                    # e.g., a read-only cache directory
+                    pass
+
+        return self._data
+
+    def load_file(self, fn, delim='\t', clear=True):
+        if clear:
+            self.clear()
+
+        with open(fn, 'rt') as f:
+            contents = f.read()
+
+        for line in contents.splitlines():
+            line = line.strip()
+            if line.startswith('#'):
+                continue
+
+            info = line.split(delim)
+
+            key, data = info[0], _share(info[1:])
+            self.add_item(key, data)
+
+        if clear:
+            # use the precomputed search index, if it matches the file
+            self._fn = fn
+            self._digest = hashlib.sha1(contents).hexdigest()
+            index = NgramIndex.load(index_filename(fn), self._digest)
+            if (index is not None and len(index.keys) == len(self.data) and
+                    all(key in self.data for key in index.keys)):
+                self._index = index
+
+    def add_item(self, key, data):
+        key = util.intern_str(key)
+        self.data[key] = data
+        self._lower_keys[key.lower()] = key
+        self._index = None
+        self._compiled = None
+
+    def items(self):
+        '''
+        (key, values) of all entries, from the compiled table if in use
+        '''
+        if self._compiled is not None:
+            return self._compiled.items()
+        return self.data.items()
+
+    @property
+    def index(self):
+        '''
+        The NgramIndex of the entries, built on first use
+        '''
+        if self._index is None and self._compiled is not None:
+            index = NgramIndex.load(index_filename(self._fn),
+                                    self._compiled.digest)
+            if index is not None and len(index.keys) == len(self._compiled):
+                self._index = index
+
+        if self._index is None:
+            self._index = NgramIndex.from_info(self)
+            if self._lazy:
+                try:
+                    self.save_index()
+                except (IOError, OSError):
+                    # e.g., a read-only cache directory
+                    pass
+
+        return self._index
+
+    def compile(self, fn=None):
+        '''
+        Write the compiled table of the loaded file (e.g., ivars.bin)
+        '''
+        if fn is None:
+            fn = compiled_filename(self._fn)
+
+        data = self.data
+        rows = dict((lower_key, (key, data[key]))
+                    for lower_key, key in self._lower_keys.items())
+        CompiledTable.write(fn, rows, self._fn, self._digest)
+
+    def save_index(self, fn=None):
+        '''
+        Save the search index of the loaded file (see index_filename)
+        '''
+        if fn is None:
+            fn = index_filename(self._fn)
+
+        digest = self._digest
+        if digest is None and self._compiled is not None:
+            digest = self._compiled.digest
+        self.index.save(fn, digest)
+
+    def __getitem__(self, key):
+        if self._compiled is not None:
+            if isinstance(key, (util.Address, util.VarRef)):
+                return self._compiled[key.key]
+            return self._compiled[key.lower()]
+
+        # reading data first loads a lazy table, filling _lower_keys
+        data = self.data
+        if isinstance(key, (util.Address, util.VarRef)):
+            # already normalized
+            return data[self._lower_keys.get(key.key, key.text)]
+
+        return data[self._lower_keys.get(key.lower(), key)]
+
+    def search(self, text, in_keys=True, in_data=True,
+               case_insensitive=True, tokens=False):
+        '''
+        (key, values) of the entries containing text.  Case-insensitive
+        searches of keys and data (the default) use the n-gram index and
+        give the best matches first (see NgramIndex.search).
+        '''
+        if in_keys and in_data and case_insensitive:
+            for key in self.index.search(text.lower(), tokens=tokens):
+                yield (key, Info.__getitem__(self, key))
+            return
+
+        # other searches check every entry
+        if case_insensitive:
+            text = text.lower()
+
+        for key, values in self.data.items():
+            s = []
+            if in_keys:
+                s.append(key)
+            if in_data:
+                s.extend(values)
+
+            s = ''.join(s)
+            if case_insensitive:
+                s = s.lower()
+
+            s = s.decode('ascii', 'ignore')
+
+            if text in s:
+                yield (key, values)
+
+
+class VarInfo(Info):
+    def __init__(self, type_='i', **kwargs):
+        self.type_ = type_
+        Info.__init__(self, **kwargs)
+
+    def __getitem__(self, key):
+        if not isinstance(key, util.VarRef):
+            if '->' in key:
+                key = key.split('->', 1)[0]
+            key = util.VarRef.parse(key)
+
+        if key[0] != self.type_:
+            raise ValueError('Variable type mismatch')
+
+        return Info.__getitem__(self, key)
+
+    def add_item(self, key, data):
+        return Info.add_item(self, util.clean_var(key, type_=self.type_), data)
+
+
+class MemInfo(Info):
+    '''
+    Memory address information.  Addresses without an entry of their own
+    resolve to the documented bit fields covering or overlapping them
+    (see overlapping), so that Y:$78005,8,12 finds the entry of
+    Y:$78005,8,16,S.
+    '''
+    def clear(self):
+        Info.clear(self)
+        self._fields = None
+
+    def _address(self, key):
+        if not isinstance(key, util.Address):
+            if '->' in key:
+                key = key.split('->', 1)[1]
+            key = util.Address.parse(key)
+        return key
+
+    def __getitem__(self, key):
+        key = self._address(key)
+        try:
+            return Info.__getitem__(self, key)
+        except KeyError:
+            matches = self.overlapping(key)
+            if not matches:
+                raise
+
+        return matches[0][1]
+
+    def add_item(self, key, data):
+        Info.add_item(self, util.clean_addr(key), data)
+        self._fields = None
+
+    @property
+    def fields(self):
+        '''
+        mem.AddressIndex of the documented addresses, built on first use
+        '''
+        if self._fields is None:
+            index = AddressIndex()
+            for key, values in self.items():
+                try:
+                    index.add(key, key)
+                except ValueError:
+                    pass
+            self._fields = index
+
+        return self._fields
+
+    def overlapping(self, key):
+        '''
+        [(documented address, values)] of the entries sharing memory with
+        an address or bit field, best first: entries covering all of it
+        (narrowest first), then the others by the number of bits shared
+        '''
+        try:
+            fields = parse_mvar(self._address(key).text)
+        except ValueError:
+            return []
+
+        matches = {}
+        for field in fields:
+            start, stop = field_span(field)
+            for entry_key, entry_field in self.fields.overlapping(field):
+                entry_start, entry_stop = field_span(entry_field)
+                covers, shared, width = matches.get(entry_key, (True, 0, 0))
+                covers = covers and entry_start <= start and entry_stop >= stop
+                shared += min(stop, entry_stop) - max(start, entry_start)
+                width += entry_field.width
+                matches[entry_key] = (covers, shared, width)
+
+        ranked = sorted((not covers, width if covers else -shared, key)
+                        for key, (covers, shared, width) in matches.items())
+        return [(key, Info.__getitem__(self, key))
+                for not_covers, rank, key in ranked]
+
+
+# table of contents file generated using:
+#    pdftotext -layout turbo_srm.pdf and partially hand-tweaked
+# see the geobrick_lv one for example
+RAW_IVAR_FN = 'ivars_raw.txt'
+RAW_TOC_FN = 'contents.txt'
+# memory information should be a commented script containing
+# mappings from (arbitrary) m variables to memory addresses.
+# the address and comment for that line then get stored.
+RAW_MEM_FN = 'm_variables.pmc'
+
+# the actual information files -- tsv (tab-separated values)
+IVAR_FN = 'ivars.tsv'
+MEM_FN = 'mem.tsv'
+TOC_FN = 'contents.tsv'
+
+# the tables of the default profile (see load_settings)
+ivar_info = None
+mem_info = None
+toc_info = None
+
+_profiles = {}
+
+
+class Profile(object):
+    '''
+    The information tables of one hardware profile
+
+    Several profiles may be loaded at once (see get_profile).  Identical
+    rows are shared between all of their tables, and compiled tables are
+    memory-mapped (see CompiledTable).
+    '''
+    def __init__(self, name, ivar_fn=IVAR_FN, mem_fn=MEM_FN, toc_fn=TOC_FN):
+        self.name = name
+        profile_path = util.get_profile_path(name)
+
+        # the files are only read (or their compiled tables opened) on
+        # first use
+        ivar_fn = os.path.join(profile_path, ivar_fn)
+        self.ivar_info = VarInfo(fn=ivar_fn, type_='i', lazy=True)
+
+        mem_fn = os.path.join(profile_path, mem_fn)
+        self.mem_info = MemInfo(fn=mem_fn, lazy=True)
+
+        toc_fn = os.path.join(profile_path, toc_fn)
+        self.toc_info = Info(fn=toc_fn, lazy=True)
+
+    def lookup(self, text):
+        return _lookup(self.ivar_info, self.mem_info, self.toc_info, text)
+
+    def __repr__(self):
+        return 'Profile(%r)' % self.name
+
+
+def get_profile(profile):
+    '''
+    The Profile named profile, loaded once per process
+    '''
+    if isinstance(profile, Profile):
+        return profile
+
+    try:
+        return _profiles[profile]
+    except KeyError:
+        ret = _profiles[profile] = Profile(profile)
+        return ret
+
+
+def load_settings(profile, ivar_fn=IVAR_FN, mem_fn=MEM_FN,
+                  toc_fn=TOC_FN):
+    '''
+    Make profile the default one, used by lookup() and TpVar.annotate
+    '''
+    global ivar_info, mem_info, toc_info
+
+    if (ivar_fn, mem_fn, toc_fn) == (IVAR_FN, MEM_FN, TOC_FN):
+        profile = get_profile(profile)
+    else:
+        profile = Profile(profile, ivar_fn=ivar_fn, mem_fn=mem_fn,
+                          toc_fn=toc_fn)
+
+    ivar_info = profile.ivar_info
+    mem_info = profile.mem_info
+    toc_info = profile.toc_info
+    return profile
+
+
+# records the raw input hashes of the generated files of a profile (kept
+# with its compiled tables, see generated_filename)
+MANIFEST_FN = 'generated.json'
+# bump whenever the generated files change for the same raw inputs
+GENERATOR_VERSION = 1
+
+
+def _generate(job):
+    # generate and compile a single tsv (in a worker process)
+    kind, input_fn, output_fn, contents = job
+    lines = contents.splitlines(True)
+    if kind == 'ivars':
+        generate_toc_info(input_fn, output_fn, only_ivars=True, lines=lines)
+        VarInfo(fn=output_fn, type_='i').compile()
+    elif kind == 'mem':
+        generate_mem_info(input_fn, output_fn, lines=lines)
+        MemInfo(fn=output_fn).compile()
+    else:
+        generate_toc_info(input_fn, output_fn, lines=lines)
+        Info(fn=output_fn).compile()
+
+    return output_fn
+
+
+def _read_manifest(fn):
+    try:
+        with open(fn, 'rt') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def generate_settings(profile, ivar_fns=(RAW_TOC_FN, IVAR_FN),
+                      mem_fns=(RAW_MEM_FN, MEM_FN),
+                      toc_fns=(RAW_TOC_FN, TOC_FN), force=False,
+                      workers=None):
+    '''
+    Generate the tsv files of a profile (and their compiled tables) from
+    its raw files, returning the names of the regenerated files
+
+    Each raw file is read once, even if used by several generators.  An
+    output is skipped if the hash of its raw input matches the one
+    recorded in the profile's manifest (generated.json, in the cache
+    directory) when it was last generated (unless force).
+    The remaining generators run in a pool of up to workers processes
+    (defaulting to the number of CPUs).
+    '''
+    profile_path = util.get_profile_path(profile)
+    manifest_fn = generated_filename(os.path.join(profile_path, MANIFEST_FN),
+                                     '.json')
+    manifest = _read_manifest(manifest_fn)
+
+    contents = {}
+    jobs = []
+    digests = {}
+    for kind, (input_fn, output_fn) in (('ivars', ivar_fns),
+                                        ('mem', mem_fns),
+                                        ('toc', toc_fns)):
+        input_fn = os.path.join(profile_path, input_fn)
+        output_fn = os.path.join(profile_path, output_fn)
+        if input_fn not in contents:
+            with open(input_fn, 'rt') as f:
+                contents[input_fn] = f.read()
+
+        digest = hashlib.sha1(('%d %s\n' % (GENERATOR_VERSION, kind)) +
+                              contents[input_fn]).hexdigest()
+
+        name = os.path.basename(output_fn)
+        if (not force and manifest.get(name) == digest and
+                os.path.exists(output_fn) and
+                os.path.exists(compiled_filename(output_fn))):
+            continue
+
+        digests[output_fn] = digest
+        jobs.append((kind, input_fn, output_fn, contents[input_fn]))
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    workers = min(workers, len(jobs))
+    if workers <= 1:
+        generated = [_generate(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            generated = pool.map(_generate, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    if generated:
+        # reload the profile on next use
+        _profiles.pop(profile, None)
+
+        for output_fn in generated:
+            manifest[os.path.basename(output_fn)] = digests[output_fn]
+
+        with _generated_file(manifest_fn, 'wt') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return generated
+
+
+def compile_settings(profile, ivar_fn=IVAR_FN, mem_fn=MEM_FN,
+                     toc_fn=TOC_FN):
+    '''
+    Write the compiled tables (ivars.bin, etc.) of a profile's tsv files,
+    and the search index of its table of contents, to the cache directory
+    '''
+    profile_path = util.get_profile_path(profile)
+
+    VarInfo(fn=os.path.join(profile_path, ivar_fn), type_='i').compile()
+    MemInfo(fn=os.path.join(profile_path, mem_fn)).compile()
+
+    toc_info = Info(fn=os.path.join(profile_path, toc_fn))
+    toc_info.compile()
+    toc_info.save_index()
+
+
+def lookup(text, profile=None):
+    '''
+    [(description, page)] of a variable, memory address or search text;
+    text may also be a util.VarRef or util.Address.  profile defaults to
+    the one of load_settings.
+    '''
+    if profile is not None:
+        return get_profile(profile).lookup(text)
+
+    return _lookup(ivar_info, mem_info, toc_info, text)
+
+
+def _lookup(ivar_info, mem_info, toc_info, text):
+    if isinstance(text, (util.Address, util.VarRef)):
+        ref, text = text, text.text
+    else:
+        text = text.strip()
+        if not text:
+            return []
+
+        if ':$' in text:
+            ref = util.Address.parse(text)
+        else:
+            try:
+                ref = util.VarRef.parse(text)
+            except ValueError:
+                ref = None
+
+    if isinstance(ref, util.Address):
+        try:
+            desc = mem_info[ref][0]
+        except KeyError:
+            pass
+        else:
+            return [(desc, None)]
+    elif ref is not None and ref[0] == 'i':
+        try:
+            desc, category, page = ivar_info[ref]
+        except KeyError:
+            pass
+        else:
+            return [('%s [%s]' % (desc, category), int(page))]
+
+    contents = toc_info
+    return [('%s [%s]' % (desc_, cat_), int(page_))
+            for desc_, (cat_, page_) in contents.search(text)]
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    force = '--force' in args
+    profiles = [arg for arg in args if arg != '--force']
+    if not profiles:
+        print('Usage: %s [--force] profile_name [profile_name ...]' %
+              (sys.argv[0]))
+        sys.exit(1)
+
+    for profile in profiles:
+        generated = generate_settings(profile, force=force)
+        print('%s: %d file(s) regenerated' % (profile, len(generated)))
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# vi: ts=4 sw=4
+"""
+tpmac.mem
+Parses M-variable memory definitions (e.g., Y:$78005,8,16,S) into bit
+fields, and indexes them to find M-variables that alias the same memory
+"""
+
+from __future__ import print_function
+import re
+import sys
+import heapq
+from bisect import (bisect_left, bisect_right)
+from collections import namedtuple
+
+
+WORD_BITS = 24
+
+# a bit field within a single (X or Y) memory space
+MemField = namedtuple('MemField', ['space', 'word', 'bit', 'width'])
+
+# a parsed memory definition: its type (x, y, d, l, f or dp), MemFields and
+# format letter (u, s, d, c or None)
+MemDefinition = namedtuple('MemDefinition', ['type_', 'fields', 'format'])
+
+_addr_re = re.compile(r'^\s*(x|y|d|l|f|dp):\s*(\$?)([0-9a-f]+)\s*((?:,[^,]*)*)$',
+                      flags=re.IGNORECASE)
+
+_formats = set('usdc')
+
+
+def _parse_int(s, hex_):
+    if hex_:
+        return int(s, 16)
+    return int(s)
+
+
+def parse_mvar(value):
+    '''
+    The memory fields that an M-variable definition refers to, as a tuple
+    of MemFields.  Definitions spanning both X and Y memory (D, L, F, DP)
+    give one field per space.  Self-referenced (*) and other non-memory
+    definitions give an empty tuple.
+
+    Raises ValueError on malformed memory definitions.
+    '''
+    definition = parse_definition(value)
+    if definition is None:
+        return ()
+    return definition.fields
+
+
+def parse_definition(value):
+    '''
+    The MemDefinition of an M-variable definition (see parse_mvar), or
+    None for non-memory definitions
+
+    Raises ValueError on malformed memory definitions.
+    '''
+    m = _addr_re.match(value)
+    if not m:
+        return None
+
+    type_, hex_, word, args = m.groups()
+    type_ = type_.lower()
+    word = _parse_int(word, hex_)
+    args = [arg.strip() for arg in args.split(',')[1:]]
+    format_ = None
+    if args and args[-1].lower() in _formats:
+        format_ = args.pop().lower()
+
+    if type_ in ('d', 'l', 'f'):
+        return MemDefinition(type_, (MemField('x', word, 0, WORD_BITS),
+                                     MemField('y', word, 0, WORD_BITS)),
+                             format_)
+    elif type_ == 'dp':
+        # 16-bit dual-ported ram words
+        return MemDefinition(type_, (MemField('x', word, 0, 16),
+                                     MemField('y', word, 0, 16)),
+                             format_)
+
+    try:
+        args = [int(arg) for arg in args]
+    except ValueError:
+        raise ValueError('Invalid memory definition: %s' % value)
+
+    if not args:
+        bit, width = 0, 1
+    elif args[0] == WORD_BITS:
+        # offset 24 is the full word
+        bit, width = 0, WORD_BITS
+    elif len(args) == 1:
+        bit, width = args[0], 1
+    else:
+        bit, width = args[:2]
+
+    # X and Y fields lie within their word; only D and L definitions (above)
+    # span two words, one in each memory space
+    if bit < 0 or width < 1 or bit + width > WORD_BITS:
+        raise ValueError('Invalid bit field: %s' % value)
+
+    return MemDefinition(type_, (MemField(type_, word, bit, width), ),
+                         format_)
+
+
+def field_span(field):
+    '''
+    (start, stop) bit numbers of a field, counting bits continuously across
+    the words of its memory space
+    '''
+    start = field.word * WORD_BITS + field.bit
+    return start, start + field.width
+
+
+class AddressIndex(object):
+    '''
+    Index of memory bit fields for overlap queries
+
+    Each memory space keeps its fields sorted by starting bit.  Fields are
+    at most a word long, so any field overlapping [start, stop) starts
+    within [start - longest, stop), found by bisection: O(log n + k) per
+    query.
+    '''
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._spaces = {}
+        self._starts = {}
+        self._longest = 1
+        self._dirty = False
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, key, value):
+        '''
+        Add the M-variable definition value (a string or MemFields), returned
+        as key by queries.  Returns the fields added.
+        '''
+        if isinstance(value, MemField):
+            fields = (value, )
+        elif isinstance(value, (tuple, list)):
+            fields = value
+        else:
+            fields = parse_mvar(value)
+
+        for field in fields:
+            start, stop = field_span(field)
+            entries = self._spaces.setdefault(field.space, [])
+            entries.append((start, stop, key, field))
+            self._longest = max(self._longest, stop - start)
+
+        if fields:
+            self._count += 1
+            self._dirty = True
+
+        return fields
+
+    def add_config(self, config, name=None):
+        '''
+        Add all M-variables of a TpConfig, keyed by (name, TpVar)
+        '''
+        for tpvar in config.variables['m']:
+            try:
+                self.add((name, tpvar), tpvar.value)
+            except ValueError:
+                pass
+
+    def _sort(self):
+        if self._dirty:
+            self._starts = {}
+            for space, entries in self._spaces.items():
+                entries.sort(key=lambda entry: entry[:2])
+                self._starts[space] = [entry[0] for entry in entries]
+
+            self._dirty = False
+
+    def overlapping(self, value):
+        '''
+        Keys of the fields overlapping an M-variable definition (string or
+        MemFields), each with the overlapping field: [(key, MemField)]
+        '''
+        if isinstance(value, MemField):
+            fields = (value, )
+        elif isinstance(value, (tuple, list)):
+            fields = value
+        else:
+            fields = parse_mvar(value)
+
+        self._sort()
+
+        ret = []
+        seen = set()
+        for field in fields:
+            starts = self._starts.get(field.space)
+            if not starts:
+                continue
+
+            entries = self._spaces[field.space]
+            start, stop = field_span(field)
+            i0 = bisect_right(starts, start - self._longest)
+            i1 = bisect_left(starts, stop)
+            for entry_start, entry_stop, key, entry_field in entries[i0:i1]:
+                if entry_stop > start and (id(key), entry_field) not in seen:
+                    seen.add((id(key), entry_field))
+                    ret.append((key, entry_field))
+
+        return ret
+
+    def aliases(self):
+        '''
+        All pairs of keys whose fields overlap, as (key_a, key_b, space)
+        tuples, in a single sweep over each space: O(n log n + k)
+        '''
+        self._sort()
+
+        ret = []
+        for space, entries in sorted(self._spaces.items()):
+            # (stop, entry number, key) of the fields overlapping this one
+            active = []
+            for i, (start, stop, key, field) in enumerate(entries):
+                while active and active[0][0] <= start:
+                    heapq.heappop(active)
+
+                for active_stop, j, active_key in active:
+                    if active_key is not key:
+                        ret.append((active_key, key, space))
+
+                heapq.heappush(active, (stop, i, key))
+
+        return ret
+
+
+def alias_report(configs):
+    '''
+    Overlapping M-variable definitions across {name: TpConfig}, as lines of
+    text
+    '''
+    index = AddressIndex()
+    for name, config in sorted(configs.items()):
+        index.add_config(config, name=name)
+
+    pairs = {}
+    for (name_a, var_a), (name_b, var_b), space in index.aliases():
+        key = (name_a, var_a.var, name_b, var_b.var)
+        if key not in pairs:
+            pairs[key] = (name_a, var_a, name_b, var_b)
+
+    for key, (name_a, var_a, name_b, var_b) in sorted(pairs.items()):
+        yield '%s:%s->%s overlaps %s:%s->%s' % (name_a, var_a.var_str.upper(),
+                                                var_a.value,
+                                                name_b, var_b.var_str.upper(),
+                                                var_b.value)
+
+
+if __name__ == '__main__':
+    from .conf import load_many
+
+    if len(sys.argv) < 2:
+        print('Usage: %s PMC_FILE [PMC_FILE ...]' % (sys.argv[0]))
+        sys.exit(1)
+
+    fns = sys.argv[1:]
+    configs = dict(zip(fns, load_many(fns, verbose=False)))
+    for line in alias_report(configs):
+        print(line)
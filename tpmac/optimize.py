@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# vi: ts=4 sw=4
+"""
+Usage: tpmac.optimize [-sv] [--max-line=255] INPUT_PMC [OUTPUT]
+
+Produces a minimal download command stream for a Turbo PMAC configuration:
+runs of variables with identical values become range assignments
+(I100..105=0) and assignments are packed several per command line
+
+Arguments:
+    INPUT_PMC          the PMC file to optimize
+    OUTPUT             optionally output to a file (stdout by default)
+
+Options:
+    -s --strides       also use constant-step assignments (I130,8,100=0)
+    -m --max-line=N    maximum command line length [default: 255]
+    -v --verbose       verbose mode
+"""
+
+from __future__ import print_function
+import re
+import sys
+from collections import namedtuple
+
+from docopt import docopt
+
+from .conf import (TpConfig, TpVars, TpVarRange)
+from .comm import (batch_lines, strip_comment, MAX_LINE)
+
+
+OptimizeStats = namedtuple('OptimizeStats', ['commands_before', 'bytes_before',
+                                             'commands_after', 'bytes_after'])
+
+# a variable reference in an expression: P10, or an indexed one, P(P1+1)
+_value_ref_re = re.compile(r'(?<![a-z0-9_])([pmqi])\s*(\d+|\()',
+                           flags=re.IGNORECASE)
+
+
+def _references(type_, value, first, last):
+    '''
+    True if the expression value may reference a variable of type_
+    numbered first to last
+    '''
+    for m in _value_ref_re.finditer(value):
+        ref_type, num = m.groups()
+        if ref_type.lower() == type_ and (num == '(' or
+                                          first <= int(num) <= last):
+            return True
+
+    return False
+
+
+def _assignments(type_, items, strides=False):
+    '''
+    (first variable number, statement) of the shortest statements
+    assigning items, [(variable number, value)] sorted by number
+
+    A run is only collapsed if its value does not reference the variables
+    it assigns: P10=P10+1 P11=P10+1 is not P10..11=P10+1.
+    '''
+    type_upper = type_.upper()
+    eq = '->' if type_ == 'm' else '='
+
+    def single(num, value):
+        return '%s%d%s%s' % (type_upper, num, eq, value)
+
+    ret = []
+    singles = []
+    i = 0
+    while i < len(items):
+        first, value = items[i]
+        j = i
+        while (j + 1 < len(items) and items[j + 1][1] == value and
+               items[j + 1][0] == items[j][0] + 1):
+            j += 1
+
+        last = items[j][0]
+        range_ = '%s%d..%d%s%s' % (type_upper, first, last, eq, value)
+        individual = sum(len(single(num, value)) + 1
+                         for num, value in items[i:j + 1]) - 1
+        if (j > i and len(range_) < individual and
+                not _references(type_, value, first, last)):
+            ret.append((first, range_))
+        else:
+            singles.extend(items[i:j + 1])
+
+        i = j + 1
+
+    if strides:
+        singles = _strides(type_upper, eq, singles, ret)
+
+    ret.extend((num, single(num, value)) for num, value in singles)
+    ret.sort()
+    return ret
+
+
+def _strides(type_upper, eq, singles, ret):
+    # constant-step runs of 3 or more variables with the same value, such as
+    # I130, I230, ... I830: I130,8,100=value.  Returns the remaining singles.
+    by_value = {}
+    for num, value in singles:
+        by_value.setdefault(value, []).append(num)
+
+    remaining = []
+    for value, nums in by_value.items():
+        i = 0
+        while i < len(nums):
+            j = i + 1
+            if j < len(nums):
+                step = nums[j] - nums[i]
+                while j + 1 < len(nums) and nums[j + 1] - nums[j] == step:
+                    j += 1
+
+            count = j - i + 1 if j < len(nums) else 1
+            if count >= 3 and not _references(type_upper.lower(), value,
+                                              nums[i], nums[j]):
+                ret.append((nums[i], '%s%d,%d,%d%s%s' % (type_upper, nums[i],
+                                                        count, step, eq,
+                                                        value)))
+                i = j + 1
+            else:
+                remaining.append((nums[i], value))
+                i += 1
+
+    return remaining
+
+
+def _block_statements(block, config, strides=False):
+    if isinstance(block, TpVars):
+        # collapse the runs in between range assignments, keeping the order
+        # in which dump() sends them
+        items = []
+        for tpvar in block:
+            if isinstance(tpvar, TpVarRange) or not isinstance(tpvar.var, int):
+                for num, statement in _assignments(block.type_, items,
+                                                   strides=strides):
+                    yield statement
+                items = []
+                yield '%s' % tpvar
+            else:
+                items.append((tpvar.var, tpvar.value))
+
+        for num, statement in _assignments(block.type_, items,
+                                           strides=strides):
+            yield statement
+        return
+
+    for text in block.config_str(config):
+        for line in text.split('\n'):
+            line = strip_comment(line)
+            if line:
+                yield line
+
+
+def optimize_config(config, strides=False, max_length=MAX_LINE):
+    '''
+    (commands, OptimizeStats) of a TpConfig
+
+    The commands are equivalent to downloading each line of dump() in
+    turn (after #define substitution, see comm.download_lines): each
+    TpVars block is collapsed separately, so assignments are never moved
+    across other blocks, and program lines are sent one per command as
+    they are.  The stats compare against the commands comm.download sends
+    for dump(), packed the same way; bytes include a terminator per
+    command.
+    '''
+    before = list(batch_lines(config.dump(), max_length=max_length))
+
+    statements = []
+    for block in config.blocks:
+        statements.extend(_block_statements(block, config, strides=strides))
+
+    commands = list(batch_lines(statements, max_length=max_length))
+
+    stats = OptimizeStats(len(before), sum(len(line) + 1 for line in before),
+                          len(commands), sum(len(cmd) + 1 for cmd in commands))
+    return commands, stats
+
+
+def format_stats(stats):
+    commands_before, bytes_before, commands_after, bytes_after = stats
+    return ('%d commands (%d bytes) -> %d commands (%d bytes): '
+            'saved %d commands, %d bytes' %
+            (commands_before, bytes_before, commands_after, bytes_after,
+             commands_before - commands_after, bytes_before - bytes_after))
+
+
+if __name__ == '__main__':
+    opts = docopt(__doc__)
+
+    config = TpConfig(opts['INPUT_PMC'], verbose=bool(opts['--verbose']))
+    for line in config.format_diagnostics():
+        print(line, file=sys.stderr)
+    commands, stats = optimize_config(config, strides=opts['--strides'],
+                                      max_length=int(opts['--max-line']))
+
+    if opts['OUTPUT'] is not None:
+        output_ = open(opts['OUTPUT'], 'wt')
+    else:
+        output_ = sys.stdout
+
+    for command in commands:
+        print(command, file=output_)
+
+    print(format_stats(stats), file=sys.stderr)
@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# vi: ts=4 sw=4
+"""
+tpmac.overlay
+Stacks several TpConfigs (e.g., factory defaults, site includes, machine
+overrides) as layers, later layers taking precedence, without copying or
+re-parsing them
+
+Usage: python -m tpmac.overlay PMC_FILE [PMC_FILE ...]
+    lists the definitions shadowed by later files
+"""
+
+from __future__ import print_function
+import sys
+import heapq
+from bisect import bisect_right
+
+from .conf import (TpCoordSys, TpVarRange)
+from .util import VAR_TYPES
+
+
+def make_key(key):
+    '''
+    Definition key from a variable name ('P100' -> ('p', 100)), or a key
+    tuple as is: ('p', 100), ('plc', 3) or ('coord', (coord sys, motor))
+    '''
+    if isinstance(key, tuple):
+        return key
+
+    key = key.strip().lower()
+    return (key[0], int(key[1:]))
+
+
+def key_str(key):
+    type_, num = key
+    if type_ == 'plc':
+        return 'PLC %d' % num
+    elif type_ == 'coord':
+        return '&%d #%d' % num
+
+    return '%s%d' % (type_.upper(), num)
+
+
+def config_definitions(config):
+    '''
+    The effective definitions of a single TpConfig: {key: object}, where
+    the object is a TpVar, TpPlcBlock or TpCoord
+    '''
+    defs = {}
+    for type_, tpvars in config.variables.items():
+        for tpvar in tpvars:
+            if not isinstance(tpvar, TpVarRange):
+                defs[(type_, tpvar.var)] = tpvar
+
+    for number, plc in config.plcs.items():
+        defs[('plc', number)] = plc
+
+    for block in config.blocks:
+        if isinstance(block, TpCoordSys):
+            for motor, coord in block.coords.items():
+                defs[('coord', (block.coord_sys, motor))] = coord
+
+    return defs
+
+
+def _range_segments(ranges):
+    '''
+    (starts, ranges) of the disjoint segments [starts[i], starts[i + 1])
+    covered by the range assignments of one variable type, each with the
+    range assignment effective there (the last one covering it), or None
+    '''
+    events = sorted(set([var_range.first for var_range in ranges] +
+                        [var_range.last + 1 for var_range in ranges]))
+    by_first = sorted((var_range.first, order, var_range)
+                      for order, var_range in enumerate(ranges)
+                      if var_range.first <= var_range.last)
+
+    starts = []
+    winners = []
+    active = []
+    i = 0
+    for point in events:
+        while i < len(by_first) and by_first[i][0] <= point:
+            first, order, var_range = by_first[i]
+            heapq.heappush(active, (-order, var_range))
+            i += 1
+
+        # ranges ending before point are dropped once they come to the top
+        while active and active[0][1].last < point:
+            heapq.heappop(active)
+
+        winner = active[0][1] if active else None
+        if not winners or winners[-1] is not winner:
+            starts.append(point)
+            winners.append(winner)
+
+    return starts, winners
+
+
+class _Layer(object):
+    __slots__ = ('name', 'config', 'defs', 'ranges')
+
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+        self.defs = config_definitions(config)
+        # {type: range segments} of the types with range assignments
+        self.ranges = {}
+        for type_ in VAR_TYPES:
+            ranges = config.variables[type_].ranges
+            if ranges:
+                self.ranges[type_] = _range_segments(ranges)
+
+    def range_for(self, type_, num):
+        # the range assignment covering variable num, or None
+        try:
+            starts, winners = self.ranges[type_]
+        except KeyError:
+            return None
+
+        i = bisect_right(starts, num) - 1
+        if i < 0:
+            return None
+        return winners[i]
+
+
+class TpOverlay(object):
+    '''
+    Ordered stack of TpConfig layers
+
+    Every definition key maps to the list of (layer, object) defining it,
+    bottom to top, so the effective definition is the last entry.  Range
+    assignments are kept per layer as disjoint segments, so a variable
+    lookup also takes a bisection for each layer above the defining one
+    which has range assignments; other lookups take O(1).
+    Keys defined by more than one layer are tracked as they are
+    added, making the shadowed definition report proportional to the
+    number of shadowed keys only.  Adding, removing or replacing a layer
+    touches only the keys of that layer.
+
+    Range assignments (M0..8191->*) apply to variables with no individual
+    definition in a higher layer.
+    '''
+    def __init__(self, layers=()):
+        self._layers = []
+        self._positions = {}
+        self._range_positions = []
+        self._defs = {}
+        self._shadowed = set()
+        for name, config in layers:
+            self.add_layer(name, config)
+
+    def __len__(self):
+        return len(self._layers)
+
+    @property
+    def names(self):
+        return [layer.name for layer in self._layers]
+
+    def _find(self, name):
+        for i, layer in enumerate(self._layers):
+            if layer.name == name:
+                return i
+
+        raise KeyError(name)
+
+    def layer(self, name):
+        return self._layers[self._find(name)].config
+
+    def _position(self, layer):
+        return self._positions[layer]
+
+    def _update_positions(self):
+        self._positions = dict((layer, i)
+                               for i, layer in enumerate(self._layers))
+        # positions of the layers with range assignments, bottom to top
+        self._range_positions = [i for i, layer in enumerate(self._layers)
+                                 if layer.ranges]
+
+    def add_layer(self, name, config, index=None):
+        '''
+        Add a layer on top of the stack, or below the layer at index
+        '''
+        if name in self.names:
+            raise ValueError('Layer already exists: %s' % name)
+
+        layer = _Layer(name, config)
+        if index is None or index >= len(self._layers):
+            self._layers.append(layer)
+            on_top = True
+        else:
+            self._layers.insert(index, layer)
+            on_top = False
+
+        self._update_positions()
+
+        all_defs = self._defs
+        shadowed = self._shadowed
+        for key, obj in layer.defs.items():
+            entries = all_defs.get(key)
+            if entries is None:
+                all_defs[key] = [(layer, obj)]
+                continue
+
+            if on_top:
+                entries.append((layer, obj))
+            else:
+                position = self._position(layer)
+                i = len(entries)
+                while i > 0 and self._position(entries[i - 1][0]) > position:
+                    i -= 1
+                entries.insert(i, (layer, obj))
+
+            shadowed.add(key)
+
+    def remove_layer(self, name):
+        '''
+        Remove a layer, returning its TpConfig
+        '''
+        layer = self._layers.pop(self._find(name))
+        self._update_positions()
+
+        all_defs = self._defs
+        for key in layer.defs:
+            entries = all_defs[key]
+            entries[:] = [entry for entry in entries if entry[0] is not layer]
+            if not entries:
+                del all_defs[key]
+            elif len(entries) == 1:
+                self._shadowed.discard(key)
+
+        return layer.config
+
+    def replace_layer(self, name, config=None):
+        '''
+        Replace the configuration of a layer in place, keeping its position
+        (config=None re-reads the definitions of the current configuration,
+        e.g. after TpConfig.update_lines)
+        '''
+        index = self._find(name)
+        old_config = self.remove_layer(name)
+        if config is None:
+            config = old_config
+
+        self.add_layer(name, config, index=index)
+
+    def _range_for(self, key, above):
+        # the topmost range assignment covering key, from a layer above
+        # position `above`
+        type_, num = key
+        for position in reversed(self._range_positions):
+            if position <= above:
+                break
+
+            layer = self._layers[position]
+            var_range = layer.range_for(type_, num)
+            if var_range is not None:
+                return layer, var_range
+
+    def resolve(self, key):
+        '''
+        (effective definition, source layer name) of a key, or KeyError
+        '''
+        key = make_key(key)
+        entries = self._defs.get(key)
+        if entries:
+            layer, obj = entries[-1]
+        else:
+            layer = obj = None
+
+        if key[0] in VAR_TYPES:
+            above = -1 if layer is None else self._position(layer)
+            found = self._range_for(key, above)
+            if found is not None:
+                layer, obj = found
+
+        if layer is None:
+            raise KeyError(key)
+
+        return obj, layer.name
+
+    def __getitem__(self, key):
+        return self.resolve(key)[0]
+
+    def __contains__(self, key):
+        try:
+            self.resolve(key)
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self.resolve(key)[0]
+        except KeyError:
+            return default
+
+    def source(self, key):
+        '''
+        Name of the layer providing the effective definition of key
+        '''
+        return self.resolve(key)[1]
+
+    def definitions(self, key):
+        '''
+        All individual definitions of key as [(layer name, object)], bottom
+        to top
+        '''
+        return [(layer.name, obj)
+                for layer, obj in self._defs.get(make_key(key), [])]
+
+    def keys(self):
+        return self._defs.keys()
+
+    def shadowed(self):
+        '''
+        Keys defined individually in more than one layer, with their
+        definitions: [(key, [(layer name, object)])], sorted by key.  The
+        last definition of each is the effective one.  (Variables covered
+        by a range assignment in a higher layer are not included.)
+        '''
+        return [(key, self.definitions(key))
+                for key in sorted(self._shadowed)]
+
+    def shadowed_report(self):
+        '''
+        Lines of text describing the shadowed definitions
+        '''
+        for key, defs in self.shadowed():
+            name, obj = defs[-1]
+            yield '%s: %s (%s)' % (key_str(key), _def_str(obj), name)
+            for name, obj in reversed(defs[:-1]):
+                yield '    shadows %s (%s)' % (_def_str(obj), name)
+
+
+def _def_str(obj):
+    if hasattr(obj, 'lines'):
+        # plc
+        return '%d lines' % len(obj.lines)
+    elif hasattr(obj, 'axis'):
+        return obj.axis
+
+    return '%s' % obj
+
+
+if __name__ == '__main__':
+    from .conf import load_many
+
+    if len(sys.argv) < 2:
+        print('Usage: %s PMC_FILE [PMC_FILE ...]' % (sys.argv[0]))
+        sys.exit(1)
+
+    fns = sys.argv[1:]
+    overlay = TpOverlay(zip(fns, load_many(fns, verbose=False)))
+    for line in overlay.shadowed_report():
+        print(line)
@@ -0,0 +1,702 @@
+#!/usr/bin/env python
+# vi: ts=4 sw=4
+"""
+Usage: tpmac.plcsim [-v] [--scans=1000] [--scan-time=1.0] [--define=DEF...] INPUT_PMC
+
+Runs the PLCs of a Turbo PMAC configuration file offline, against an
+in-memory variable store
+
+Arguments:
+    INPUT_PMC          the PMC file with the PLCs to run
+
+Options:
+    -n --scans=N       number of background scans to run [default: 1000]
+    -t --scan-time=MS  simulated time per scan, in milliseconds [default: 1.0]
+    -D --define=DEF    additional #define, as NAME=VALUE
+    -v --verbose       print the compiled code of each PLC
+"""
+
+from __future__ import print_function
+import re
+import sys
+import math
+
+from docopt import docopt
+
+from . import util
+
+
+# PMAC servo clock: I10 is the servo interrupt time in 1/8388608 msec
+SERVO_CLOCK = 8388608.0
+DEFAULT_I10 = 3713991
+
+# servo IC timer registers, counting down once per servo cycle
+TIMERS = ('i6612', 'i6613', 'i6712', 'i6713',
+          'i6812', 'i6813', 'i6912', 'i6913')
+
+
+class PlcError(Exception):
+    pass
+
+
+class PlcCompileError(PlcError):
+    pass
+
+
+_token_re = re.compile(r'''\s*(?:
+    (?P<string>"[^"]*")
+  | (?P<number>\$[0-9a-f]+|(?:\d+(?:\.(?!\.)\d*)?|\.\d+)(?:e[-+]?\d+)?)
+  | (?P<var>[pmqi])(?=\s*[\d(])
+  | (?P<word>[a-z_][a-z0-9_]*)
+  | (?P<op>\.\.|!=|<>|!<|!>|!~|<=|>=|[-+*/%&|^()=<>,~])
+  )''', flags=re.IGNORECASE | re.VERBOSE)
+
+# python expression of each relational operator, given a and b
+_relations = {'=': '%s == %s',
+              '!=': '%s != %s',
+              '<>': '%s != %s',
+              '<': '%s < %s',
+              '>': '%s > %s',
+              '<=': '%s <= %s',
+              '>=': '%s >= %s',
+              '!>': '%s <= %s',
+              '!<': '%s >= %s',
+              '~': 'abs(%s - %s) <= 1.0',
+              '!~': 'abs(%s - %s) > 1.0',
+              }
+
+_add_ops = {'+': '(%s + %s)',
+            '-': '(%s - %s)',
+            '|': '_bor(%s, %s)',
+            '^': '_bxor(%s, %s)',
+            }
+
+_mul_ops = {'*': '(%s * %s)',
+            '/': '(%s / %s)',
+            '%': '_mod(%s, %s)',
+            '&': '_band(%s, %s)',
+            }
+
+# angles in degrees (I15=0)
+_functions = {'sin': lambda x: math.sin(math.radians(x)),
+              'cos': lambda x: math.cos(math.radians(x)),
+              'tan': lambda x: math.tan(math.radians(x)),
+              'asin': lambda x: math.degrees(math.asin(x)),
+              'acos': lambda x: math.degrees(math.acos(x)),
+              'atan': lambda x: math.degrees(math.atan(x)),
+              'atan2': lambda y, x: math.degrees(math.atan2(y, x)),
+              'ln': math.log,
+              'exp': math.exp,
+              'sqrt': math.sqrt,
+              'abs': abs,
+              'int': lambda x: float(math.floor(x)),
+              }
+
+_runtime = {'_key': lambda type_, num: '%s%d' % (type_, int(num)),
+            '_band': lambda a, b: float(int(a) & int(b)),
+            '_bor': lambda a, b: float(int(a) | int(b)),
+            '_bxor': lambda a, b: float(int(a) ^ int(b)),
+            '_mod': math.fmod,
+            }
+for _name, _func in _functions.items():
+    _runtime['_f_%s' % _name] = _func
+
+
+def strip_comment(line):
+    '''
+    A PLC line without its // comment (outside of quotes)
+    '''
+    if '//' not in line:
+        return line
+
+    in_quotes = False
+    for i, c in enumerate(line):
+        if c == '"':
+            in_quotes = not in_quotes
+        elif not in_quotes and line.startswith('//', i):
+            return line[:i]
+
+    return line
+
+
+def config_defines(config):
+    '''
+    {name: value} of the #define lines in a TpConfig
+    '''
+    defines = {}
+    for block in config.blocks:
+        for line, comment in getattr(block, 'lines', []):
+            m = util.DEFINE_RE.match(strip_comment(line))
+            if m:
+                name, value = m.groups()
+                defines[name] = value.strip()
+
+    return defines
+
+
+def tokenize(lines, defines=None):
+    '''
+    [(kind, value, line index)] of PLC source lines, after #define
+    substitution; words are lowercase
+    '''
+    substitute = util.define_substitution(defines)
+
+    tokens = []
+    for line_idx, line in enumerate(lines):
+        line = strip_comment(line)
+        if substitute is not None:
+            line = substitute(line)
+
+        pos = 0
+        end = len(line.rstrip())
+        while pos < end:
+            m = _token_re.match(line, pos)
+            if not m or m.end() == pos:
+                raise PlcCompileError('Line %d: unexpected %r' %
+                                      (line_idx + 1, line[pos:].strip()))
+
+            kind = m.lastgroup
+            value = m.group(kind)
+            if kind in ('var', 'word'):
+                value = value.lower()
+            tokens.append((kind, value, line_idx))
+            pos = m.end()
+
+    return tokens
+
+
+class _Parser(object):
+    '''
+    Recursive descent parser from PLC tokens to the lines of a python
+    generator function body, yielding at the end of each scan
+    '''
+    block_ends = {'if': ('endif', 'endi', 'else'),
+                  'else': ('endif', 'endi'),
+                  'while': ('endwhile', 'endw'),
+                  }
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+        self.warnings = []
+
+    def peek(self, offset=0):
+        try:
+            return self.tokens[self.pos + offset]
+        except IndexError:
+            return (None, None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise PlcCompileError('Unexpected end of PLC')
+        self.pos += 1
+        return token
+
+    def error(self, message, token=None):
+        if token is None:
+            token = self.peek()
+        if token[2] is None:
+            return PlcCompileError(message)
+        return PlcCompileError('Line %d: %s' % (token[2] + 1, message))
+
+    def expect(self, kind, value=None):
+        token = self.next()
+        if token[0] != kind or (value is not None and token[1] != value):
+            raise self.error('expected %s, got %r' % (value or kind, token[1]),
+                             token)
+        return token
+
+    def is_word(self, *words):
+        kind, value, line = self.peek()
+        return kind == 'word' and value in words
+
+    def same_line(self, line):
+        return self.peek()[2] == line
+
+    # expressions
+    def var_ref(self):
+        kind, type_, line = self.expect('var')
+        kind, value, line = self.peek()
+        if kind == 'number' and not value.startswith('$'):
+            self.next()
+            return "v['%s%d']" % (type_, int(float(value)))
+
+        self.expect('op', '(')
+        index = self.expr()
+        self.expect('op', ')')
+        return "v[_key('%s', %s)]" % (type_, index)
+
+    def primary(self):
+        kind, value, line = self.peek()
+        if kind == 'number':
+            self.next()
+            if value.startswith('$'):
+                return repr(float(int(value[1:], 16)))
+            return repr(float(value))
+        elif kind == 'var':
+            return self.var_ref()
+        elif kind == 'op' and value == '(':
+            self.next()
+            ret = self.expr()
+            self.expect('op', ')')
+            return ret
+        elif kind == 'word' and value in _functions:
+            self.next()
+            self.expect('op', '(')
+            args = [self.expr()]
+            while self.peek()[:2] == ('op', ','):
+                self.next()
+                args.append(self.expr())
+            self.expect('op', ')')
+            return '_f_%s(%s)' % (value, ', '.join(args))
+
+        if kind is None:
+            raise self.error('unexpected end of PLC')
+        raise self.error('unexpected %r in expression' % (value, ))
+
+    def unary(self):
+        kind, value, line = self.peek()
+        if kind == 'op' and value in ('-', '+'):
+            self.next()
+            return '(%s%s)' % (value, self.unary())
+        return self.primary()
+
+    def term(self):
+        ret = self.unary()
+        while True:
+            kind, value, line = self.peek()
+            if kind != 'op' or value not in _mul_ops:
+                return ret
+            self.next()
+            ret = _mul_ops[value] % (ret, self.unary())
+
+    def expr(self):
+        ret = self.term()
+        while True:
+            kind, value, line = self.peek()
+            if kind != 'op' or value not in _add_ops:
+                return ret
+            self.next()
+            ret = _add_ops[value] % (ret, self.term())
+
+    # conditions
+    def comparison(self):
+        start = self.pos
+        try:
+            left = self.expr()
+            kind, op, line = self.next()
+            if kind != 'op' or op not in _relations:
+                raise self.error('expected a comparison')
+            return _relations[op] % (left, self.expr())
+        except PlcCompileError:
+            if self.tokens[start][:2] != ('op', '('):
+                raise
+
+        # a parenthesized condition
+        self.pos = start + 1
+        ret = self.condition()
+        self.expect('op', ')')
+        return '(%s)' % ret
+
+    def and_condition(self):
+        ret = self.comparison()
+        while self.is_word('and'):
+            self.next()
+            ret = '%s and %s' % (ret, self.comparison())
+        return ret
+
+    def condition(self):
+        ret = self.and_condition()
+        while self.is_word('or'):
+            self.next()
+            ret = '%s or %s' % (ret, self.and_condition())
+        return ret
+
+    def full_condition(self):
+        # IF/WHILE conditions may continue on following lines, each
+        # beginning with AND or OR
+        ret = self.condition()
+        while self.is_word('and', 'or') and self.peek(1)[:2] == ('op', '('):
+            word = self.next()[1]
+            ret = '(%s) %s (%s)' % (ret, word, self.condition())
+        return ret
+
+    # statements
+    def block(self, ends):
+        lines = []
+        while True:
+            kind, value, line = self.peek()
+            if kind is None:
+                raise self.error('missing %s' % ends[0].upper())
+            if kind == 'word' and value in ends:
+                return lines
+            lines.extend(self.statement())
+
+    def rest_of_line(self, line):
+        lines = []
+        while self.same_line(line):
+            lines.extend(self.statement())
+        return lines
+
+    def statement(self):
+        kind, value, line = self.peek()
+        if kind == 'var':
+            target = self.var_ref()
+            self.expect('op', '=')
+            return ['%s = %s' % (target, self.expr())]
+        elif kind != 'word':
+            raise self.error('unexpected %r' % (value, ))
+
+        handler = getattr(self, '_stmt_%s' % value, None)
+        if handler is None:
+            return self._stmt_unsupported()
+        return handler()
+
+    def _stmt_unsupported(self):
+        kind, value, line = self.next()
+        return self._skip_line(value, line)
+
+    def _skip_line(self, value, line):
+        # the rest of the line is ignored, with a warning
+        words = [value]
+        while self.same_line(line):
+            words.append(self.next()[1])
+
+        self.warnings.append('Line %d: unsupported statement ignored: %s' %
+                             (line + 1, ' '.join(words)))
+        return []
+
+    def _stmt_if(self):
+        kind, value, line = self.next()
+        cond = self.full_condition()
+        if self.same_line(self.tokens[self.pos - 1][2]):
+            # single-line IF
+            body = self.rest_of_line(self.tokens[self.pos - 1][2])
+            return ['if %s:' % cond] + _indent(body)
+
+        body = self.block(self.block_ends['if'])
+        ret = ['if %s:' % cond] + _indent(body)
+        if self.is_word('else'):
+            self.next()
+            ret.append('else:')
+            ret.extend(_indent(self.block(self.block_ends['else'])))
+
+        self.next()
+        return ret
+
+    def _stmt_while(self):
+        kind, value, line = self.next()
+        cond = self.full_condition()
+        cond_line = self.tokens[self.pos - 1][2]
+        if self.same_line(cond_line) and not self.is_word(*self.block_ends['while']):
+            # single-line WHILE
+            body = self.rest_of_line(cond_line)
+        else:
+            body = self.block(self.block_ends['while'])
+            self.next()
+
+        # the PLC scan ends at each ENDWHILE, resuming at the WHILE
+        return ['while %s:' % cond] + _indent(body + ['yield'])
+
+    def _stmt_cmd(self, func='_cmd'):
+        kind, value, line = self.next()
+        if self.peek()[0] != 'string':
+            return self._skip_line(value, line)
+
+        text = self.next()[1][1:-1]
+        return ['%s(%r)' % (func, text)]
+
+    def _stmt_send(self):
+        return self._stmt_cmd(func='_send')
+
+    _stmt_sends = _stmt_sendp = _stmt_send
+
+    def _plc_list(self):
+        numbers = []
+        while True:
+            first = int(self.expect('number')[1])
+            if self.peek()[:2] == ('op', '..'):
+                self.next()
+                last = int(self.expect('number')[1])
+                numbers.extend(range(first, last + 1))
+            else:
+                numbers.append(first)
+
+            if self.peek()[:2] != ('op', ','):
+                return numbers
+            self.next()
+
+    def _stmt_enable(self, enable=True):
+        kind, value, line = self.next()
+        if not self.is_word('plc'):
+            return self._skip_line(value, line)
+
+        self.next()
+        return ['_enable(%s, %r)' % (enable, tuple(self._plc_list()))]
+
+    def _stmt_disable(self):
+        return self._stmt_enable(enable=False)
+
+    def _stmt_else(self):
+        raise self.error('ELSE without IF')
+
+    def _stmt_endif(self):
+        raise self.error('ENDIF without IF')
+
+    def _stmt_endwhile(self):
+        raise self.error('ENDWHILE without WHILE')
+
+    _stmt_endi = _stmt_endif
+    _stmt_endw = _stmt_endwhile
+
+    def program(self):
+        lines = []
+        while self.peek()[0] is not None:
+            lines.extend(self.statement())
+        return lines
+
+
+def _indent(lines):
+    if not lines:
+        return ['    pass']
+    return ['    %s' % line for line in lines]
+
+
+class CompiledPlc(object):
+    '''
+    A TpPlcBlock compiled once into a python generator function; each
+    next() on the generator is one scan of the PLC
+
+    Attributes:
+        number: PLC number
+        source: the generated python source
+        warnings: statements that were ignored
+    '''
+    def __init__(self, plc, defines=None):
+        self.number = plc.number
+
+        lines = [line for line, comment in plc]
+        parser = _Parser(tokenize(lines, defines))
+        body = parser.program()
+        self.warnings = parser.warnings
+
+        self.source = '\n'.join(['def _plc(v, _cmd, _send, _enable):',
+                                 '    while True:'] +
+                                _indent(_indent(body + ['yield'])))
+
+        namespace = dict(_runtime)
+        code = compile(self.source, '<plc %d>' % self.number, 'exec')
+        exec(code, namespace)
+        self._func = namespace['_plc']
+
+    def start(self, variables, cmd, send, enable):
+        '''
+        A new generator running the PLC from the top
+        '''
+        return self._func(variables, cmd, send, enable)
+
+
+def compile_plc(plc, defines=None):
+    return CompiledPlc(plc, defines=defines)
+
+
+class VarStore(dict):
+    '''
+    Variable values keyed by lowercase name ('p1', 'i10'); undefined
+    variables read as 0
+    '''
+    def __missing__(self, key):
+        return 0.0
+
+
+class PlcSimulator(object):
+    '''
+    Runs compiled PLCs round-robin, one scan of each enabled PLC (in number
+    order) per background cycle, as Turbo PMAC does
+
+    Each background cycle advances simulated time by scan_time msec and
+    counts down the servo IC timers (e.g., I6612, used by timer32/msec32
+    waits) by the servo cycles elapsed, based on I10.
+
+    CMD"..." and SEND"..." strings are recorded in commands and sends as
+    (PLC number, text); CMD"ENABLE PLC n" and CMD"DISABLE PLC n" take
+    effect, and cmd_handler(plc number, text), if given, is called for
+    each command.
+    '''
+    def __init__(self, plcs=(), variables=None, defines=None, scan_time=1.0,
+                 cmd_handler=None):
+        self.variables = VarStore()
+        self.variables['i10'] = float(DEFAULT_I10)
+        if variables:
+            self.variables.update(variables)
+
+        self.defines = dict(defines or {})
+        self.scan_time = float(scan_time)
+        self.cmd_handler = cmd_handler
+
+        self.programs = {}
+        self.enabled = set()
+        self.commands = []
+        self.sends = []
+        self.scans = 0
+        self.time = 0.0
+
+        self._gens = {}
+        self._order = []
+        self._current = None
+
+        for plc in plcs:
+            self.load(plc)
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        '''
+        A simulator running the PLCs of a TpConfig, with its numeric P, Q
+        and I variable assignments and #defines
+        '''
+        variables = {}
+        for type_ in ('p', 'q', 'i'):
+            for tpvar in config.variables[type_]:
+                try:
+                    value = _parse_number(tpvar.value)
+                except ValueError:
+                    continue
+
+                if hasattr(tpvar, 'first'):
+                    for num in range(tpvar.first, tpvar.last + 1):
+                        variables['%s%d' % (type_, num)] = value
+                else:
+                    variables['%s%d' % (type_, tpvar.var)] = value
+
+        variables.update(kwargs.pop('variables', None) or {})
+
+        defines = config_defines(config)
+        defines.update(kwargs.pop('defines', None) or {})
+
+        return cls(plcs=[plc for num, plc in sorted(config.plcs.items())],
+                   variables=variables, defines=defines, **kwargs)
+
+    def load(self, plc, enable=True):
+        '''
+        Compile and load a TpPlcBlock, replacing any PLC of the same number
+        '''
+        compiled = CompiledPlc(plc, defines=self.defines)
+        self.programs[compiled.number] = compiled
+        self._gens.pop(compiled.number, None)
+        self.enable(compiled.number, enable)
+        return compiled
+
+    def enable(self, number, enable=True):
+        if enable:
+            if number not in self.programs:
+                return
+            # enabling restarts a PLC from the top
+            self._gens[number] = self.programs[number].start(
+                self.variables, self._cmd, self._send, self._enable)
+            self.enabled.add(number)
+        else:
+            self.enabled.discard(number)
+
+        self._order = sorted(self.enabled)
+
+    def _enable(self, enable, numbers):
+        for number in numbers:
+            if enable != (number in self.enabled):
+                self.enable(number, enable)
+
+    def _cmd(self, text):
+        self.commands.append((self._current, text))
+
+        words = text.lower().split()
+        if len(words) == 3 and words[0] in ('enable', 'disable') and \
+                words[1] == 'plc' and words[2].isdigit():
+            self._enable(words[0] == 'enable', [int(words[2])])
+
+        if self.cmd_handler is not None:
+            self.cmd_handler(self._current, text)
+
+    def _send(self, text):
+        self.sends.append((self._current, text))
+
+    def scan(self):
+        '''
+        One background cycle: a scan of each enabled PLC
+        '''
+        gens = self._gens
+        for number in self._order:
+            if number not in self.enabled:
+                # disabled earlier in this cycle
+                continue
+
+            self._current = number
+            try:
+                next(gens[number])
+            except Exception as ex:
+                raise PlcError('PLC %d: %s: %s' % (number,
+                                                   ex.__class__.__name__, ex))
+
+        self._current = None
+        self.scans += 1
+        self.time += self.scan_time
+
+        variables = self.variables
+        cycles = self.scan_time * SERVO_CLOCK / variables['i10']
+        for timer in TIMERS:
+            if timer in variables:
+                variables[timer] -= cycles
+
+    def run(self, scans):
+        for i in range(scans):
+            self.scan()
+
+    def run_until(self, condition, max_scans=100000):
+        '''
+        Scan until condition(simulator) is true; returns the number of scans
+        run, or None if max_scans was reached first
+        '''
+        for i in range(max_scans):
+            if condition(self):
+                return i
+            self.scan()
+
+        if condition(self):
+            return max_scans
+
+
+def _parse_number(value):
+    value = value.strip()
+    if value.startswith('$'):
+        return float(int(value[1:], 16))
+    return float(value)
+
+
+if __name__ == '__main__':
+    import time
+    from .conf import TpConfig
+
+    opts = docopt(__doc__)
+
+    config = TpConfig(opts['INPUT_PMC'], verbose=False)
+    defines = dict(define.split('=', 1) for define in opts['--define'])
+    sim = PlcSimulator.from_config(config, defines=defines,
+                                   scan_time=float(opts['--scan-time']))
+
+    for number, compiled in sorted(sim.programs.items()):
+        for warning in compiled.warnings:
+            print('PLC %d: %s' % (number, warning), file=sys.stderr)
+        if opts['--verbose']:
+            print('# PLC %d' % number)
+            print(compiled.source)
+
+    scans = int(opts['--scans'])
+    t0 = time.time()
+    sim.run(scans)
+    elapsed = time.time() - t0
+
+    for number, text in sim.commands:
+        print('PLC %d: CMD"%s"' % (number, text))
+
+    print('%d scans in %.3fs (%.0f scans/s); enabled PLCs: %s' %
+          (scans, elapsed, scans / max(elapsed, 1e-9),
+           ', '.join(str(num) for num in sorted(sim.enabled)) or 'none'))
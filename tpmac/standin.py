@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# vi: ts=4 sw=4
+"""
+Usage: tpmac.standin [--host=127.0.0.1] [--port=1025]
+
+A local stand-in for a Turbo PMAC Ethernet ASCII command interface, for
+testing and benchmarking tpmac.comm without a controller
+
+Options:
+    -H --host=HOST     address to listen on [default: 127.0.0.1]
+    -p --port=PORT     port to listen on [default: 1025]
+"""
+
+from __future__ import print_function
+import re
+import socket
+import threading
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+from docopt import docopt
+
+from .comm import (HEADER, ACK, BELL, VR_PMAC_GETRESPONSE, VR_PMAC_SENDLINE)
+
+
+_stmt_re = re.compile(r'''\s*(?:
+    (?P<define>m(?P<d_first>\d+)(?:\.\.(?P<d_last>\d+))?\s*->\s*(?P<d_value>\S*))
+  | (?P<assign>(?P<a_type>[pmqi])(?P<a_first>\d+)(?:\.\.(?P<a_last>\d+))?
+               \s*=\s*(?P<a_value>\S+))
+  | (?P<query>(?P<q_type>[pmqi])(?P<q_first>\d+)(?:\.\.(?P<q_last>\d+))?)(?![\w(])
+  | (?P<open>open\s+plc\s*(?P<plc>\d+))
+  | (?P<close>close)(?!\w)
+  | (?P<other>"[^"]*"|[^\s"]+)
+  )''', flags=re.IGNORECASE | re.VERBOSE)
+
+_close_re = re.compile(r'\s*close(?!\w)', flags=re.IGNORECASE)
+
+# tokens starting with these are rejected with ERR003 (unrecognized)
+_invalid_start = set('@`{}\\')
+
+_number_re = re.compile(r'^-?(\d+\.?\d*|\.\d+)(e[-+]?\d+)?$', flags=re.IGNORECASE)
+
+
+def _normalize_value(value):
+    # numeric values are replied in decimal, as with I9=0
+    if value.startswith('$'):
+        try:
+            return '%d' % int(value[1:], 16)
+        except ValueError:
+            return value
+    elif _number_re.match(value):
+        number = float(value)
+        if number == int(number):
+            return '%d' % number
+        return '%.10g' % number
+
+    # expressions are stored, not evaluated
+    return value
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        server = self.server
+        while True:
+            header = self.rfile.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+
+            request_type, request, value, index, length = HEADER.unpack(header)
+            data = self.rfile.read(length)
+
+            if request == VR_PMAC_GETRESPONSE:
+                self.wfile.write(server.execute(data.decode('ascii')))
+            elif request == VR_PMAC_SENDLINE:
+                server.execute(data.decode('ascii'))
+                self.wfile.write(ACK)
+            else:
+                # flush and other single byte acknowledgements
+                self.wfile.write(b'@')
+
+
+class PmacStandIn(socketserver.ThreadingMixIn, socketserver.TCPServer,
+                  object):
+    '''
+    Emulates the command replies and the I/P/Q/M variable storage of a
+    Turbo PMAC, over the same Ethernet protocol (GETRESPONSE, SENDLINE and
+    FLUSH requests)
+
+    Supported commands, several per line as on the controller:
+        P1=5, I100..105=0   assignments (expressions are stored as text)
+        P1, I100..105       queries, replying each value
+        M1->Y:$78005,8      M-variable definitions; M1-> queries them
+        OPEN PLC n ... CLOSE  lines in between are stored in plcs[n]
+    Other commands are accepted without a reply.
+
+    Program lines are stored as received, one entry per command line, so
+    that the line structure of a download can be checked (see
+    mismatched_plcs).
+
+    Attributes:
+        variables: {'p1': value text}
+        plcs: {number: [lines]}
+        commands: number of command lines executed
+    '''
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0)):
+        socketserver.TCPServer.__init__(self, address, _Handler)
+        self.variables = {}
+        self.plcs = {}
+        self.commands = 0
+        self._open_plc = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def address(self):
+        return self.server_address[:2]
+
+    def serve_in_thread(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self._thread
+
+    def shutdown(self):
+        socketserver.TCPServer.shutdown(self)
+        self.server_close()
+
+    def execute(self, command):
+        '''
+        The response to a command line: replies followed by ACK, or an
+        error (BELL ERRnnn CR)
+        '''
+        with self._lock:
+            self.commands += 1
+            replies = []
+            try:
+                for line in command.split('\r'):
+                    self._execute(line, replies)
+            except ValueError:
+                return BELL + b'ERR003\r'
+
+        replies.append('')
+        return '\r'.join(replies).encode('ascii') + ACK
+
+    def _execute(self, command, replies):
+        variables = self.variables
+        pos = 0
+        end = len(command.rstrip())
+        while pos < end:
+            if self._open_plc is not None:
+                # buffered program lines, up to CLOSE
+                m = _close_re.search(command, pos)
+                text = command[pos:m.start() if m else end].strip()
+                lines = self.plcs[self._open_plc]
+                if text[:5].lower() == 'clear':
+                    # OPEN PLC n CLEAR
+                    del lines[:]
+                    text = text[5:].strip()
+                if text:
+                    lines.append(text)
+
+                if m is None:
+                    return
+
+                self._open_plc = None
+                pos = m.end()
+                continue
+
+            m = _stmt_re.match(command, pos)
+            if m is None or m.end() == pos:
+                raise ValueError(command[pos:])
+            pos = m.end()
+
+            kind = m.lastgroup
+            if kind == 'define':
+                first, last, value = m.group('d_first', 'd_last', 'd_value')
+                keys = self._keys('md', first, last)
+                if value:
+                    for key in keys:
+                        variables[key] = value
+                else:
+                    replies.extend(variables.get(key, '') for key in keys)
+
+            elif kind == 'assign':
+                type_, first, last, value = m.group('a_type', 'a_first',
+                                                    'a_last', 'a_value')
+                value = _normalize_value(value)
+                for key in self._keys(type_.lower(), first, last):
+                    variables[key] = value
+
+            elif kind == 'query':
+                type_, first, last = m.group('q_type', 'q_first', 'q_last')
+                replies.extend(variables.get(key, '0')
+                               for key in self._keys(type_.lower(), first,
+                                                     last))
+
+            elif kind == 'open':
+                self._open_plc = number = int(m.group('plc'))
+                self.plcs.setdefault(number, [])
+
+            elif kind == 'other':
+                if m.group('other')[0] in _invalid_start:
+                    raise ValueError(m.group('other'))
+
+    def mismatched_plcs(self, programs):
+        '''
+        Numbers of the PLCs of programs ({number: [lines]}, see
+        comm.program_lines) which were not received line for line
+        '''
+        with self._lock:
+            return [number for number, lines in sorted(programs.items())
+                    if self.plcs.get(number) != lines]
+
+    def _keys(self, type_, first, last):
+        first = int(first)
+        last = int(last) if last is not None else first
+        if last < first:
+            raise ValueError('%d..%d' % (first, last))
+        return ['%s%d' % (type_, num) for num in range(first, last + 1)]
+
+
+if __name__ == '__main__':
+    opts = docopt(__doc__)
+
+    server = PmacStandIn((opts['--host'], int(opts['--port'])))
+    print('Listening on %s:%d' % server.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# vi: ts=4 sw=4
+"""
+tpmac.stats
+Stage timing and counters for the parse/clean pipeline
+
+Nothing is recorded unless a PipelineStats is being collected:
+
+    with stats.collect() as pipeline_stats:
+        write_clean_pmc(...)
+    pipeline_stats.write_json(sys.stderr)
+
+Instrumented code checks stats.current, which is None otherwise.
+"""
+
+from __future__ import print_function
+import json
+import time
+from contextlib import contextmanager
+
+
+# the PipelineStats being collected (see collect), or None
+current = None
+
+
+class PipelineStats(object):
+    '''
+    Wall time of each pipeline stage, and counters
+
+    Attributes:
+        times: {stage: seconds}
+        calls: {stage: number of times the stage was entered}
+        counters: {name: count}, e.g. lines, blocks, unparsed_lines
+        patterns: {line pattern: lines matched}
+    '''
+    def __init__(self):
+        self.times = {}
+        self.calls = {}
+        self.counters = {}
+        self.patterns = {}
+
+    @contextmanager
+    def stage(self, name):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - t0)
+
+    def add_time(self, name, elapsed):
+        self.times[name] = self.times.get(name, 0.0) + elapsed
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def hit(self, pattern):
+        self.patterns[pattern] = self.patterns.get(pattern, 0) + 1
+
+    def as_dict(self):
+        stages = dict((name, {'seconds': self.times[name],
+                              'calls': self.calls[name]})
+                      for name in self.times)
+        return {'stages': stages,
+                'counters': dict(self.counters),
+                'patterns': dict(self.patterns),
+                }
+
+    def write_json(self, fileobj):
+        json.dump(self.as_dict(), fileobj, indent=2, sort_keys=True)
+        fileobj.write('\n')
+
+
+@contextmanager
+def collect(stats=None, enabled=True):
+    '''
+    Record into stats (a new PipelineStats by default) for the duration
+    of the with block.  With enabled=False, nothing is recorded and the
+    with block gets None.
+    '''
+    global current
+
+    if not enabled:
+        stats = None
+    elif stats is None:
+        stats = PipelineStats()
+
+    previous, current = current, stats
+    try:
+        yield stats
+    finally:
+        current = previous
+
+
+@contextmanager
+def stage(name):
+    '''
+    Time the with block as stage name, if collecting
+    '''
+    if current is None:
+        yield
+    else:
+        with current.stage(name):
+            yield
@@ -7,27 +7,134 @@ Miscellaneous utility functions
 
 import os
 import re
+from operator import itemgetter
+
+try:
+    _intern = intern
+except NameError:
+    from sys import intern as _intern
 
 VAR_TYPES = 'pqmi'
 simple_var_re = re.compile('^([pqmi])(\d+)$', flags=re.IGNORECASE)
 FIRST_WORD_RE = re.compile('^\s*([a-zA-Z]+).*?')
+# leading zeros of hex numbers, keeping a single 0 before a comma or the end
+_ADDR_ZEROS_RE = re.compile('\$0+(?=[^,])')
+# host-side (PEWIN) text substitution; the controller does not know of it
+DEFINE_RE = re.compile(r'^\s*#define\s+(\w+)\s+(.*)$', flags=re.IGNORECASE)
+# per-user directory of generated files (parse cache, info indices)
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'tpmac')
+
+# maximum number of entries in each parsed reference cache
+CACHE_SIZE = 65536
+_addr_cache = {}
+_var_cache = {}
 
 
 def clean_addr(addr):
-    repl = 1
-    while repl > 0:
-        addr, repl = re.subn('\$0([^,])', r'$\1', addr)
+    return _ADDR_ZEROS_RE.sub('$', addr)
 
-    return addr
 
+def intern_str(s):
+    '''
+    Intern a string so that repeated values (addresses, comments, variable
+    types) share a single copy.  None and unicode strings on Python 2 are
+    returned as-is.
+    '''
+    try:
+        return _intern(s)
+    except TypeError:
+        return s
 
-def var_split(var):
-    m = simple_var_re.match(var.strip())
-    if not m:
-        raise ValueError('Not a variable: %s' % var)
 
-    var_type, var_num = m.groups()
-    return var_type.lower(), int(var_num)
+def _cache_set(cache, key, value):
+    if len(cache) >= CACHE_SIZE:
+        cache.clear()
+    cache[key] = value
+
+
+class Address(tuple):
+    '''
+    A memory address (e.g., Y:$078005,8,16,S) normalized with clean_addr,
+    as (text, key): key is the lowercase text, for case-insensitive
+    lookups.  Address.parse() caches the result per string.
+    '''
+    __slots__ = ()
+
+    def __new__(cls, text):
+        text = clean_addr(text.strip())
+        return tuple.__new__(cls, (intern_str(text), intern_str(text.lower())))
+
+    text = property(itemgetter(0))
+    key = property(itemgetter(1))
+
+    @classmethod
+    def parse(cls, text):
+        if isinstance(text, cls):
+            return text
+
+        try:
+            return _addr_cache[text]
+        except KeyError:
+            addr = cls(text)
+            _cache_set(_addr_cache, text, addr)
+            return addr
+
+    def __str__(self):
+        return self[0]
+
+    def __repr__(self):
+        return 'Address(%r)' % self[0]
+
+
+class VarRef(tuple):
+    '''
+    A variable reference as (type, number), e.g. ('i', 130) for I130.
+    VarRef.parse() caches the result per string.
+    '''
+    __slots__ = ()
+
+    def __new__(cls, type_, num):
+        type_ = type_.lower()
+        if type_ not in VAR_TYPES:
+            raise ValueError('Not a variable type: %s' % type_)
+        return tuple.__new__(cls, (intern_str(type_), int(num)))
+
+    type_ = property(itemgetter(0))
+    num = property(itemgetter(1))
+
+    @property
+    def text(self):
+        return '%s%d' % self
+
+    key = text
+
+    @classmethod
+    def parse(cls, text):
+        if isinstance(text, cls):
+            return text
+
+        try:
+            return _var_cache[text]
+        except KeyError:
+            pass
+
+        m = simple_var_re.match(text.strip())
+        if not m:
+            raise ValueError('Not a variable: %s' % text)
+
+        ref = cls(*m.groups())
+        _cache_set(_var_cache, text, ref)
+        return ref
+
+    def __str__(self):
+        return '%s%d' % self
+
+    def __repr__(self):
+        return 'VarRef(%r, %d)' % self
+
+
+def var_split(var):
+    return VarRef.parse(var)
 
 
 def ivar_to_int(ivar):
@@ -39,11 +146,11 @@ def ivar_to_int(ivar):
 
 
 def clean_var(var, type_=None):
-    var_type, num = var_split(var)
-    if type_ is not None and var_type != type_.lower():
+    ref = VarRef.parse(var)
+    if type_ is not None and ref[0] != type_.lower():
         raise ValueError('Variable type mismatch')
 
-    return '%s%d' % (var_type, num)
+    return ref.text
 
 
 def get_profile_path(profile):
@@ -64,3 +171,28 @@ def get_first_word(line):
         return m.groups()[0]
     else:
         return line
+
+
+def define_substitution(defines):
+    '''
+    A function making the substitutions of defines ({name: value}, as
+    from #define lines) in a line, outside of quoted strings; None if
+    there are no defines
+    '''
+    if not defines:
+        return None
+
+    lower = dict((name.lower(), value) for name, value in defines.items())
+    names = sorted(lower, key=len, reverse=True)
+    define_re = re.compile(r'\b(%s)\b' % '|'.join(re.escape(name)
+                                                    for name in names),
+                           flags=re.IGNORECASE)
+
+    def substitute(line):
+        parts = line.split('"')
+        for i in range(0, len(parts), 2):
+            parts[i] = define_re.sub(lambda m: ' %s ' % lower[m.group(1).lower()],
+                                     parts[i])
+        return '"'.join(parts)
+
+    return substitute
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # vi: ts=4 sw=4
 """
-Usage: viewer.py [-ci] [--pdf=FILE] [--profile=geobrick_lv] PMC_FILE [PMC_FILE [PMC_FILE... ]]
+Usage: viewer.py [-ci] [--pdf=FILE] [--profile=geobrick_lv] [--file-profile=PATTERN:PROFILE...] [--cache=DIR] PMC_FILE [PMC_FILE [PMC_FILE... ]]
        viewer.py --download [--pdf=FILE]
 
 Displays turbo pmac configuration files
@@ -12,9 +12,12 @@ Arguments:
 Options:
     -c --clean       clean pmc file first (fix tabs, annotate lines)
     -p --profile=x   variable information profile [default: geobrick_lv]
+    --file-profile=PATTERN:PROFILE
+                     use PROFILE for files matching PATTERN (e.g., *_ppmac.pmc:x)
     -d --download    download "turbo srm.pdf" from Delta Tau website (http://www.deltatau.com/manuals/pdfs/TURBO%20SRM.pdf)
     -p --pdf=FILE    specify pdf documentation location (current index is of 2014/2/14 manual) [default: turbo_srm.pdf]
     -i --includes    open files included in all PMC files
+    --cache=DIR      cache parsed files in DIR
 """
 
 # TODO option for executing program instead of relying on browser pdf viewer
@@ -22,6 +25,7 @@ from __future__ import print_function
 import os
 import sys
 import atexit
+import fnmatch
 
 try:
     from cStringIO import StringIO
@@ -59,9 +63,13 @@ else:
 
 from docopt import docopt
 
-from tpmac.conf import (TpConfig, TpVars)
+from tpmac.conf import (TpConfig, TpVars, TpVarRange, TpRefIndex, load_many,
+                        resolve_include)
 import tpmac.info as tp_info
-from tpmac.clean import clean_pmc
+from tpmac.clean import clean_many
+from tpmac.cache import ParseCache
+from tpmac.mem import AddressIndex
+from tpmac.overlay import TpOverlay
 from tpmac import util
 
 PDF_FILE = 'turbo_srm.pdf'
@@ -267,7 +275,7 @@ class TextEditor(Qsci.QsciScintilla):
 
         text = text.strip()
 
-        entries = tp_info.lookup(text)
+        entries = self.cview.profile.lookup(text)
 
         if not entries:
             return
@@ -350,8 +358,10 @@ class RefListWidget(QtGui.QListWidget):
 
         info = []
 
+        profile = self.cview.profile
+
         def lookup(text):
-            for desc, page in tp_info.lookup(text):
+            for desc, page in profile.lookup(text):
                 yield desc, page
 
             mvar_info = self.main.mvar_info
@@ -365,25 +375,50 @@ class RefListWidget(QtGui.QListWidget):
                     pass
                 else:
                     try:
-                        mem_info = tp_info.mem_info[addr][0]
+                        mem_info = profile.mem_info[addr][0]
                     except:
                         mem_info = 'unknown'
 
                     yield ('%s->%s [%s]' % (text, addr, mem_info), None)
 
+                    try:
+                        aliases = self.main.mvar_index.overlapping(addr)
+                    except ValueError:
+                        aliases = []
+
+                    for (fn, tpvar), field in aliases:
+                        if tpvar.var_str.upper() != text.upper():
+                            yield ('Aliased by %s->%s (%s)' %
+                                   (tpvar.var_str.upper(), tpvar.value, fn),
+                                   None)
+
         for desc, page in lookup(text):
             info.append(desc)
             if page is not None:
                 page = int(page)
                 info.append('Documentation page <a href="%d">%d</a>' % (page, page))
 
+        try:
+            definitions = self.main.overlay.definitions(text)
+        except ValueError:  # not a variable
+            definitions = []
+
+        if len(definitions) > 1:
+            for fn, obj in reversed(definitions):
+                info.append('Defined in %s: %s' % (fn, obj))
+
+        for fn, plc_num, line_num in self.main.ref_index.references(text):
+            if fn != self.cview.fn or plc_num != self.plc.number:
+                info.append('Used in %s PLC %d (line %d)' %
+                            (fn, plc_num, line_num + 1))
+
         s = '<br>\n'.join(info)
         self.refwidget.info.setText(s)
 
     def open_pdf(self, list_item):
         text = '%s' % list_item.text()
         try:
-            desc, category, page = tp_info.ivar_info[text]
+            desc, category, page = self.cview.profile.ivar_info[text]
         except KeyError:
             pass
         else:
@@ -527,6 +562,7 @@ class ConfigView(QtGui.QTabWidget):
         self.fn = fn
         self.config = config
         self.main = main
+        self.profile = main.profile_for(fn)
 
         sw = self.source_widget = TextEditor(self)
         sw.setText('\n'.join(config.dump()))
@@ -545,63 +581,132 @@ class ConfigView(QtGui.QTabWidget):
 
 
 class MainWindow(QtGui.QMainWindow):
-    def __init__(self, fns, clean=False, load_includes=False):
+    def __init__(self, fns, clean=False, load_includes=False, cache=None,
+                 profile=None, file_profiles=()):
         QtGui.QMainWindow.__init__(self)
 
         if not fns:
             return
 
+        self.profile = tp_info.get_profile(profile or 'geobrick_lv')
+        # [(file name pattern, profile)], the first match applying
+        self.file_profiles = [(pattern, tp_info.get_profile(name))
+                              for pattern, name in file_profiles]
+
         self.tabs = QtGui.QTabWidget()
 
         self.setCentralWidget(self.tabs)
 
         self.mvar_info = tp_info.VarInfo(type_='m')
+        self.mvar_index = AddressIndex()
+        self.ref_index = TpRefIndex()
+        # files loaded later take precedence
+        self.overlay = TpOverlay()
         self.configs = {}
         self.config_views = {}
         self.variables = {}
 
         self.setWindowTitle('TpView - [%s]' % fns[0])
         self.load_includes = load_includes
+        self.cache = cache
 
         for var_type in util.VAR_TYPES:
             self.variables[var_type] = TpVars(var_type)
 
-        for fn in fns:
-            self.load_file(fn, clean, load_includes=load_includes)
+        self.load_files(fns, clean, load_includes=load_includes)
+
+    def profile_for(self, fn):
+        for pattern, profile in self.file_profiles:
+            if fnmatch.fnmatch(fn, pattern):
+                return profile
+
+        return self.profile
 
     def load_file(self, fn, clean=False, load_includes=False):
-        fn = os.path.relpath(fn)
-        if fn in self.configs:
-            return
+        self.load_files([fn], clean=clean, load_includes=load_includes)
+
+    def load_files(self, fns, clean=False, load_includes=False):
+        # files are parsed in parallel, one level of includes at a time, and
+        # then added depth-first (each file followed by its includes), so
+        # that definitions take precedence as when loading them one by one
+        fns = [os.path.relpath(fn) for fn in fns]
+        parsed = {}
+        includes = {}
+        pending = fns
+        while pending:
+            new_fns = []
+            for fn in pending:
+                if (fn not in self.configs and fn not in parsed and
+                        fn not in new_fns):
+                    new_fns.append(fn)
+
+            pending = []
+            for fn, config in zip(new_fns, self._parse_files(new_fns, clean)):
+                parsed[fn] = config
+                includes[fn] = []
+                if not load_includes:
+                    continue
+
+                for include in config.includes:
+                    include_fn = resolve_include(include.fn, fn)
+                    if include_fn is None:
+                        print('Included file not found: %s (from %s)' %
+                              (include.fn, fn))
+                    else:
+                        include_fn = os.path.relpath(include_fn)
+                        includes[fn].append(include_fn)
+                        pending.append(include_fn)
+
+        stack = list(reversed(fns))
+        while stack:
+            fn = stack.pop()
+            if fn in self.configs or fn not in parsed:
+                continue
+
+            self.add_config(fn, parsed[fn])
+            stack.extend(reversed(includes[fn]))
+
+    def _parse_files(self, fns, clean=False):
+        if not fns:
+            return []
+
+        if not clean:
+            return load_many(fns, cache=self.cache)
 
-        if clean:
-            print('Cleaning file: %s' % fn)
+        print('Cleaning files: %s' % ', '.join(fns))
+        configs = []
+        for lines in clean_many(fns, annotate=True, fix_indent=True,
+                                cache=self.cache):
             output = StringIO()
-            for line in clean_pmc(fn, annotate=True, fix_indent=True):
+            for line in lines:
                 print(line, file=output)
 
             output.seek(0)
-            self.configs[fn] = TpConfig(output)
-        else:
-            self.configs[fn] = TpConfig(fn)
+            configs.append(TpConfig(output))
+
+        return configs
 
-        config = self.configs[fn]
+    def add_config(self, fn, config):
+        self.configs[fn] = config
         config_view = self.config_views[fn] = ConfigView(self, config, fn)
         self.tabs.addTab(config_view, fn)
 
         for tpvar in config.variables['m']:
+            if isinstance(tpvar, TpVarRange):
+                continue
+
             var_name = tpvar.var_str
             addr = tpvar.value
             self.mvar_info.add_item(var_name, [addr])
 
+        self.mvar_index.add_config(config, name=fn)
+        self.ref_index.add_config(fn, config)
+        self.overlay.add_layer(fn, config)
+
         for var_type, tpvars in config.variables.items():
             for tpvar in tpvars:
                 self.variables[var_type].add_var(tpvar)
 
-        if load_includes:
-            for include in config.includes:
-                self.load_file(include.fn, clean=clean, load_includes=load_includes)
-
 
 def download(url, filename):
     print('Download: %s' % url)
@@ -633,14 +738,22 @@ if __name__ == "__main__":
         download(PDF_URL, PDF_FILE)
         sys.exit(0)
 
-    tp_info.load_settings(opts['--profile'])
+    profile = tp_info.load_settings(opts['--profile'])
+    file_profiles = [spec.rsplit(':', 1) for spec in opts['--file-profile']]
     pmc_files = opts['PMC_FILE']
 
     print('Loading: %s' % ', '.join(pmc_files))
 
     app = QtGui.QApplication(sys.argv)
+    if opts['--cache']:
+        cache = ParseCache(opts['--cache'])
+    else:
+        cache = None
+
     main = MainWindow(pmc_files, clean=opts['--clean'],
-                      load_includes=opts['--includes'])
+                      load_includes=opts['--includes'],
+                      cache=cache, profile=profile,
+                      file_profiles=file_profiles)
 
     main.show()
     app.exec_()